@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import array
+import struct
+
+
+# ----------------------------------------------------------
+# Compact key/value store
+#
+# A Python dict of small strings spends several times the size of the data on
+# object headers, hash table entries and allocator slack. This store keeps
+# every key and value in one contiguous bytearray (the arena) and finds them
+# through an open-addressing index of plain integers.
+#
+# Each record in the arena is a block:
+#
+#   [key length][value length][key bytes][value bytes][padding]
+#
+# rounded up to a multiple of BLOCK_ALIGN bytes. A freed block goes on a free
+# list for its size and is reused by the next record of the same size, which
+# is most records for keys and values of similar length.
+#
+# The store is a drop-in replacement for the dict in NodeCore.map. It is not
+# thread safe; NodeCore serializes access to it.
+#
+
+HEADER = struct.Struct("=II")       # key length, value length
+BLOCK_ALIGN = 8
+
+INITIAL_SLOTS = 1024                # Index size, always a power of two
+MAX_LOAD = 0.66                     # Used slots (incl. deleted) before growing
+
+EMPTY = 0                           # Index slot never used
+DELETED = -1                        # Index slot whose record was removed
+
+
+def block_size(key_length, value_length):
+    size = HEADER.size + key_length + value_length
+    return (size + BLOCK_ALIGN - 1) & ~(BLOCK_ALIGN - 1)
+
+
+class ArenaStore:
+
+    def __init__(self, slots=INITIAL_SLOTS):
+        self.arena = bytearray()
+        self.free_blocks = dict()   # block size -> list of free offsets
+        self.free_size = 0          # Total size of free blocks
+        self.count = 0              # Live records
+        self.payload_size = 0       # Total length of live keys and values
+        self.allocate_index(slots)
+
+    def allocate_index(self, slots):
+        # Slots hold offset+1 of a record, EMPTY or DELETED. The hash of each
+        # record's key is kept alongside so that probing rarely has to compare
+        # keys in the arena.
+        self.slots = array.array('l', [EMPTY]) * slots
+        self.hashes = array.array('l', [0]) * slots
+        self.mask = slots - 1
+        self.used_slots = 0
+
+    # ------------------------------------------------------
+    # Index
+
+    # Returns (slot, found). If the key is not in the store, slot is
+    # where it should be inserted.
+    def find_slot(self, key):
+        key_hash = hash(key)
+        slot = key_hash & self.mask
+        first_deleted = None
+
+        while True:
+            entry = self.slots[slot]
+            if entry == EMPTY:
+                if first_deleted is not None:
+                    return (first_deleted, False)
+                return (slot, False)
+            elif entry == DELETED:
+                if first_deleted is None:
+                    first_deleted = slot
+            elif self.hashes[slot] == key_hash and self.key_at(entry - 1) == key:
+                return (slot, True)
+            slot = (slot + 1) & self.mask
+
+    def grow_index(self):
+        old_slots = self.slots
+        old_hashes = self.hashes
+
+        size = len(old_slots)
+        while self.count + 1 > size * MAX_LOAD / 2:
+            size *= 2
+        self.allocate_index(size)
+
+        for i in xrange(len(old_slots)):
+            entry = old_slots[i]
+            if entry > 0:
+                key_hash = old_hashes[i]
+                slot = key_hash & self.mask
+                while self.slots[slot] != EMPTY:
+                    slot = (slot + 1) & self.mask
+                self.slots[slot] = entry
+                self.hashes[slot] = key_hash
+                self.used_slots += 1
+
+    # ------------------------------------------------------
+    # Arena
+
+    def key_at(self, offset):
+        (key_length, value_length) = HEADER.unpack_from(self.arena, offset)
+        start = offset + HEADER.size
+        return str(self.arena[start:start+key_length])
+
+    def value_at(self, offset):
+        (key_length, value_length) = HEADER.unpack_from(self.arena, offset)
+        start = offset + HEADER.size + key_length
+        return str(self.arena[start:start+value_length])
+
+    def block_at(self, offset):
+        (key_length, value_length) = HEADER.unpack_from(self.arena, offset)
+        return block_size(key_length, value_length)
+
+    def write_block(self, key, value):
+        size = block_size(len(key), len(value))
+        free = self.free_blocks.get(size)
+        if free:
+            offset = free.pop()
+            self.free_size -= size
+        else:
+            offset = len(self.arena)
+            self.arena.extend(bytearray(size))
+
+        HEADER.pack_into(self.arena, offset, len(key), len(value))
+        start = offset + HEADER.size
+        self.arena[start:start+len(key)] = key
+        start += len(key)
+        self.arena[start:start+len(value)] = value
+        return offset
+
+    def free_block(self, offset):
+        size = self.block_at(offset)
+        self.free_blocks.setdefault(size, []).append(offset)
+        self.free_size += size
+
+    # ------------------------------------------------------
+    # Dict interface
+
+    def get(self, key, default=None):
+        (slot, found) = self.find_slot(key)
+        if not found:
+            return default
+        return self.value_at(self.slots[slot] - 1)
+
+    def __getitem__(self, key):
+        (slot, found) = self.find_slot(key)
+        if not found:
+            raise KeyError(key)
+        return self.value_at(self.slots[slot] - 1)
+
+    def __setitem__(self, key, value):
+        key = str(key)
+        value = str(value)
+        (slot, found) = self.find_slot(key)
+
+        if found:
+            offset = self.slots[slot] - 1
+            (key_length, old_value_length) = HEADER.unpack_from(self.arena, offset)
+            if block_size(len(key), len(value)) == self.block_at(offset):
+                # Same size block: overwrite in place
+                HEADER.pack_into(self.arena, offset, len(key), len(value))
+                start = offset + HEADER.size + len(key)
+                self.arena[start:start+len(value)] = value
+            else:
+                self.free_block(offset)
+                self.slots[slot] = self.write_block(key, value) + 1
+            self.payload_size += len(value) - old_value_length
+            return
+
+        if (self.used_slots + 1) > len(self.slots) * MAX_LOAD:
+            self.grow_index()
+            (slot, found) = self.find_slot(key)
+
+        if self.slots[slot] == EMPTY:
+            self.used_slots += 1
+        self.slots[slot] = self.write_block(key, value) + 1
+        self.hashes[slot] = hash(key)
+        self.count += 1
+        self.payload_size += len(key) + len(value)
+
+    def __delitem__(self, key):
+        (slot, found) = self.find_slot(key)
+        if not found:
+            raise KeyError(key)
+        offset = self.slots[slot] - 1
+        (key_length, value_length) = HEADER.unpack_from(self.arena, offset)
+        self.payload_size -= key_length + value_length
+        self.free_block(offset)
+        self.slots[slot] = DELETED
+        self.count -= 1
+
+    def pop(self, key, *default):
+        (slot, found) = self.find_slot(key)
+        if not found:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self.value_at(self.slots[slot] - 1)
+        del self[key]
+        return value
+
+    def __contains__(self, key):
+        return self.find_slot(key)[1]
+
+    def __len__(self):
+        return self.count
+
+    def update(self, pairs):
+        if isinstance(pairs, dict):
+            pairs = pairs.iteritems()
+        for (key, value) in pairs:
+            self[key] = value
+
+    def iteritems(self):
+        for entry in self.slots:
+            if entry > 0:
+                yield (self.key_at(entry - 1), self.value_at(entry - 1))
+
+    def iterkeys(self):
+        for entry in self.slots:
+            if entry > 0:
+                yield self.key_at(entry - 1)
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    # ------------------------------------------------------
+    # Memory accounting
+
+    # Exact number of bytes held by the arena and the index
+    def bytes_used(self):
+        return (len(self.arena)
+                + self.slots.itemsize * len(self.slots)
+                + self.hashes.itemsize * len(self.hashes))
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import random
+import unittest
+
+import arena_store
+import node
+from node_test import find_key_with_modulus
+
+
+class TestArenaStore(unittest.TestCase):
+
+    def test_put_get(self):
+        store = arena_store.ArenaStore()
+        store["/key"] = "value"
+        self.assertEqual(store.get("/key"), "value")
+        self.assertEqual(store["/key"], "value")
+        self.assertEqual(len(store), 1)
+        self.assertTrue("/key" in store)
+
+    def test_get_missing(self):
+        store = arena_store.ArenaStore()
+        self.assertEqual(store.get("/missing"), None)
+        self.assertEqual(store.get("/missing", "default"), "default")
+        self.assertRaises(KeyError, lambda: store["/missing"])
+        self.assertFalse("/missing" in store)
+
+    def test_overwrite_same_size_in_place(self):
+        store = arena_store.ArenaStore()
+        store["/key"] = "aaaa"
+        arena_length = len(store.arena)
+        store["/key"] = "bbbb"
+        self.assertEqual(store.get("/key"), "bbbb")
+        self.assertEqual(len(store.arena), arena_length)
+        self.assertEqual(len(store), 1)
+
+    def test_overwrite_other_size(self):
+        store = arena_store.ArenaStore()
+        store["/key"] = "short"
+        store["/key"] = "a much longer value than before"
+        self.assertEqual(store.get("/key"), "a much longer value than before")
+        self.assertEqual(store.payload_size, len("/key") + 31)
+
+    def test_delete_reuses_space(self):
+        store = arena_store.ArenaStore()
+        store["/a"] = "1234567890"
+        arena_length = len(store.arena)
+
+        del store["/a"]
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.get("/a"), None)
+        self.assertEqual(store.payload_size, 0)
+
+        store["/b"] = "0987654321"
+        self.assertEqual(len(store.arena), arena_length)
+        self.assertEqual(store.get("/b"), "0987654321")
+
+    def test_delete_missing(self):
+        store = arena_store.ArenaStore()
+        def delete():
+            del store["/missing"]
+        self.assertRaises(KeyError, delete)
+
+    def test_pop(self):
+        store = arena_store.ArenaStore()
+        store["/a"] = "1"
+        self.assertEqual(store.pop("/a"), "1")
+        self.assertEqual(store.pop("/a", None), None)
+        self.assertRaises(KeyError, store.pop, "/a")
+
+    def test_binary_values(self):
+        store = arena_store.ArenaStore()
+        value = "".join(chr(i) for i in range(256))
+        store["/bin"] = value
+        self.assertEqual(store.get("/bin"), value)
+
+    def test_grow_and_churn(self):
+        store = arena_store.ArenaStore(slots=8)
+        expected = dict()
+        rnd = random.Random(42)
+        for i in range(5000):
+            key = "/key%d" % rnd.randint(0, 1000)
+            if rnd.random() < 0.3 and key in expected:
+                del store[key]
+                del expected[key]
+            else:
+                value = str(rnd.randint(0, 10 ** rnd.randint(1, 30)))
+                store[key] = value
+                expected[key] = value
+
+        self.assertEqual(len(store), len(expected))
+        self.assertEqual(dict(store.iteritems()), expected)
+        self.assertEqual(store.payload_size,
+                sum(len(k) + len(v) for (k, v) in expected.iteritems()))
+
+    def test_update(self):
+        store = arena_store.ArenaStore()
+        store.update({"/a": "1", "/b": "2"})
+        store.update([("/c", "3")])
+        self.assertEqual(sorted(store.keys()), ["/a", "/b", "/c"])
+
+    def test_bytes_used(self):
+        store = arena_store.ArenaStore(slots=16)
+        store["/a"] = "1"
+        self.assertEqual(store.bytes_used(),
+                arena_store.block_size(2, 1) + 2 * 16 * store.slots.itemsize)
+
+    def test_node_core_with_arena(self):
+        node_core = node.NodeCore(5, 0, "NEXT", arena_store.ArenaStore())
+        key = find_key_with_modulus(0, 5)
+
+        result = node_core.do_get(key)
+        self.assertTrue(isinstance(result, node.ValueNotFound))
+
+        node_core.do_put(key, "THIS IS A TEST VALUE")
+        result = node_core.do_get(key)
+        self.assertEqual(result.value, "THIS IS A TEST VALUE")
+
+
+if __name__ == '__main__':
+    unittest.main()
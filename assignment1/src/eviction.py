@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import collections
+import random
+
+
+# ----------------------------------------------------------
+# Eviction policies for a node's storage budget
+#
+# A policy keeps track of the size of every entry in a node's store and
+# decides which entry to evict when the store is over budget. Every
+# operation is O(1).
+#
+#   touch(key)        the entry was read
+#   put(key, size)    the entry was written (size is key + value length)
+#   remove(key)       the entry was deleted or evicted
+#   victim()          the entry to evict next, or None to reject the write
+#
+# NodeCore calls the policy with its lock held, so policies need no locking
+# of their own.
+#
+
+# Never evict. Writes that do not fit are rejected.
+class RejectPolicy:
+    def __init__(self):
+        self.sizes = dict()
+        self.size = 0
+
+    def size_of(self, key):
+        return self.sizes.get(key, 0)
+
+    def touch(self, key):
+        pass
+
+    def put(self, key, size):
+        self.size += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+
+    def remove(self, key):
+        self.size -= self.sizes.pop(key, 0)
+
+    def victim(self):
+        return None
+
+
+# Evict the least recently used entry
+class LRUPolicy(RejectPolicy):
+    def __init__(self):
+        # Ordered from least to most recently used
+        self.sizes = collections.OrderedDict()
+        self.size = 0
+
+    def touch(self, key):
+        size = self.sizes.pop(key, None)
+        if size is not None:
+            self.sizes[key] = size
+
+    def put(self, key, size):
+        self.size += size - self.sizes.pop(key, 0)
+        self.sizes[key] = size
+
+    def victim(self):
+        for key in self.sizes:
+            return key
+        return None
+
+
+# Approximate LRU: evict the oldest of a few randomly sampled entries
+#
+# A read only bumps the entry's last-access tick, where exact LRU moves the
+# entry to the end of a list. The victim is only roughly the least recently
+# used one. It takes more memory per entry than LRUPolicy: a tick, and a
+# slot in the key list for sampling.
+class SampledLRUPolicy(RejectPolicy):
+    def __init__(self, samples=5, random=random):
+        self.sizes = dict()
+        self.size = 0
+        self.samples = samples
+        self.random = random
+
+        self.clock = 0
+        self.last_access = dict()       # key -> clock tick of last access
+        self.keys = []                  # All keys, for sampling
+        self.positions = dict()         # key -> index in self.keys
+
+    def touch(self, key):
+        if key in self.last_access:
+            self.clock += 1
+            self.last_access[key] = self.clock
+
+    def put(self, key, size):
+        if key not in self.positions:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+        RejectPolicy.put(self, key, size)
+        self.clock += 1
+        self.last_access[key] = self.clock
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        # Move the last key into the hole
+        last = self.keys.pop()
+        if last != key:
+            self.keys[position] = last
+            self.positions[last] = position
+        del self.last_access[key]
+        RejectPolicy.remove(self, key)
+
+    def victim(self):
+        if len(self.keys) == 0:
+            return None
+        sample = [self.random.choice(self.keys) for i in range(self.samples)]
+        return min(sample, key=lambda key: self.last_access[key])
+
+
+# Policies selectable from the command line
+POLICIES = {
+    "reject": RejectPolicy,
+    "lru": LRUPolicy,
+    "sampled-lru": SampledLRUPolicy,
+}
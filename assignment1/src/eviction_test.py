@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import random
+import unittest
+
+import eviction
+import node
+
+
+class TestEvictionPolicies(unittest.TestCase):
+
+    def test_reject_tracks_size(self):
+        policy = eviction.RejectPolicy()
+        policy.put("/a", 10)
+        policy.put("/b", 5)
+        policy.put("/a", 3)
+        self.assertEqual(policy.size, 8)
+        self.assertEqual(policy.size_of("/a"), 3)
+        policy.remove("/b")
+        self.assertEqual(policy.size, 3)
+        self.assertEqual(policy.victim(), None)
+
+    def test_lru_order(self):
+        policy = eviction.LRUPolicy()
+        policy.put("/a", 1)
+        policy.put("/b", 1)
+        policy.put("/c", 1)
+        self.assertEqual(policy.victim(), "/a")
+
+        policy.touch("/a")
+        self.assertEqual(policy.victim(), "/b")
+
+        policy.put("/b", 2)
+        self.assertEqual(policy.victim(), "/c")
+        self.assertEqual(policy.size, 4)
+
+        for key in ["/c", "/a", "/b"]:
+            policy.remove(key)
+        self.assertEqual(policy.victim(), None)
+        self.assertEqual(policy.size, 0)
+
+    def test_sampled_lru_prefers_old(self):
+        policy = eviction.SampledLRUPolicy(samples=50, random=random.Random(1))
+        for i in range(10):
+            policy.put("/key%d" % i, 1)
+        for i in range(1, 10):
+            policy.touch("/key%d" % i)
+        self.assertEqual(policy.victim(), "/key0")
+
+    def test_sampled_lru_remove(self):
+        policy = eviction.SampledLRUPolicy()
+        for i in range(5):
+            policy.put("/key%d" % i, 2)
+        policy.remove("/key1")
+        policy.remove("/key4")
+        policy.remove("/missing")
+        self.assertEqual(sorted(policy.keys), ["/key0", "/key2", "/key3"])
+        for key in policy.keys:
+            self.assertEqual(policy.keys[policy.positions[key]], key)
+        self.assertEqual(policy.size, 6)
+
+
+class TestNodeStorageBudget(unittest.TestCase):
+
+    def test_reject_when_full(self):
+        node_core = node.NodeCore(1, 0, "NEXT", max_size=20)
+        self.assertTrue(isinstance(node_core.do_put("/a", "123456789"), node.ValueStored))
+        self.assertTrue(isinstance(node_core.do_put("/b", "123456789"), node.StorageFull))
+        self.assertTrue(isinstance(node_core.do_get("/b"), node.ValueNotFound))
+
+        # Overwriting with a value of the same size still fits
+        self.assertTrue(isinstance(node_core.do_put("/a", "987654321"), node.ValueStored))
+        self.assertEqual(node_core.policy.size, 11)
+
+    def test_lru_evicts(self):
+        node_core = node.NodeCore(1, 0, "NEXT", max_size=30,
+                policy=eviction.LRUPolicy())
+        node_core.do_put("/a", "12345678")
+        node_core.do_put("/b", "12345678")
+        node_core.do_put("/c", "12345678")
+        node_core.do_get("/a")
+
+        self.assertTrue(isinstance(node_core.do_put("/d", "12345678"), node.ValueStored))
+        self.assertTrue(isinstance(node_core.do_get("/b"), node.ValueNotFound))
+        self.assertEqual(node_core.do_get("/a").value, "12345678")
+        self.assertEqual(len(node_core.map), 3)
+        self.assertEqual(node_core.policy.size, 30)
+
+    def test_too_large_for_budget(self):
+        node_core = node.NodeCore(1, 0, "NEXT", max_size=10,
+                policy=eviction.LRUPolicy())
+        node_core.do_put("/a", "1")
+        self.assertTrue(isinstance(node_core.do_put("/b", "x" * 20), node.StorageFull))
+        self.assertEqual(node_core.do_get("/a").value, "1")
+
+    def test_batch_rejects(self):
+        node_core = node.NodeCore(1, 0, "NEXT", max_size=10)
+        result = node_core.do_put_batch([("/a", "1234"), ("/b", "1234")])
+        self.assertEqual(result.values, {"/a": "1234"})
+        self.assertEqual(result.rejected, ["/b"])
+
+    def test_existing_entries_counted(self):
+        node_core = node.NodeCore(1, 0, "NEXT", {"/a": "1234"}, max_size=10)
+        self.assertEqual(node_core.policy.size, 6)
+        self.assertTrue(isinstance(node_core.do_put("/b", "1234"), node.StorageFull))
+
+
+if __name__ == '__main__':
+    unittest.main()
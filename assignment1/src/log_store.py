@@ -0,0 +1,419 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+# ----------------------------------------------------------
+# Persistent append-only key/value store (Bitcask style)
+#
+# Every PUT or delete is appended to the active segment file in the data
+# directory, and an in-memory index maps each key to the segment, offset and
+# length of its latest value. A GET is a single read at that offset.
+#
+# When the active segment grows past MAX_SEGMENT_SIZE it is closed and a hint
+# file is written next to it: the keys of the segment with value offsets, but
+# without the values. On startup the index is rebuilt from the hint files, so
+# only segments without a hint (the one that was active when the node went
+# down) are scanned in full.
+#
+# Overwritten and deleted values stay in their segments until a compaction
+# copies the live values of all closed segments into one new segment and
+# removes the old files. Compaction can run in a background thread.
+#
+# Data record:  [crc32][key length][value length][deadline][key][value]
+# Hint record:  [key length][value length][value offset][deadline][key]
+#
+# A value length of -1 marks a deleted key (a tombstone). The deadline is
+# the time (as in time.time()) a value written with a time to live expires,
+# or 0 for values that never do. The store only keeps deadlines across
+# restarts; expiring values is up to the node.
+#
+
+DATA_HEADER = struct.Struct("=Iiid")    # crc32, key length, value length, deadline
+HINT_HEADER = struct.Struct("=iiQd")    # key length, value length, value offset, deadline
+
+MAX_SEGMENT_SIZE = 67108864             # Size before starting a new segment (64 megabytes)
+COMPACT_INTERVAL = 60                   # Seconds between compaction checks
+COMPACT_GARBAGE_RATIO = 0.3             # Share of dead bytes in closed segments that triggers compaction
+
+TOMBSTONE = -1
+
+
+def segment_name(segment_id, extension):
+    return "%010d.%s" % (segment_id, extension)
+
+
+def record_crc(key, value_length, deadline, value):
+    crc = zlib.crc32(struct.pack("=iid", len(key), value_length, deadline))
+    crc = zlib.crc32(key, crc)
+    crc = zlib.crc32(value, crc)
+    return crc & 0xffffffff
+
+
+# Reads (key, value length, value offset, deadline) from a segment's data file. Stops at
+# the first incomplete or corrupt record, which is where a crash cut off the
+# last write, and returns the length of the valid part as well.
+def scan_data_file(path):
+    entries = []
+    with open(path, "rb") as f:
+        data = f.read()
+
+    pos = 0
+    while pos + DATA_HEADER.size <= len(data):
+        (crc, key_length, value_length, deadline) = DATA_HEADER.unpack_from(data, pos)
+        start = pos + DATA_HEADER.size
+        end = start + key_length + max(value_length, 0)
+        if key_length < 0 or end > len(data):
+            break
+
+        key = data[start:start+key_length]
+        value = data[start+key_length:end]
+        if crc != record_crc(key, value_length, deadline, value):
+            break
+
+        entries.append((key, value_length, start + key_length, deadline))
+        pos = end
+    return (entries, pos)
+
+
+def read_hint_file(path):
+    entries = []
+    with open(path, "rb") as f:
+        data = f.read()
+
+    pos = 0
+    while pos + HINT_HEADER.size <= len(data):
+        (key_length, value_length, value_offset, deadline) = HINT_HEADER.unpack_from(data, pos)
+        pos += HINT_HEADER.size
+        entries.append((data[pos:pos+key_length], value_length, value_offset, deadline))
+        pos += key_length
+    return entries
+
+
+# Hints are written to a temporary file and renamed, so a hint file is either
+# complete or absent.
+def write_hint_file(path, entries):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for (key, value_length, value_offset, deadline) in entries:
+            f.write(HINT_HEADER.pack(len(key), value_length, value_offset, deadline))
+            f.write(key)
+    os.rename(tmp, path)
+
+
+class LogStore:
+
+    def __init__(self, directory, max_segment_size=MAX_SEGMENT_SIZE, sync=False):
+        self.directory = directory
+        self.max_segment_size = max_segment_size
+        self.sync = sync                # fsync after every write
+
+        self.index = dict()             # key -> (segment id, value offset, value length)
+        self.deadlines = dict()         # key -> deadline, for values that expire
+        self.readers = dict()           # segment id -> open file for reading
+        self.sizes = dict()             # segment id -> bytes in segment
+        self.garbage = dict()           # segment id -> bytes of dead records
+        self.payload_size = 0           # Total length of live keys and values
+
+        # The store is used from request threads and the compactor thread
+        self.lock = threading.RLock()
+        self.compacting = threading.Lock()
+        self.compactor = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.load()
+
+    def path(self, segment_id, extension):
+        return os.path.join(self.directory, segment_name(segment_id, extension))
+
+    # ------------------------------------------------------
+    # Startup
+
+    def segment_ids(self):
+        ids = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".data"):
+                ids.append(int(name[:-len(".data")]))
+        return sorted(ids)
+
+    def load(self):
+        ids = self.segment_ids()
+        for segment_id in ids:
+            data_path = self.path(segment_id, "data")
+            hint_path = self.path(segment_id, "hint")
+
+            if os.path.exists(hint_path):
+                entries = read_hint_file(hint_path)
+            else:
+                # Segment that was active when we stopped. Cut off any torn
+                # write at the end and write the hint we did not get to.
+                (entries, valid_length) = scan_data_file(data_path)
+                if valid_length < os.path.getsize(data_path):
+                    with open(data_path, "r+b") as f:
+                        f.truncate(valid_length)
+                write_hint_file(hint_path, entries)
+
+            self.sizes[segment_id] = os.path.getsize(data_path)
+            self.garbage[segment_id] = 0
+            self.readers[segment_id] = open(data_path, "rb")
+            for (key, value_length, value_offset, deadline) in entries:
+                self.apply(key, segment_id, value_offset, value_length, deadline)
+
+        self.open_active(ids[-1] + 1 if ids else 1)
+
+    def open_active(self, segment_id):
+        self.active_id = segment_id
+        self.active_entries = []
+        path = self.path(segment_id, "data")
+        self.writer = open(path, "ab")
+        self.readers[segment_id] = open(path, "rb")
+        self.sizes[segment_id] = 0
+        self.garbage[segment_id] = 0
+
+    # Point the index at a new record, and count what it replaces as garbage
+    def apply(self, key, segment_id, value_offset, value_length, deadline=0):
+        record_size = DATA_HEADER.size + len(key) + max(value_length, 0)
+        old = self.index.get(key)
+        if old is not None:
+            (old_id, old_offset, old_length) = old
+            self.garbage[old_id] += DATA_HEADER.size + len(key) + old_length
+            self.payload_size -= len(key) + old_length
+
+        if value_length == TOMBSTONE:
+            if old is not None:
+                del self.index[key]
+            self.garbage[segment_id] += record_size
+        else:
+            self.index[key] = (segment_id, value_offset, value_length)
+            self.payload_size += len(key) + value_length
+
+        if value_length != TOMBSTONE and deadline:
+            self.deadlines[key] = deadline
+        else:
+            self.deadlines.pop(key, None)
+
+    # ------------------------------------------------------
+    # Writing
+
+    def append(self, key, value_length, value, deadline=0):
+        if self.sizes[self.active_id] >= self.max_segment_size:
+            self.rotate()
+
+        offset = self.sizes[self.active_id]
+        self.writer.write(DATA_HEADER.pack(record_crc(key, value_length, deadline, value),
+                len(key), value_length, deadline))
+        self.writer.write(key)
+        self.writer.write(value)
+        self.writer.flush()
+        if self.sync:
+            os.fsync(self.writer.fileno())
+
+        value_offset = offset + DATA_HEADER.size + len(key)
+        self.sizes[self.active_id] = value_offset + len(value)
+        self.active_entries.append((key, value_length, value_offset, deadline))
+        self.apply(key, self.active_id, value_offset, value_length, deadline)
+
+    # Close the active segment with a hint file and start a new one
+    def rotate(self):
+        self.writer.close()
+        write_hint_file(self.path(self.active_id, "hint"), self.active_entries)
+        self.open_active(self.active_id + 1)
+
+    # ------------------------------------------------------
+    # Dict interface
+
+    def get(self, key, default=None):
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return default
+            (segment_id, value_offset, value_length) = location
+            reader = self.readers[segment_id]
+            reader.seek(value_offset)
+            return reader.read(value_length)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put_expiring(key, value, None)
+
+    # Store a value together with the time it expires, kept across restarts
+    def put_expiring(self, key, value, deadline):
+        with self.lock:
+            self.append(str(key), len(value), str(value), deadline or 0)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.index:
+                raise KeyError(key)
+            self.append(key, TOMBSTONE, "")
+
+    def pop(self, key, *default):
+        with self.lock:
+            value = self.get(key)
+            if value is None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            del self[key]
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.index
+
+    def __len__(self):
+        with self.lock:
+            return len(self.index)
+
+    def update(self, pairs):
+        if isinstance(pairs, dict):
+            pairs = pairs.iteritems()
+        with self.lock:
+            for (key, value) in pairs:
+                self[key] = value
+
+    def keys(self):
+        with self.lock:
+            return self.index.keys()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        for key in self.keys():
+            value = self.get(key)
+            if value is not None:
+                yield (key, value)
+
+    def items(self):
+        return list(self.iteritems())
+
+    # (key, key + value length) of every entry, without reading values
+    def entry_sizes(self):
+        with self.lock:
+            return [(key, len(key) + location[2])
+                    for (key, location) in self.index.iteritems()]
+
+    # (key, deadline) of every value that expires
+    def expiring(self):
+        with self.lock:
+            return self.deadlines.items()
+
+    # Bytes on disk, including dead records not yet compacted
+    def bytes_used(self):
+        with self.lock:
+            return sum(self.sizes.values())
+
+    # ------------------------------------------------------
+    # Compaction
+
+    def garbage_ratio(self):
+        with self.lock:
+            closed = [i for i in self.sizes if i != self.active_id]
+            size = sum(self.sizes[i] for i in closed)
+            if size == 0:
+                return 0.0
+            return float(sum(self.garbage[i] for i in closed)) / size
+
+    # Merge the live values of all closed segments into one segment
+    #
+    # Values are copied without holding the store lock. Keys written or
+    # deleted while the copy runs keep their newer entries.
+    def compact(self):
+        with self.compacting:
+            with self.lock:
+                closed = sorted(i for i in self.sizes if i != self.active_id)
+                if len(closed) == 0:
+                    return
+                live = [(key, location, self.deadlines.get(key, 0))
+                        for (key, location) in self.index.iteritems()
+                        if location[0] != self.active_id]
+
+            # The merged segment takes the id of the newest closed segment,
+            # so it still sorts before the active segment on startup.
+            merged_id = closed[-1]
+            data_path = self.path(merged_id, "data")
+            readers = dict((i, open(self.path(i, "data"), "rb")) for i in closed)
+
+            moved = []
+            offset = 0
+            with open(data_path + ".tmp", "wb") as out:
+                for (key, (segment_id, value_offset, value_length), deadline) in live:
+                    reader = readers[segment_id]
+                    reader.seek(value_offset)
+                    value = reader.read(value_length)
+                    out.write(DATA_HEADER.pack(record_crc(key, value_length, deadline, value),
+                            len(key), value_length, deadline))
+                    out.write(key)
+                    out.write(value)
+                    new_offset = offset + DATA_HEADER.size + len(key)
+                    moved.append((key, (segment_id, value_offset, value_length),
+                            new_offset, deadline))
+                    offset = new_offset + value_length
+                out.flush()
+                os.fsync(out.fileno())
+            for reader in readers.values():
+                reader.close()
+
+            entries = [(key, location[2], new_offset, deadline)
+                    for (key, location, new_offset, deadline) in moved]
+            write_hint_file(self.path(merged_id, "hint") + ".new", entries)
+
+            with self.lock:
+                for segment_id in closed:
+                    self.readers.pop(segment_id).close()
+                    del self.sizes[segment_id]
+                    del self.garbage[segment_id]
+
+                # Without a hint a segment is scanned on startup, so a crash
+                # between the renames can not pair old hints with new data.
+                os.remove(self.path(merged_id, "hint"))
+                os.rename(data_path + ".tmp", data_path)
+                os.rename(self.path(merged_id, "hint") + ".new", self.path(merged_id, "hint"))
+                for segment_id in closed[:-1]:
+                    os.remove(self.path(segment_id, "data"))
+                    os.remove(self.path(segment_id, "hint"))
+
+                self.readers[merged_id] = open(data_path, "rb")
+                self.sizes[merged_id] = offset
+                self.garbage[merged_id] = 0
+
+                for (key, location, new_offset, deadline) in moved:
+                    if self.index.get(key) == location:
+                        self.index[key] = (merged_id, new_offset, location[2])
+                    else:
+                        # Overwritten or deleted while we were copying
+                        self.garbage[merged_id] += DATA_HEADER.size + len(key) + location[2]
+
+    # Compact in a background thread whenever enough garbage builds up
+    def start_compactor(self, interval=COMPACT_INTERVAL):
+        def compactor():
+            while True:
+                time.sleep(interval)
+                if self.garbage_ratio() >= COMPACT_GARBAGE_RATIO:
+                    self.compact()
+
+        self.compactor = threading.Thread(name="log compactor", target=compactor)
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            write_hint_file(self.path(self.active_id, "hint"), self.active_entries)
+            for reader in self.readers.values():
+                reader.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import log_store
+
+
+class TestLogStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self, store, **kwargs):
+        store.close()
+        return log_store.LogStore(self.directory, **kwargs)
+
+    def test_put_get(self):
+        store = log_store.LogStore(self.directory)
+        store["/key"] = "value"
+        self.assertEqual(store.get("/key"), "value")
+        self.assertEqual(store.get("/missing"), None)
+        self.assertEqual(len(store), 1)
+        store.close()
+
+    def test_overwrite_and_delete(self):
+        store = log_store.LogStore(self.directory)
+        store["/a"] = "1"
+        store["/a"] = "22"
+        store["/b"] = "3"
+        del store["/b"]
+        self.assertEqual(store.get("/a"), "22")
+        self.assertEqual(store.get("/b"), None)
+        self.assertEqual(store.payload_size, len("/a") + 2)
+        store.close()
+
+    def test_survives_restart(self):
+        store = log_store.LogStore(self.directory)
+        store["/a"] = "1"
+        store["/b"] = "2"
+        del store["/b"]
+
+        store = self.reopen(store)
+        self.assertEqual(store.get("/a"), "1")
+        self.assertEqual(store.get("/b"), None)
+        self.assertEqual(len(store), 1)
+        store.close()
+
+    def test_restart_without_close_scans_data(self):
+        store = log_store.LogStore(self.directory)
+        store["/a"] = "1"
+        store["/b"] = "2"
+        store.writer.close()
+
+        # No hint for the active segment, so it is scanned
+        store = log_store.LogStore(self.directory)
+        self.assertEqual(store.get("/a"), "1")
+        self.assertEqual(store.get("/b"), "2")
+        store.close()
+
+    def test_torn_write_is_truncated(self):
+        store = log_store.LogStore(self.directory)
+        store["/a"] = "1"
+        store["/b"] = "2"
+        store.writer.close()
+
+        path = store.path(store.active_id, "data")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        store = log_store.LogStore(self.directory)
+        self.assertEqual(store.get("/a"), "1")
+        self.assertEqual(store.get("/b"), None)
+        store["/c"] = "3"
+        store = self.reopen(store)
+        self.assertEqual(store.get("/c"), "3")
+        store.close()
+
+    def test_rotate_writes_hints(self):
+        store = log_store.LogStore(self.directory, max_segment_size=64)
+        for i in range(20):
+            store["/key%d" % i] = "value %d" % i
+        self.assertTrue(len(store.sizes) > 1)
+        self.assertTrue(os.path.exists(store.path(1, "hint")))
+
+        store = self.reopen(store, max_segment_size=64)
+        for i in range(20):
+            self.assertEqual(store.get("/key%d" % i), "value %d" % i)
+        store.close()
+
+    def test_compact(self):
+        store = log_store.LogStore(self.directory, max_segment_size=64)
+        for round in range(5):
+            for i in range(10):
+                store["/key%d" % i] = "value %d %d" % (i, round)
+        del store["/key0"]
+        self.assertTrue(store.garbage_ratio() > 0.5)
+        size_before = store.bytes_used()
+
+        store.compact()
+        self.assertEqual(store.garbage_ratio(), 0.0)
+        self.assertTrue(store.bytes_used() < size_before)
+        self.assertEqual(len(store.sizes), 2)
+        self.assertEqual(store.get("/key0"), None)
+        for i in range(1, 10):
+            self.assertEqual(store.get("/key%d" % i), "value %d 4" % i)
+
+        store = self.reopen(store, max_segment_size=64)
+        self.assertEqual(store.get("/key0"), None)
+        for i in range(1, 10):
+            self.assertEqual(store.get("/key%d" % i), "value %d 4" % i)
+        store.close()
+
+    def test_deadlines_survive_restart(self):
+        store = log_store.LogStore(self.directory, max_segment_size=64)
+        store.put_expiring("/a", "1", 1000.5)
+        store.put_expiring("/b", "2", 2000.0)
+        store["/b"] = "3"
+        store.put_expiring("/c", "4", 3000.0)
+        del store["/c"]
+        for i in range(10):
+            store["/key%d" % i] = "value %d" % i
+        self.assertEqual(dict(store.expiring()), {"/a": 1000.5})
+
+        store = self.reopen(store, max_segment_size=64)
+        self.assertEqual(dict(store.expiring()), {"/a": 1000.5})
+        store.compact()
+        store = self.reopen(store, max_segment_size=64)
+        self.assertEqual(dict(store.expiring()), {"/a": 1000.5})
+        self.assertEqual(store.get("/a"), "1")
+        self.assertEqual(store.get("/b"), "3")
+        store.close()
+
+    def test_items(self):
+        store = log_store.LogStore(self.directory)
+        store.update({"/a": "1", "/b": "2"})
+        self.assertEqual(dict(store.iteritems()), {"/a": "1", "/b": "2"})
+        self.assertEqual(sorted(store.keys()), ["/a", "/b"])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,22 +2,46 @@
 # vim: set sts=4 sw=4 et:
 
 import BaseHTTPServer
+import Queue
 import SocketServer
+import select
 import time
 import threading
 import signal
+import socket
 import sys
 import os
 import getopt
 import hashlib
+import httplib
 from pprint import pformat
 
+import arena_store
+import eviction
+import key_hash as khash
+import log_store
 import node_request
+import placement
+import snapshot_store
+import timer_wheel
 
 MAX_CONTENT_LENGHT = 1024		# Maximum length of the content of the http request (1 kilobyte)
-MAX_STORAGE_SIZE = 104857600	# Maximum total storage allowed (100 megabytes)
+MAX_STORAGE_SIZE = 104857600	# Default storage budget of a node (100 megabytes)
+
+KEEPALIVE_TIMEOUT = 60			# Seconds an idle keep-alive connection is kept open
+MAX_BATCH_CONTENT_LENGTH = 16777216	# Maximum length of a batch request (16 megabytes)
+DEFAULT_WORKERS = 256			# Worker threads in the "pool" concurrency model
+EXPIRY_INTERVAL = 1			# Seconds between reclaiming expired keys
+REPAIR_TIMEOUT = 30			# Seconds read repair waits for slow replicas
+
+# Sent when every worker is busy, see ThreadPoolMixIn.reject
+BUSY_RESPONSE = ("HTTP/1.1 503 Service Unavailable\r\n"
+        "Content-Type: text/html\r\nContent-Length: 11\r\n"
+        "Connection: close\r\n\r\nServer busy")
 
 node_httpserver_port = 8000
+node_snapshot_path = None		# Snapshot file written by POST /snapshot
+node_addresses = []			# Host of every rank, in replicated mode
 
 # Convenience method to concisely hash a string with MD5
 def md5_string(s):
@@ -27,10 +51,36 @@ def md5_string(s):
     return digest
 
 # Hashing function to map string keys to an integer key space
+#
+# This runs for every request that does not carry its hash yet. The function
+# and the width of the key space are set with --hash and --key-bits (see
+# key_hash.py and hash_benchmark.py); the default is the full 128 bit MD5.
 def node_hash(s):
-    hexhash = md5_string(s)
-    numerichash = long(hexhash,16)
-    return numerichash
+    return khash.hash_key(s)
+
+
+# (key, size) of every entry in a store, where size is the length of the key
+# and value. Stores that can tell sizes without reading values do so.
+def entry_sizes(store):
+    if hasattr(store, "entry_sizes"):
+        return store.entry_sizes()
+    return ((key, len(key) + len(value)) for (key, value) in store.iteritems())
+
+
+# (key, deadline) of every value a store keeps with the time it expires.
+# Only persistent stores keep deadlines, so they survive a restart.
+def expiring_entries(store):
+    if hasattr(store, "expiring"):
+        return store.expiring()
+    return []
+
+
+# Store a value, and its deadline (or None) in stores that keep deadlines
+def put_value(store, key, value, deadline):
+    if hasattr(store, "put_expiring"):
+        store.put_expiring(key, value, deadline)
+    else:
+        store[key] = value
 
 
 # ----------------------------------------------------------
@@ -43,11 +93,32 @@ class ValueFound:
 
 class ValueNotFound: pass
 
+# A value with the version stamp it was written with, see NodeCore.new_version
+class VersionFound:
+    def __init__(self, value, version, ttl=None):
+        self.value = value
+        self.version = version
+        self.ttl = ttl                      # Seconds left to live, if it expires
+
 class ValueStored: pass
 
+# The value does not fit in the node's storage budget
+class StorageFull: pass
+
 class ForwardRequest:
-    def __init__(self, destination):
+    def __init__(self, destination, key_hash=None):
         self.destination = destination
+        self.key_hash = key_hash            # To pass on, so it is not hashed again
+
+# Result of a batch request: the values for the keys handled by this node, and
+# the rest of the batch, which should be forwarded to the destination in one
+# request.
+class BatchResult:
+    def __init__(self, values, remaining, destination, rejected=None):
+        self.values = values
+        self.remaining = remaining
+        self.destination = destination
+        self.rejected = rejected or []      # Keys that did not fit
 
 
 # ----------------------------------------------------------
@@ -57,21 +128,65 @@ class ForwardRequest:
 #
 class NodeCore:
 
-    def __init__(self, node_count, rank, next_node):
-        self.map = dict()
+    # store is the key/value map to keep data in, a dict by default. Anything
+    # with the dict methods used here will do, see STORAGE_ENGINES.
+    #
+    # Keys and values together may take up to max_size bytes. The eviction
+    # policy decides what gives way when a write does not fit, see
+    # eviction.POLICIES. By default such writes are rejected.
+    #
+    # Values stored with a time to live expire at their deadline on clock.
+    # Reads never return an expired value, and expire() reclaims the expired
+    # values nobody reads, using a timer wheel so that only the keys that
+    # actually expired are visited. Stores that persist values persist the
+    # deadlines with them, and the timers are set up again from those.
+    #
+    # placement maps key hashes to ranks, see placement.PLACEMENTS. It is
+    # modulo by default, and must be the same on every node and frontend.
+    #
+    # With replicas > 1 every key is kept on the rank placement gives it and
+    # the replicas - 1 ranks after it, with a version stamp, see
+    # replica_ranks. Versions are kept in memory only; values without one
+    # (after a restart) lose to any stamped copy.
+    #
+    def __init__(self, node_count, rank, next_node, store=None,
+            max_size=MAX_STORAGE_SIZE, policy=None, clock=time.time,
+            placement=placement.modulo, replicas=1):
+        self.map = store if store is not None else dict()
+        # Requests are served concurrently, so all access to the map goes
+        # through this lock.
+        self.lock = threading.Lock()
         self.node_count = long(node_count)
         self.rank = long(rank)
         self.next_node = next_node
+        self.placement = placement
+
+        self.max_size = max_size
+        self.policy = policy if policy is not None else eviction.RejectPolicy()
+        for (key, size) in entry_sizes(self.map):
+            self.policy.put(key, size)
+
+        self.clock = clock
+        self.expiry = dict()                # key -> deadline, for keys with a ttl
+        self.timers = timer_wheel.TimerWheel(clock())
+        for (key, deadline) in expiring_entries(self.map):
+            self.expiry[key] = deadline
+            self.timers.schedule(key, deadline)
+
+        self.replicas = min(replicas, self.node_count)
+        self.versions = dict()              # key -> version stamp
+        self.last_version = 0
 
     # Hashes the key into the key space and decides if this key is in range to
     # be handled by this node.
     def responsible_for_key(self, key):
         # First hash the key using a standard hashing algorithm.
-        # Then do a modulo operation on the number of nodes in the cluster.
-        # This effectively maps the key to a key space of integers from 0 to n-1.
-        # Each node is responsible for one integer in this key space.
-        key_hash = node_hash(key)
-        rank_responsible = key_hash % self.node_count
+        return self.responsible_for_hash(node_hash(key))
+
+    def responsible_for_hash(self, key_hash):
+        # Then map the hash to a rank, from 0 to n-1, with the placement
+        # strategy. Each node is responsible for one rank.
+        rank_responsible = self.placement(key_hash, self.node_count)
         return rank_responsible == self.rank
 
 
@@ -80,12 +195,83 @@ class NodeCore:
     # Returns a ValueStored instance if the value was stored successfully, or a
     # ForwardReqest instance if the request should be forwarded to another node.
     #
-    def do_put(self, key, value):
-        if self.responsible_for_key(key):
-            self.map[key] = value
-            return ValueStored()
+    # The value expires ttl seconds from now if ttl is given. key_hash is the
+    # hash of the key if the caller already has it.
+    #
+    def do_put(self, key, value, ttl=None, key_hash=None):
+        if key_hash is None:
+            key_hash = node_hash(key)
+        if self.responsible_for_hash(key_hash):
+            with self.lock:
+                stored = self.store_value(key, value, ttl)
+            if stored: return ValueStored()
+            else: return StorageFull()
         else:
-            return ForwardRequest(self.next_node)
+            return ForwardRequest(self.next_node, key_hash)
+
+    # Store a value within the storage budget, evicting entries as the policy
+    # decides. Returns False if the value does not fit. Call with the lock held.
+    def store_value(self, key, value, ttl=None, version=None):
+        size = len(key) + len(value)
+        if size > self.max_size:
+            return False
+
+        # Expired values go first
+        if self.policy.size - self.policy.size_of(key) + size > self.max_size:
+            self.reclaim_expired()
+
+        while self.policy.size - self.policy.size_of(key) + size > self.max_size:
+            victim = self.policy.victim()
+            if victim is None:
+                return False
+            self.remove_value(victim)
+
+        deadline = self.clock() + ttl if ttl is not None else None
+        put_value(self.map, key, value, deadline)
+        self.policy.put(key, size)
+
+        if version is None:
+            self.versions.pop(key, None)
+        else:
+            self.versions[key] = version
+
+        if deadline is None:
+            self.expiry.pop(key, None)
+            self.timers.cancel(key)
+        else:
+            self.expiry[key] = deadline
+            self.timers.schedule(key, deadline)
+        return True
+
+    # Remove a value and everything kept about it. Call with the lock held.
+    def remove_value(self, key):
+        self.map.pop(key, None)
+        self.versions.pop(key, None)
+        self.policy.remove(key)
+        self.expiry.pop(key, None)
+        self.timers.cancel(key)
+
+    # The value of a key, or None if there is none or it has expired. Call
+    # with the lock held.
+    def live_value(self, key):
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= self.clock():
+            self.remove_value(key)
+            return None
+        return self.map.get(key)
+
+    # Remove the values whose time to live has passed. Returns how many were
+    # removed. Call with the lock held.
+    def reclaim_expired(self):
+        expired = self.timers.advance(self.clock())
+        for key in expired:
+            self.remove_value(key)
+        return len(expired)
+
+    # Reclaim expired values, called periodically
+    def expire(self):
+        with self.lock:
+            return self.reclaim_expired()
 
     # Handle a request to look up a key
     #
@@ -94,13 +280,123 @@ class NodeCore:
     # is nothing stored there yet, and a ForwardReqest instance if the request
     # should be forwarded to another node.
     #
-    def do_get(self, key):
-        if self.responsible_for_key(key):
-            value = self.map.get(key)
+    # key_hash is the hash of the key if the caller already has it.
+    #
+    def do_get(self, key, key_hash=None):
+        if key_hash is None:
+            key_hash = node_hash(key)
+        if self.responsible_for_hash(key_hash):
+            with self.lock:
+                value = self.live_value(key)
+                if value: self.policy.touch(key)
             if value: return ValueFound(value)
             else: return ValueNotFound()
         else:
-            return ForwardRequest(self.next_node)
+            return ForwardRequest(self.next_node, key_hash)
+
+    # Handle a request to store a batch of key-value pairs
+    #
+    # Stores the pairs this node is responsible for, with time to live ttl if
+    # given. Returns a BatchResult with the stored keys as values, the keys
+    # that did not fit, and the pairs that must be forwarded.
+    #
+    def do_put_batch(self, pairs, ttl=None):
+        owned = list()
+        remaining = list()
+        for (key, value) in pairs:
+            if self.responsible_for_key(key):
+                owned.append((key, value))
+            else:
+                remaining.append((key, value))
+
+        stored = dict()
+        rejected = list()
+        with self.lock:
+            for (key, value) in owned:
+                if self.store_value(key, value, ttl):
+                    stored[key] = value
+                else:
+                    rejected.append(key)
+        return BatchResult(stored, remaining, self.next_node, rejected)
+
+    # Handle a request to look up a batch of keys
+    #
+    # Returns a BatchResult with the values of the keys this node is
+    # responsible for (None if there is nothing stored) and the keys that
+    # must be forwarded.
+    #
+    def do_get_batch(self, keys):
+        owned = list()
+        remaining = list()
+        for key in keys:
+            if self.responsible_for_key(key):
+                owned.append(key)
+            else:
+                remaining.append(key)
+
+        values = dict()
+        with self.lock:
+            for key in owned:
+                values[key] = self.live_value(key) or None
+                if values[key]: self.policy.touch(key)
+        return BatchResult(values, remaining, self.next_node)
+
+    # The ranks that keep copies of a key: the rank placement gives it, and
+    # the ones after it, wrapping around
+    def replica_ranks(self, key_hash):
+        first = self.placement(key_hash, self.node_count)
+        return [(first + i) % self.node_count for i in range(self.replicas)]
+
+    # A new version stamp, for a write this node coordinates
+    #
+    # Stamps are microseconds since the epoch, made unique by the rank of the
+    # node in the lowest digits, so the last write wins. They only grow on
+    # each node, even if its clock goes back.
+    #
+    def new_version(self):
+        with self.lock:
+            version = long(self.clock() * 1000000) * self.node_count + self.rank
+            if version <= self.last_version:
+                version = self.last_version + self.node_count
+            self.last_version = version
+            return version
+
+    # Handle a write of a replica of a key, from the node coordinating it
+    #
+    # Stores the value unless there is a newer version of the key already.
+    # Returns ValueStored either way, or StorageFull.
+    #
+    def put_version(self, key, value, version, ttl=None):
+        with self.lock:
+            if self.live_value(key) is not None and self.versions.get(key, 0) >= version:
+                return ValueStored()
+            if self.store_value(key, value, ttl, version):
+                return ValueStored()
+            return StorageFull()
+
+    # Handle a read of a replica of a key
+    #
+    # Returns a VersionFound instance, with version 0 for a value that has
+    # none, or a ValueNotFound instance.
+    #
+    def get_version(self, key):
+        with self.lock:
+            value = self.live_value(key)
+            if value is None:
+                return ValueNotFound()
+            self.policy.touch(key)
+            ttl = None
+            if key in self.expiry:
+                ttl = self.expiry[key] - self.clock()
+            return VersionFound(value, self.versions.get(key, 0), ttl)
+
+    # A consistent copy of all key-value pairs, for snapshots. Snapshots have
+    # no room for deadlines, so values with a time to live are left out rather
+    # than restored without one.
+    def snapshot_items(self):
+        with self.lock:
+            return [(key, value) for (key, value) in self.map.iteritems()
+                    if key not in self.expiry]
 
 
 
@@ -114,13 +410,40 @@ class NodeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     global node
 
+    # Keep connections open between requests. Every response must then carry
+    # a Content-Length so the client knows where it ends.
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    # In the pool model a worker serves one request of a connection, and
+    # the connection waits for the next without it, see ThreadPoolMixIn
+    def handle(self):
+        if getattr(self.server, "parks_connections", False):
+            self.handle_one_request()
+        else:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+
     # Handle a GET request, to look up a key
     def do_GET(self):
         # The URL path is the key
         key = self.path
 
+        try:
+            key_hash = node_request.parse_key_hash(self.headers)
+            quorum = node_request.parse_quorum(self.headers, node.replicas)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        if self.headers.get(node_request.REPLICA_HEADER):
+            self.replica_get(key)
+            return
+        elif node.replicas > 1:
+            self.quorum_get(key, key_hash, quorum)
+            return
+
         # Defer to NodeCore
-        result = node.do_get(key)
+        result = node.do_get(key, key_hash)
 
         # Take action depending on NodeCore decision
         if isinstance(result, ValueFound):
@@ -132,7 +455,7 @@ class NodeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         elif isinstance(result, ForwardRequest):
             # Forward request to specified node
             (status_code, content_type, data) = node_request.sendGET(
-                    result.destination, node_httpserver_port, key)
+                    result.destination, node_httpserver_port, key, result.key_hash)
 
             # Relay response to requesting node
             self.respond(status_code, content_type, data)
@@ -150,39 +473,399 @@ class NodeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         contentLength = int(self.headers['Content-Length'])
 
         if contentLength <= 0 or contentLength > MAX_CONTENT_LENGHT:
+            # The body is left unread, so the connection can not be reused
+            self.close_connection = 1
             self.respond(400, "text/html", "Content body too large")
             return
 
         # The value is the body of the PUT request
         value = self.rfile.read(contentLength)
 
+        try:
+            ttl = node_request.parse_ttl(self.headers)
+            key_hash = node_request.parse_key_hash(self.headers)
+            quorum = node_request.parse_quorum(self.headers, node.replicas)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        if self.headers.get(node_request.REPLICA_HEADER):
+            self.replica_put(key, value, ttl)
+            return
+        elif node.replicas > 1:
+            self.quorum_put(key, value, ttl, key_hash, quorum)
+            return
+
         # Defer to NodeCore
-        result = node.do_put(key, value)
+        result = node.do_put(key, value, ttl, key_hash)
 
         # Take action depending on NodeCore decision
         if isinstance(result, ValueStored):
             self.respond(200, "application/octet-stream", "")
 
+        elif isinstance(result, StorageFull):
+            self.respond(507, "text/html", "Storage full")
+
         elif isinstance(result, ForwardRequest):
-            node_request.sendPUT(result.destination, node_httpserver_port, key, value)
+            try:
+                node_request.sendPUT(result.destination, node_httpserver_port,
+                        key, value, ttl, result.key_hash)
+            except node_request.StorageFullError:
+                self.respond(507, "text/html", "Storage full")
+                return
             self.respond(200, "application/octet-stream", "")
 
         else:
             raise Exception("Unknown result command: " + pformat(result))
 
 
+    # Handle a POST request, for batches of keys and node commands
+    #
+    #   /batch/get   body is a batch of keys, responds with a batch of values
+    #   /batch/put   body is a batch of key-value pairs to store
+    #   /snapshot    write a snapshot of this node's store
+    #
+    # Batches are in the format of node_request.encode_batch. A TTL header on
+    # a batch put applies to every pair. In replicated mode every key of a
+    # batch is read or written like a single key, with the quorum header's
+    # quorum.
+    def do_POST(self):
+        contentLength = int(self.headers['Content-Length'])
+
+        if contentLength < 0 or contentLength > MAX_BATCH_CONTENT_LENGTH:
+            self.close_connection = 1
+            self.respond(400, "text/html", "Content body too large")
+            return
+
+        body = self.rfile.read(contentLength)
+
+        if self.path == "/snapshot":
+            self.do_snapshot()
+            return
+
+        try:
+            pairs = node_request.decode_batch(body)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        try:
+            quorum = node_request.parse_quorum(self.headers, node.replicas)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        if self.path == "/batch/get" and node.replicas > 1:
+            self.quorum_get_batch([key for (key, value) in pairs], quorum)
+
+        elif self.path == "/batch/get":
+            result = node.do_get_batch([key for (key, value) in pairs])
+            values = result.values
+
+            # Forward the rest of the batch, and merge in the answer
+            if result.remaining:
+                values.update(node_request.sendMultiGET(
+                        result.destination, node_httpserver_port, result.remaining))
+
+            body = node_request.encode_batch(
+                    [(key, values.get(key)) for (key, value) in pairs])
+            self.respond(200, "application/octet-stream", body)
+
+        elif self.path == "/batch/put":
+            for (key, value) in pairs:
+                if not value or len(value) > MAX_CONTENT_LENGHT:
+                    self.respond(400, "text/html", "Bad value for key " + key)
+                    return
+
+            try:
+                ttl = node_request.parse_ttl(self.headers)
+            except ValueError as e:
+                self.respond(400, "text/html", str(e))
+                return
+
+            if node.replicas > 1:
+                self.quorum_put_batch(pairs, ttl, quorum)
+                return
+
+            result = node.do_put_batch(pairs, ttl)
+            full = len(result.rejected) > 0
+
+            if result.remaining:
+                try:
+                    node_request.sendMultiPUT(result.destination, node_httpserver_port,
+                            result.remaining, ttl)
+                except node_request.StorageFullError:
+                    full = True
+
+            if full:
+                self.respond(507, "text/html", "Storage full")
+            else:
+                self.respond(200, "application/octet-stream", "")
+
+        else:
+            self.respond(404, "text/html", "Unknown batch operation")
+
+
+    # Replicated mode
+    #
+    # Reads and writes wait for a quorum of the key's replicas: the quorum
+    # header's number, a majority by default. R + W > N makes every read see
+    # the latest acknowledged write; R=1 or W=1 answer faster.
+
+    # Answer a GET with the newest value of the first 'quorum' replicas to
+    # answer, and bring the stale replicas up to date in the background
+    def quorum_get(self, key, key_hash, quorum):
+        quorum = quorum_size(quorum)
+        (answered, newest) = quorum_read(key, key_hash, quorum)
+
+        if answered < quorum:
+            self.respond(503, "text/html", "%d of %d replicas answered"
+                    % (answered, quorum))
+        elif newest is None:
+            self.respond(404, "text/html", "Key not found")
+        else:
+            self.respond(200, "application/octet-stream", newest[0])
+
+    # Store a PUT on every replica, with a new version, and answer once
+    # 'quorum' of them have stored it. The rest are left to finish.
+    def quorum_put(self, key, value, ttl, key_hash, quorum):
+        quorum = quorum_size(quorum)
+        (stored, failed, count) = quorum_write(key, value, ttl, key_hash, quorum)
+
+        if stored >= quorum:
+            self.respond(200, "application/octet-stream", "")
+        elif stored + failed < count:
+            self.respond(507, "text/html", "Storage full")
+        else:
+            self.respond(503, "text/html", "%d of %d replicas stored the value"
+                    % (stored, quorum))
+
+    # Answer a batch GET with a quorum read of each key, one key after the
+    # other. Fails with 503 as soon as a key has too few replicas answering.
+    def quorum_get_batch(self, keys, quorum):
+        quorum = quorum_size(quorum)
+        values = dict()
+        for key in keys:
+            (answered, newest) = quorum_read(key, None, quorum)
+            if answered < quorum:
+                self.respond(503, "text/html", "%d of %d replicas of %s answered"
+                        % (answered, quorum, key))
+                return
+            values[key] = newest[0] if newest is not None else None
+
+        body = node_request.encode_batch([(key, values[key]) for key in keys])
+        self.respond(200, "application/octet-stream", body)
+
+    # Store a batch PUT like a PUT of each pair, every pair with a version
+    # of its own, one pair after the other
+    def quorum_put_batch(self, pairs, ttl, quorum):
+        quorum = quorum_size(quorum)
+        full = False
+        for (key, value) in pairs:
+            (stored, failed, count) = quorum_write(key, value, ttl, None, quorum)
+            if stored >= quorum:
+                continue
+            if stored + failed < count:
+                full = True
+            else:
+                self.respond(503, "text/html", "%d of %d replicas stored %s"
+                        % (stored, quorum, key))
+                return
+
+        if full:
+            self.respond(507, "text/html", "Storage full")
+        else:
+            self.respond(200, "application/octet-stream", "")
+
+    # Answer a read of our replica of a key, from a coordinating node
+    def replica_get(self, key):
+        result = node.get_version(key)
+        if isinstance(result, VersionFound):
+            self.respond(200, "application/octet-stream", result.value,
+                    node_request.version_headers(result.version, result.ttl))
+        else:
+            self.respond(404, "text/html", "Key not found")
+
+    # Store a replica of a key, from a coordinating node
+    def replica_put(self, key, value, ttl):
+        try:
+            version = node_request.parse_version(self.headers)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        result = node.put_version(key, value, version, ttl)
+        if isinstance(result, ValueStored):
+            self.respond(200, "application/octet-stream", "")
+        else:
+            self.respond(507, "text/html", "Storage full")
+
+
+    # Write a point-in-time snapshot of the store to node_snapshot_path
+    def do_snapshot(self):
+        if node_snapshot_path is None:
+            self.respond(404, "text/html", "No snapshot file configured")
+            return
+
+        start = time.time()
+        count = snapshot_store.write_snapshot(node_snapshot_path, node.snapshot_items())
+        self.respond(200, "text/plain", "Wrote %d keys to %s in %1.3fs"
+                % (count, node_snapshot_path, time.time() - start))
+
+
     # Convenience method to make it easier to send responses
-    def respond(self, status_code, content_type, body):
+    def respond(self, status_code, content_type, body, headers={}):
         self.send_response(status_code)
         self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(body)
 
 
+# ----------------------------------------------------------
+# Replicas of a key, for the coordinating node
+#
+
+# The number of replicas to wait for: the quorum asked for, or a majority
+def quorum_size(quorum):
+    if quorum is None:
+        return node.replicas // 2 + 1
+    return quorum
+
+# Read a key from its replicas, until 'quorum' or all of them have
+# answered. Returns (number of replicas that answered, newest (value,
+# version, ttl) among them or None). With a quorum, the stale replicas are
+# brought up to date in the background, see read_repair.
+def quorum_read(key, key_hash, quorum):
+    if key_hash is None:
+        key_hash = node_hash(key)
+
+    ranks = node.replica_ranks(key_hash)
+    answers = fan_out(ranks, lambda rank: read_replica(rank, key))
+    (replies, failed) = gather(answers, len(ranks), quorum, lambda reply: True)
+
+    answered = len(replies)
+    if answered < quorum:
+        return (answered, None)
+
+    newest = newest_reply(replies.values())
+    repair = threading.Thread(name="read repair", target=read_repair,
+            args=(key, answers, len(ranks) - answered - failed, replies))
+    repair.daemon = True
+    repair.start()
+    return (answered, newest)
+
+# Write a value to every replica of a key with a new version, until
+# 'quorum' have stored it or all have answered. The rest are left to
+# finish. Returns (replicas that stored it, replicas that failed, replicas).
+def quorum_write(key, value, ttl, key_hash, quorum):
+    if key_hash is None:
+        key_hash = node_hash(key)
+
+    version = node.new_version()
+    ranks = node.replica_ranks(key_hash)
+    answers = fan_out(ranks,
+            lambda rank: write_replica(rank, key, value, version, ttl))
+    (replies, failed) = gather(answers, len(ranks), quorum, lambda stored: stored)
+
+    stored = len([r for r in replies.values() if r is True])
+    return (stored, failed, len(ranks))
+
+# Run call(rank) for every rank in parallel. Returns a queue where each
+# (rank, result) arrives as soon as its call returns; result is the
+# exception if the call raised one.
+def fan_out(ranks, call):
+    answers = Queue.Queue()
+
+    def worker(rank):
+        try:
+            result = call(rank)
+        except Exception as e:
+            result = e
+        answers.put((rank, result))
+
+    for rank in ranks:
+        t = threading.Thread(target = worker, args = (rank,))
+        t.daemon = True
+        t.start()
+    return answers
+
+# Take answers from the queue until 'quorum' calls have returned a result
+# that is ok(result), or all 'count' calls have returned. Returns ({rank:
+# result} of the calls that returned, number of calls that raised).
+def gather(answers, count, quorum, ok):
+    replies = dict()
+    (succeeded, failed) = (0, 0)
+    while succeeded < quorum and len(replies) + failed < count:
+        (rank, result) = answers.get()
+        if isinstance(result, Exception):
+            failed += 1
+        else:
+            replies[rank] = result
+            if ok(result):
+                succeeded += 1
+    return (replies, failed)
+
+# Read the replica of a key on a rank. Returns (value, version, ttl), or None.
+def read_replica(rank, key):
+    if rank == node.rank:
+        result = node.get_version(key)
+        if isinstance(result, VersionFound):
+            return (result.value, result.version, result.ttl)
+        return None
+    return node_request.sendReplicaGET(node_addresses[rank],
+            node_httpserver_port, key)
+
+# Write the replica of a key on a rank. Returns False if it has no room.
+def write_replica(rank, key, value, version, ttl=None):
+    if rank == node.rank:
+        return isinstance(node.put_version(key, value, version, ttl), ValueStored)
+    try:
+        node_request.sendReplicaPUT(node_addresses[rank], node_httpserver_port,
+                key, value, version, ttl)
+    except node_request.StorageFullError:
+        return False
+    return True
+
+# The (value, version, ttl) with the highest version, None if there is none
+def newest_reply(replies):
+    found = [r for r in replies if r is not None]
+    if len(found) == 0:
+        return None
+    return max(found, key=lambda (value, version, ttl): version)
+
+# Wait for the 'pending' replicas of a read that were still out when it was
+# answered, then write the newest value to every replica that answered
+# without it. Replicas that did not answer are left alone.
+def read_repair(key, answers, pending, replies):
+    for i in range(pending):
+        try:
+            (rank, result) = answers.get(timeout=REPAIR_TIMEOUT)
+        except Queue.Empty:
+            break
+        if not isinstance(result, Exception):
+            replies[rank] = result
+
+    newest = newest_reply(replies.values())
+    if newest is None:
+        return
+    (value, version, ttl) = newest
+    for (rank, reply) in replies.items():
+        if reply is None or reply[1] < version:
+            try:
+                write_replica(rank, key, value, version, ttl)
+            except (socket.error, httplib.HTTPException) as e:
+                print "Read repair of %s on rank %d failed: %s" % (key, rank, e)
+
+
 # ----------------------------------------------------------
 # Basic HTTP server
 #
-class NodeServer(BaseHTTPServer.HTTPServer, SocketServer.ForkingMixIn, SocketServer.ThreadingMixIn):
+# Serves one request at a time. Use one of the concurrent servers below.
+#
+class NodeServer(BaseHTTPServer.HTTPServer):
 
     def server_bind(self):
         BaseHTTPServer.HTTPServer.server_bind(self)
@@ -198,6 +881,7 @@ class NodeServer(BaseHTTPServer.HTTPServer, SocketServer.ForkingMixIn, SocketSer
             except socket.timeout:
                 if not self.run:
                     raise socket.error
+        raise socket.error
 
     def stop(self):
         self.run = False
@@ -207,19 +891,245 @@ class NodeServer(BaseHTTPServer.HTTPServer, SocketServer.ForkingMixIn, SocketSer
             self.handle_request()
 
 
+# ----------------------------------------------------------
+# Bounded pool of worker threads
+#
+# Accepted connections are queued and served by a fixed number of worker
+# threads. When all workers are busy and the queue is full, a request is
+# answered with 503 and its connection closed, see reject. Waiting for room
+# instead would stop the accept loop and the idle sweep below, and a ring of
+# nodes waiting on requests forwarded to each other could deadlock.
+#
+# A worker serves one request at a time, not a whole connection. Between
+# requests, keep-alive connections are parked: one thread waits for any of
+# them to become readable (epoll) and queues it for a worker again, and
+# closes those idle for longer than KEEPALIVE_TIMEOUT. Idle clients then
+# hold no workers, however many there are. Clients must not pipeline
+# requests, as a request read ahead with the previous one would be lost.
+#
+class ThreadPoolMixIn:
+
+    workers = DEFAULT_WORKERS
+    parks_connections = True
+
+    def start_workers(self):
+        self.requests = Queue.Queue(self.workers)
+        self.parked = dict()            # fd -> (request, client_address, parked at)
+        self.parked_lock = threading.Lock()
+        self.poller = select.epoll()
+        for i in range(self.workers):
+            t = threading.Thread(target = self.process_request_worker)
+            t.daemon = True
+            t.start()
+        t = threading.Thread(target = self.watch_parked)
+        t.daemon = True
+        t.start()
+
+    def process_request_worker(self):
+        while True:
+            (request, client_address) = self.requests.get()
+            keep_open = False
+            try:
+                keep_open = self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            if keep_open:
+                self.park(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    # Serve one request. Returns whether the connection stays open.
+    def finish_request(self, request, client_address):
+        handler = self.RequestHandlerClass(request, client_address, self)
+        return not handler.close_connection
+
+    def park(self, request, client_address):
+        fd = request.fileno()
+        with self.parked_lock:
+            self.parked[fd] = (request, client_address, time.time())
+        self.poller.register(fd, select.EPOLLIN)
+
+    def watch_parked(self):
+        checked = time.time()
+        while True:
+            for (fd, event) in self.poller.poll(1):
+                self.poller.unregister(fd)
+                with self.parked_lock:
+                    (request, client_address, parked_at) = self.parked.pop(fd)
+                self.queue_request(request, client_address)
+
+            # Close the connections that have been idle too long
+            now = time.time()
+            if now - checked < 1:
+                continue
+            checked = now
+            with self.parked_lock:
+                idle = [fd for (fd, (r, a, parked_at)) in self.parked.items()
+                        if now - parked_at > KEEPALIVE_TIMEOUT]
+                idle = [(fd, self.parked.pop(fd)[0]) for fd in idle]
+            for (fd, request) in idle:
+                self.poller.unregister(fd)
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.queue_request(request, client_address)
+
+    def queue_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Queue.Full:
+            self.reject(request)
+
+    # Answer a request with 503 without reading it, and close the connection.
+    # The response is small enough to go straight into the socket buffer.
+    def reject(self, request):
+        try:
+            request.sendall(BUSY_RESPONSE)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+
+# One thread per connection, without bound
+class ThreadingNodeServer(SocketServer.ThreadingMixIn, NodeServer):
+
+    daemon_threads = True
+
+
+# A fixed number of worker threads
+class ThreadPoolNodeServer(ThreadPoolMixIn, NodeServer):
+
+    def server_activate(self):
+        NodeServer.server_activate(self)
+        self.start_workers()
+
+
+# Persistent store in data_dir, compacted in the background
+def open_log_store(data_dir):
+    store = log_store.LogStore(data_dir)
+    store.start_compactor()
+    return store
+
+# Storage engines selectable from the command line. Each takes the data
+# directory, which only the persistent engines use.
+STORAGE_ENGINES = {
+    "dict": lambda data_dir: dict(),
+    "arena": lambda data_dir: arena_store.ArenaStore(),
+    "log": open_log_store,
+}
+
+# Concurrency models selectable from the command line
+SERVER_MODELS = {
+    "thread": ThreadingNodeServer,
+    "pool": ThreadPoolNodeServer,
+}
+
+
 if __name__ == '__main__':
 
     httpserver_port = 8000
+    concurrency = "pool"
+    workers = DEFAULT_WORKERS
+    storage = "dict"
+    data_dir = "/tmp/node_data"
+    max_size = MAX_STORAGE_SIZE
+    policy = "reject"
+    placement_name = "modulo"
+    replicas = 1
+    hash_name = khash.name
+    key_bits = khash.bits
+
+    usage = (sys.argv[0] + " [--concurrency thread|pool(default)]"
+            + " [--workers count(default=%d)]" % DEFAULT_WORKERS
+            + " [--storage dict(default)|arena|log]"
+            + " [--data-dir directory(default=/tmp/node_data)]"
+            + " [--snapshot file]"
+            + " [--max-size bytes(default=%d)]" % MAX_STORAGE_SIZE
+            + " [--eviction reject(default)|lru|sampled-lru]"
+            + " [--placement modulo(default)|jump|rendezvous]"
+            + " [--replicas count(default=1) --nodes host,host,...(every rank, in order)]"
+            + " [--hash %s(default=md5)]" % "|".join(sorted(khash.FUNCTIONS))
+            + " [--key-bits bits(default=128)]"
+            + " node_count rank next_node")
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], '',
+                ['concurrency=', 'workers=', 'storage=', 'data-dir=', 'snapshot=',
+                 'max-size=', 'eviction=', 'placement=', 'replicas=', 'nodes=',
+                 'hash=', 'key-bits='])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+
+    for opt, arg in optlist:
+        if opt == "--concurrency":
+            concurrency = arg
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--storage":
+            storage = arg
+        elif opt == "--data-dir":
+            data_dir = arg
+        elif opt == "--snapshot":
+            node_snapshot_path = arg
+        elif opt == "--max-size":
+            max_size = int(arg)
+        elif opt == "--eviction":
+            policy = arg
+        elif opt == "--placement":
+            placement_name = arg
+        elif opt == "--replicas":
+            replicas = int(arg)
+        elif opt == "--nodes":
+            node_addresses = arg.split(",")
+        elif opt == "--hash":
+            hash_name = arg
+        elif opt == "--key-bits":
+            key_bits = int(arg)
+
+    if (len(args) != 3 or concurrency not in SERVER_MODELS or workers <= 0
+            or storage not in STORAGE_ENGINES or policy not in eviction.POLICIES
+            or placement_name not in placement.PLACEMENTS or replicas < 1
+            or (replicas > 1 and len(node_addresses) != int(args[0]))):
+        print usage
+        sys.exit(2)
 
-    # sys.argv[1] --> node_count
-    # sys.argv[2] --> rank
-    # sys.argv[3] --> next_node
-    node = NodeCore(sys.argv[1], sys.argv[2], sys.argv[3])
+    try:
+        khash.configure(hash_name, key_bits)
+    except ValueError, e:
+        print e
+        sys.exit(2)
+
+    # args[0] --> node_count
+    # args[1] --> rank
+    # args[2] --> next_node
+    store = STORAGE_ENGINES[storage](data_dir)
+
+    # Serve straight from an existing snapshot while it loads in the background
+    if node_snapshot_path and os.path.exists(node_snapshot_path):
+        print "Restoring from snapshot %s" % node_snapshot_path
+        store = snapshot_store.SnapshotStore(node_snapshot_path, store)
+        store.start_loader()
+
+    node = NodeCore(args[0], args[1], args[2], store,
+            max_size, eviction.POLICIES[policy](),
+            placement=placement.PLACEMENTS[placement_name], replicas=replicas)
+
+    # Reclaim expired keys that are not read
+    def expire_periodically():
+        while True:
+            time.sleep(EXPIRY_INTERVAL)
+            node.expire()
+    expiry_thread = threading.Thread(name="expiry", target = expire_periodically)
+    expiry_thread.daemon = True
+    expiry_thread.start()
 
     # Start the webserver which handles incomming requests
     try:
-        print "Starting HTTP server on port %d" % httpserver_port
-        httpd = NodeServer(("",httpserver_port), NodeHttpHandler)
+        print "Starting HTTP server on port %d (%s)" % (httpserver_port, concurrency)
+        server_class = SERVER_MODELS[concurrency]
+        server_class.workers = workers
+        httpd = server_class(("",httpserver_port), NodeHttpHandler)
         server_thread = threading.Thread(target = httpd.serve)
         server_thread.daemon = True
         server_thread.start()
@@ -235,3 +1145,6 @@ if __name__ == '__main__':
 
     # Wait for server thread to exit
     server_thread.join(100)
+
+    if hasattr(node.map, "close"):
+        node.map.close()
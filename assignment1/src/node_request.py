@@ -1,42 +1,351 @@
 #!/usr/bin/python
 # vim: set sts=4 sw=4 et:
 
+import collections
+import errno
 import httplib
+import select
+import socket
+import threading
+
+import key_hash as khash
+
+
+MAX_IDLE_CONNECTIONS = 8        # Idle connections kept open per destination
+CONNECTION_TIMEOUT = 30         # Seconds to wait on a connection before giving up
+
+
+# ----------------------------------------------------------
+# Pool of persistent (keep-alive) connections
+#
+# Every request used to open a new TCP connection and tear it down again,
+# which dominates the cost of a small request and leaves a TIME_WAIT socket
+# behind for every call. Instead we keep a few idle connections per
+# destination and reuse them.
+#
+class ConnectionPool:
+
+    def __init__(self, hostname, port, max_idle=MAX_IDLE_CONNECTIONS):
+        self.hostname = hostname
+        self.port = port
+        self.max_idle = max_idle
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+
+    # Returns (connection, reused). Idle connections that fail the health
+    # check are closed and skipped.
+    def acquire(self):
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                conn = self.idle.pop()
+            if is_healthy(conn):
+                return (conn, True)
+            conn.close()
+
+        conn = httplib.HTTPConnection(self.hostname, self.port,
+                timeout=CONNECTION_TIMEOUT)
+        return (conn, False)
+
+    # Hand a connection back after its response has been read completely.
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            while len(self.idle) > 0:
+                self.idle.pop().close()
+
+
+# An idle connection is healthy if its socket is still open and has nothing
+# to read. A readable idle socket means the server closed it (EOF) or sent
+# something we did not ask for, either way it can not be reused.
+def is_healthy(conn):
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error):
+        return False
+    return len(readable) == 0
+
+
+pools = dict()
+pools_lock = threading.Lock()
+
+def get_pool(hostname, port):
+    with pools_lock:
+        pool = pools.get((hostname, port))
+        if pool is None:
+            pool = ConnectionPool(hostname, port)
+            pools[(hostname, port)] = pool
+        return pool
+
+def close_all():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
+
+
+# Send a request over a pooled connection and read the whole response.
+#
+# Returns (status_code, content_type, data). A reused connection may have been
+# closed by the server since we last used it, so a request that fails on a
+# reused connection before the server can have seen it is retried once on a
+# fresh one, see closed_before_response. Anything else, a timeout in
+# particular, is not retried: the request may have been carried out.
+#
+def request(hostname, port, method, path, body=None, headers=None):
+    (response, data) = send_request(hostname, port, method, path, body, headers)
+    return (response.status, response.getheader("Content-Type"), data)
+
+# Like request, but returns (response, data), for the response headers
+def send_request(hostname, port, method, path, body=None, headers=None):
+    pool = get_pool(hostname, port)
+
+    retried = False
+    while True:
+        (conn, reused) = pool.acquire()
+        sent = False
+        try:
+            conn.request(method, path, body, headers or {})
+            sent = True
+
+            # Must read response even if we don't do anything with it.
+            # If we don't, the server will get broken pipe errors, and the
+            # connection can not be reused for the next request.
+            response = conn.getresponse()
+            data = response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            if reused and not retried and closed_before_response(e, sent):
+                retried = True
+                continue
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            pool.release(conn)
+
+        return (response, data)
+
+
+# Whether a request failed because the server had closed the connection
+# already: reset or broken pipe while sending it, or the connection closed
+# without a single byte of response
+def closed_before_response(e, sent):
+    if isinstance(e, httplib.BadStatusLine):
+        return e.line == repr("")
+    if isinstance(e, socket.timeout) or sent:
+        return False
+    return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)
 
 
 # ----------------------------------------------------------
 # Common routines for sending GET and PUT requests to nodes
 #
 
+# The node had no room for the value (507 Insufficient Storage)
+class StorageFullError(httplib.HTTPException): pass
 
-# Send a PUT request, to store a key-value pair
-def sendPUT(hostname, port, key, value):
 
-    conn = httplib.HTTPConnection(hostname, port)
-    conn.request("PUT", key, value)
+# Header of a PUT or batch PUT that gives the stored values a time to live,
+# in seconds. Without it values are kept until overwritten or evicted.
+TTL_HEADER = "X-TTL"
+
+# Header with the hash of the key (node.node_hash), so that nodes a request
+# is forwarded through do not hash the key again
+KEY_HASH_HEADER = "X-Key-Hash"
+
+def request_headers(ttl=None, key_hash=None):
+    headers = dict()
+    if ttl is not None:
+        headers[TTL_HEADER] = repr(ttl)
+    if key_hash is not None:
+        headers[KEY_HASH_HEADER] = str(key_hash)
+    return headers
+
+# The time to live in the request headers, None if there is none. Raises
+# ValueError if it is not a positive number of seconds.
+def parse_ttl(headers):
+    value = headers.get(TTL_HEADER)
+    if value is None:
+        return None
+    ttl = float(value)
+    if not 0 < ttl < float("inf"):
+        raise ValueError("%s must be a positive number of seconds" % TTL_HEADER)
+    return ttl
 
-    # Must read response even if we don't do anything with it.
-    # If we don't, the server will get broken pipe errors.
-    #	1. Return without reading response
-    #	2. Server might not be finish sending response yet.
-    #	3. Library code here closes connection.
-    #	4. Server code tries to finish writing to closed pipe.
-    #	5. Broken pipe.
-    response = conn.getresponse()
-    data = response.read()
+# The key hash in the request headers, None if there is none. Only checked to
+# be in the key space: whoever sends it is trusted to have hashed the key.
+def parse_key_hash(headers):
+    value = headers.get(KEY_HASH_HEADER)
+    if value is None:
+        return None
+    key_hash = long(value)
+    if not 0 <= key_hash < khash.space:
+        raise ValueError("%s is out of the key space" % KEY_HASH_HEADER)
+    return key_hash
 
+
+# ----------------------------------------------------------
+# Replicated mode
+#
+# The node a request enters at coordinates it: it reads or writes every
+# replica of the key itself, with requests that carry the replica header,
+# and answers once the quorum header's number of replicas have. Replicas
+# answer those from their own store, with the version stamp of the value in
+# the version header.
+#
+REPLICA_HEADER = "X-Replica"
+VERSION_HEADER = "X-Version"
+QUORUM_HEADER = "X-Quorum"
+
+# The quorum in the request headers, None if there is none. Raises
+# ValueError unless it is between 1 and the number of replicas.
+def parse_quorum(headers, replicas):
+    value = headers.get(QUORUM_HEADER)
+    if value is None:
+        return None
+    quorum = int(value)
+    if not 1 <= quorum <= replicas:
+        raise ValueError("%s must be between 1 and %d" % (QUORUM_HEADER, replicas))
+    return quorum
+
+def version_headers(version, ttl=None):
+    headers = request_headers(ttl)
+    headers[VERSION_HEADER] = str(version)
+    return headers
+
+# Raises ValueError if the version is missing or not a number
+def parse_version(headers):
+    value = headers.get(VERSION_HEADER)
+    if value is None:
+        raise ValueError("%s missing" % VERSION_HEADER)
+    return long(value)
+
+# Store a replica of a key-value pair, unless the node has a newer version
+def sendReplicaPUT(hostname, port, key, value, version, ttl=None):
+    headers = version_headers(version, ttl)
+    headers[REPLICA_HEADER] = "1"
+    (status_code, content_type, data) = request(hostname, port, "PUT", key, value, headers)
+
+    if status_code==507:
+        raise StorageFullError("No room for %s on %s:%s" % (key, hostname, port))
+    if status_code!=200:
+        raise httplib.HTTPException("Replica PUT %s to %s:%s failed: %d %s"
+                % (key, hostname, port, status_code, data))
+
+# Read a replica of a key. Returns (value, version, ttl), or None if the
+# node does not have the key. ttl is None if the value does not expire.
+def sendReplicaGET(hostname, port, key):
+    (response, data) = send_request(hostname, port, "GET", key, None,
+            {REPLICA_HEADER: "1"})
+
+    if response.status==404:
+        return None
     if response.status!=200:
-        raise
+        raise httplib.HTTPException("Replica GET %s from %s:%s failed: %d %s"
+                % (key, hostname, port, response.status, data))
+    try:
+        return (data, parse_version(response.msg), parse_ttl(response.msg))
+    except ValueError as e:
+        raise httplib.HTTPException("Replica GET %s from %s:%s: %s"
+                % (key, hostname, port, e))
+
+
+# Send a PUT request, to store a key-value pair
+def sendPUT(hostname, port, key, value, ttl=None, key_hash=None):
+    (status_code, content_type, data) = request(hostname, port, "PUT", key, value,
+            request_headers(ttl, key_hash))
+
+    if status_code==507:
+        raise StorageFullError("No room for %s on %s:%s" % (key, hostname, port))
+    if status_code!=200:
+        raise httplib.HTTPException("PUT %s to %s:%s failed: %d %s"
+                % (key, hostname, port, status_code, data))
 
 
 # Send a GET request, to look up a key
-def sendGET(hostname, port, key):
-    conn = httplib.HTTPConnection(hostname, port)
-    conn.request("GET", key)
-    response = conn.getresponse()
+def sendGET(hostname, port, key, key_hash=None):
+    return request(hostname, port, "GET", key, None, request_headers(key_hash=key_hash))
+
+
+# ----------------------------------------------------------
+# Batches of keys and values
+#
+# A batch is a list of (key, value) pairs in one request body. Each pair is
+# framed as "<key length> <value length>\n<key><value>", so keys and values
+# may contain any bytes. A value of None (value length -1) stands for a key
+# without a value: the keys of a multi-get, or a key that was not found.
+#
+
+def encode_batch(pairs):
+    parts = []
+    for (key, value) in pairs:
+        if value is None:
+            parts.append("%d -1\n%s" % (len(key), key))
+        else:
+            parts.append("%d %d\n%s%s" % (len(key), len(value), key, value))
+    return "".join(parts)
+
+
+def decode_batch(data):
+    pairs = []
+    pos = 0
+    while pos < len(data):
+        newline = data.find("\n", pos)
+        if newline < 0:
+            raise ValueError("Truncated batch header at offset %d" % pos)
+        (key_length, value_length) = [int(n) for n in data[pos:newline].split(" ")]
+        pos = newline + 1
+
+        key = data[pos:pos+key_length]
+        pos += key_length
+
+        if value_length < 0:
+            value = None
+        else:
+            value = data[pos:pos+value_length]
+            pos += value_length
+
+        if len(key) != key_length or (value is not None and len(value) != value_length):
+            raise ValueError("Truncated batch item for key '%s'" % key)
+        pairs.append((key, value))
+    return pairs
+
+
+# Send a batch of key-value pairs to store
+def sendMultiPUT(hostname, port, pairs, ttl=None):
+    (status_code, content_type, data) = request(hostname, port, "POST",
+            "/batch/put", encode_batch(pairs), request_headers(ttl))
+
+    if status_code==507:
+        raise StorageFullError("No room for batch of %d keys on %s:%s"
+                % (len(pairs), hostname, port))
+    if status_code!=200:
+        raise httplib.HTTPException("Batch PUT of %d keys to %s:%s failed: %d %s"
+                % (len(pairs), hostname, port, status_code, data))
+
+
+# Look up a batch of keys
+#
+# Returns a list of (key, value) pairs, where value is None for keys that
+# were not found.
+#
+def sendMultiGET(hostname, port, keys):
+    (status_code, content_type, data) = request(hostname, port, "POST",
+            "/batch/get", encode_batch([(key, None) for key in keys]))
 
-    status_code = response.status
-    content_type = response.getheader("Content-Type")
-    data = response.read()
+    if status_code!=200:
+        raise httplib.HTTPException("Batch GET of %d keys from %s:%s failed: %d %s"
+                % (len(keys), hostname, port, status_code, data))
 
-    return (status_code, content_type, data)
+    return decode_batch(data)
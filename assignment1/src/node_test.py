@@ -1,8 +1,18 @@
 #!/usr/bin/python
 # vim: set sts=4 sw=4 et:
 
+import BaseHTTPServer
+import errno
+import httplib
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import log_store
 import node
+import node_request
 from pprint import pformat
 
 class TestNodeHashing(unittest.TestCase):
@@ -156,6 +166,366 @@ class TestNodeCore(unittest.TestCase):
         self.assertEqual(isinstance(result, node.ValueStored), True)
 
 
+    def test_put_batch_split(self):
+        node_core = node.NodeCore(3, 0, 'node1')
+        mine = find_key_with_modulus(0, 3)
+        other = find_key_with_modulus(1, 3)
+
+        result = node_core.do_put_batch([(mine, "A"), (other, "B")])
+        self.assertEqual(result.values, {mine: "A"})
+        self.assertEqual(result.remaining, [(other, "B")])
+        self.assertEqual(result.destination, "node1")
+
+        result = node_core.do_get(mine)
+        self.assertEqual(result.value, "A")
+
+    def test_get_batch_split(self):
+        node_core = node.NodeCore(3, 0, 'node1')
+        mine = find_key_with_modulus(0, 3)
+        other = find_key_with_modulus(2, 3)
+
+        result = node_core.do_get_batch([mine, other])
+        self.assertEqual(result.values, {mine: None})
+
+        node_core.do_put(mine, "A")
+        result = node_core.do_get_batch([mine, other])
+        self.assertEqual(result.values, {mine: "A"})
+        self.assertEqual(result.remaining, [other])
+        self.assertEqual(result.destination, "node1")
+
+    def test_batch_ring(self):
+        nodes = [node.NodeCore(3, 0, 'node1'),
+                node.NodeCore(3, 1, 'node2'),
+                node.NodeCore(3, 2, 'node0')]
+        pairs = [(str(i), "value %d" % i) for i in range(30)]
+
+        # Each node stores its part and forwards the rest once
+        remaining = pairs
+        for node_core in nodes:
+            remaining = node_core.do_put_batch(remaining).remaining
+        self.assertEqual(remaining, [])
+
+        values = dict()
+        remaining = [key for (key, value) in pairs]
+        for node_core in nodes:
+            result = node_core.do_get_batch(remaining)
+            values.update(result.values)
+            remaining = result.remaining
+        self.assertEqual(values, dict(pairs))
+
+
+class TestNodeKeyHash(unittest.TestCase):
+
+    def test_given_hash_is_used(self):
+        node_core = node.NodeCore(2, 0, "NEXT")
+        result = node_core.do_put("/key", "value", key_hash=1)
+        self.assertTrue(isinstance(result, node.ForwardRequest))
+        self.assertEqual(result.key_hash, 1)
+
+    def test_forward_carries_hash(self):
+        node_core = node.NodeCore(2, 0, "NEXT")
+        key = [str(i) for i in range(100) if node.node_hash(str(i)) % 2 == 1][0]
+        result = node_core.do_get(key)
+        self.assertEqual(result.key_hash, node.node_hash(key))
+
+        self.assertEqual(node_core.do_put(key, "value", key_hash=0).__class__, node.ValueStored)
+        self.assertEqual(node_core.do_get(key, key_hash=0).value, "value")
+
+
+class TestNodeExpiry(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.node_core = node.NodeCore(1, 0, "NEXT", max_size=30,
+                clock=lambda: self.now)
+
+    def test_lazy_expiry(self):
+        self.node_core.do_put("/a", "1", ttl=10)
+        self.node_core.do_put("/b", "2")
+        self.now += 9
+        self.assertEqual(self.node_core.do_get("/a").value, "1")
+        self.now += 1
+        self.assertTrue(isinstance(self.node_core.do_get("/a"), node.ValueNotFound))
+        self.assertEqual(self.node_core.do_get_batch(["/a", "/b"]).values,
+                {"/a": None, "/b": "2"})
+        self.assertEqual(self.node_core.policy.size, 3)
+
+    def test_expire_reclaims(self):
+        for i in range(5):
+            self.node_core.do_put("/%d" % i, "x", ttl=i + 1)
+        self.now += 3
+        self.assertEqual(self.node_core.expire(), 3)
+        self.assertEqual(sorted(self.node_core.map.keys()), ["/3", "/4"])
+        self.assertEqual(self.node_core.policy.size, 6)
+
+    def test_overwrite_clears_ttl(self):
+        self.node_core.do_put("/a", "1", ttl=5)
+        self.node_core.do_put("/a", "2")
+        self.now += 10
+        self.assertEqual(self.node_core.expire(), 0)
+        self.assertEqual(self.node_core.do_get("/a").value, "2")
+
+    def test_expired_values_make_room(self):
+        self.node_core.do_put("/a", "123456789012", ttl=5)
+        self.node_core.do_put("/b", "123456789012")
+        self.assertTrue(isinstance(self.node_core.do_put("/c", "1234567890"), node.StorageFull))
+        self.now += 5
+        self.assertTrue(isinstance(self.node_core.do_put("/c", "1234567890"), node.ValueStored))
+        self.assertEqual(self.node_core.policy.size, 26)
+
+    def test_snapshot_leaves_out_ttl(self):
+        self.node_core.do_put("/a", "1", ttl=5)
+        self.node_core.do_put("/b", "2")
+        self.assertEqual(self.node_core.snapshot_items(), [("/b", "2")])
+
+    def test_ttl_survives_restart(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = log_store.LogStore(directory)
+            node_core = node.NodeCore(1, 0, "NEXT", store, clock=lambda: self.now)
+            node_core.do_put("/a", "1", ttl=10)
+            node_core.do_put("/b", "2", ttl=10)
+            node_core.do_put("/b", "3")
+            store.close()
+
+            store = log_store.LogStore(directory)
+            node_core = node.NodeCore(1, 0, "NEXT", store, clock=lambda: self.now)
+            self.assertEqual(node_core.do_get("/a").value, "1")
+            self.now += 10
+            self.assertEqual(node_core.expire(), 1)
+            self.assertEqual(store.get("/a"), None)
+            self.assertEqual(node_core.do_get("/b").value, "3")
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestNodeReplication(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.node_core = node.NodeCore(4, 1, "NEXT", replicas=3,
+                clock=lambda: self.now)
+
+    def test_replica_ranks_wrap(self):
+        self.assertEqual(self.node_core.replica_ranks(1), [1, 2, 3])
+        self.assertEqual(self.node_core.replica_ranks(3), [3, 0, 1])
+        self.assertEqual(node.NodeCore(2, 0, "NEXT", replicas=3).replica_ranks(1), [1, 0])
+
+    def test_versions_grow(self):
+        first = self.node_core.new_version()
+        self.assertEqual(first % 4, 1)
+        second = self.node_core.new_version()
+        self.now -= 10
+        third = self.node_core.new_version()
+        self.assertTrue(first < second < third)
+        self.assertEqual(third % 4, 1)
+
+    def test_newer_version_wins(self):
+        self.node_core.put_version("/a", "new", 20)
+        self.node_core.put_version("/a", "old", 10)
+        result = self.node_core.get_version("/a")
+        self.assertEqual((result.value, result.version, result.ttl), ("new", 20, None))
+        self.node_core.put_version("/a", "newer", 30, ttl=5)
+        result = self.node_core.get_version("/a")
+        self.assertEqual((result.value, result.version, result.ttl), ("newer", 30, 5))
+
+    def test_unversioned_value_loses(self):
+        self.node_core.do_put("/a", "plain", key_hash=1)
+        self.assertEqual(self.node_core.get_version("/a").version, 0)
+        self.node_core.put_version("/a", "stamped", 1)
+        self.assertEqual(self.node_core.get_version("/a").value, "stamped")
+        self.assertTrue(isinstance(self.node_core.get_version("/b"), node.ValueNotFound))
+
+    def test_expired_version_is_replaced(self):
+        self.node_core.put_version("/a", "old", 20, ttl=1)
+        self.now += 1
+        self.node_core.put_version("/a", "new", 10)
+        self.assertEqual(self.node_core.get_version("/a").value, "new")
+
+    def test_newest_reply(self):
+        replies = [None, ("a", 5, None), ("b", 7, 3.0)]
+        self.assertEqual(node.newest_reply(replies), ("b", 7, 3.0))
+        self.assertEqual(node.newest_reply([None, None]), None)
+
+    def test_parse_quorum(self):
+        self.assertEqual(node_request.parse_quorum({}, 3), None)
+        self.assertEqual(node_request.parse_quorum({"X-Quorum": "2"}, 3), 2)
+        for bad in ["0", "4", "all"]:
+            self.assertRaises(ValueError, node_request.parse_quorum, {"X-Quorum": bad}, 3)
+
+
+# Replica requests to 'replica1' and 'replica2' go straight to the cores of
+# ranks 1 and 2, in this process
+class StubReplicas:
+
+    def __init__(self, cores):
+        self.cores = dict(("replica%d" % rank, core) for (rank, core) in enumerate(cores))
+
+    def get(self, hostname, port, key):
+        result = self.cores[hostname].get_version(key)
+        if isinstance(result, node.VersionFound):
+            return (result.value, result.version, result.ttl)
+        return None
+
+    def put(self, hostname, port, key, value, version, ttl=None):
+        self.cores[hostname].put_version(key, value, version, ttl)
+
+class TestQuorumBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (getattr(node, "node", None), node.node_addresses,
+                node.node_httpserver_port, node_request.sendReplicaGET,
+                node_request.sendReplicaPUT)
+        cores = [node.NodeCore(3, rank, "NEXT", replicas=3) for rank in range(3)]
+        replicas = StubReplicas(cores)
+        node.node = cores[0]
+        node.node_addresses = ["127.0.0.1", "replica1", "replica2"]
+        node_request.sendReplicaGET = replicas.get
+        node_request.sendReplicaPUT = replicas.put
+        self.cores = cores
+
+        self.server = node.ThreadPoolNodeServer(("127.0.0.1", 0), node.NodeHttpHandler)
+        self.port = self.server.server_address[1]
+        node.node_httpserver_port = self.port
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.server.server_close()
+        node_request.close_all()
+        (node.node, node.node_addresses, node.node_httpserver_port,
+                node_request.sendReplicaGET, node_request.sendReplicaPUT) = self.saved
+
+    def test_batch_put_then_quorum_get(self):
+        keys = ["/key-%d" % i for i in range(10)]
+        for key in keys:
+            node_request.sendPUT("127.0.0.1", self.port, key, "old")
+        node_request.sendMultiPUT("127.0.0.1", self.port, [(key, "new") for key in keys])
+
+        for key in keys:
+            (status, content_type, value) = node_request.sendGET("127.0.0.1", self.port, key)
+            self.assertEqual((status, value), (200, "new"))
+            for core in self.cores:
+                self.assertEqual(core.get_version(key).value, "new")
+
+    def test_batch_get_reads_quorum(self):
+        node_request.sendPUT("127.0.0.1", self.port, "/a", "old")
+        # A newer value that only ranks 1 and 2 have
+        for core in self.cores[1:]:
+            core.put_version("/a", "new", node.node.new_version())
+
+        pairs = node_request.sendMultiGET("127.0.0.1", self.port, ["/a", "/missing"])
+        self.assertEqual(pairs, [("/a", "new"), ("/missing", None)])
+
+
+class TestNodeRequestBatch(unittest.TestCase):
+
+    def test_batch_round_trip(self):
+        pairs = [("/a", "1"), ("/b\n2 3", "x\ny z"), ("/c", None), ("/d", "")]
+        data = node_request.encode_batch(pairs)
+        self.assertEqual(node_request.decode_batch(data), pairs)
+
+    def test_batch_empty(self):
+        self.assertEqual(node_request.encode_batch([]), "")
+        self.assertEqual(node_request.decode_batch(""), [])
+
+    def test_batch_truncated(self):
+        data = node_request.encode_batch([("/a", "12345")])
+        self.assertRaises(ValueError, node_request.decode_batch, data[:-1])
+        self.assertRaises(ValueError, node_request.decode_batch, "3 1")
+
+    def test_parse_key_hash(self):
+        self.assertEqual(node_request.parse_key_hash({}), None)
+        self.assertEqual(node_request.parse_key_hash({"X-Key-Hash": "12345"}), 12345)
+        for bad in ["-1", str(2**128), "abc"]:
+            self.assertRaises(ValueError, node_request.parse_key_hash, {"X-Key-Hash": bad})
+
+    def test_parse_ttl(self):
+        self.assertEqual(node_request.parse_ttl({}), None)
+        self.assertEqual(node_request.parse_ttl({"X-TTL": "2.5"}), 2.5)
+        for bad in ["0", "-1", "soon", "inf", "nan"]:
+            self.assertRaises(ValueError, node_request.parse_ttl, {"X-TTL": bad})
+
+    def test_retry_only_before_response(self):
+        closed = node_request.closed_before_response
+        self.assertEqual(closed(httplib.BadStatusLine(""), True), True)
+        self.assertEqual(closed(httplib.BadStatusLine("garbage"), True), False)
+        reset = socket.error(errno.ECONNRESET, "Connection reset by peer")
+        self.assertEqual(closed(reset, False), True)
+        self.assertEqual(closed(reset, True), False)
+        self.assertEqual(closed(socket.error(errno.EPIPE, "Broken pipe"), False), True)
+        self.assertEqual(closed(socket.timeout("timed out"), False), False)
+
+
+
+# Serves /block once the test sets server.release, anything else at once
+class BlockingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def handle(self):
+        self.handle_one_request()
+
+    def do_GET(self):
+        if self.path == "/block":
+            self.server.release.wait()
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class OneWorkerServer(node.ThreadPoolNodeServer):
+    workers = 1
+
+class TestThreadPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = OneWorkerServer(("127.0.0.1", 0), BlockingHandler)
+        self.server.release = threading.Event()
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.stop()
+        self.thread.join()
+        self.server.server_close()
+
+    def get(self, path, conn=None):
+        if conn is None:
+            conn = httplib.HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+
+    def test_busy_pool_answers(self):
+        parked = httplib.HTTPConnection("127.0.0.1", self.port, timeout=5)
+        self.assertEqual(self.get("/ok", parked), 200)
+
+        # One request on the worker, one waiting in the queue
+        blocked = [httplib.HTTPConnection("127.0.0.1", self.port, timeout=5)
+                   for i in range(2)]
+        for conn in blocked:
+            conn.request("GET", "/block")
+            time.sleep(0.2)
+
+        # New and parked connections are turned away, not left waiting
+        self.assertEqual(self.get("/ok"), 503)
+        self.assertEqual(self.get("/ok", parked), 503)
+
+        self.server.release.set()
+        for conn in blocked:
+            self.assertEqual(conn.getresponse().status, 200)
+        self.assertEqual(self.get("/ok"), 200)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+
+# ----------------------------------------------------------
+# Key placement strategies
+#
+# A strategy maps a key hash to the rank (0 to node_count - 1) of the node
+# that stores the key. Nodes and the frontend must use the same one.
+#
+#   modulo        key_hash % node_count. Changing node_count moves almost
+#                 every key.
+#   jump          Jump consistent hash (Lamping and Veach). Adding a node
+#                 at the end (rank node_count) moves only 1/node_count of the
+#                 keys, all of them to the new node. O(log n) per key.
+#   rendezvous    Highest random weight: the rank that scores highest for
+#                 the key. Adding or removing any rank moves only the keys
+#                 that rank wins. O(n) per key.
+#
+# startup.sh assigns ranks in the order the nodes are listed, so with jump
+# or rendezvous, grow the cluster by adding nodes at the end of the list.
+#
+
+MASK64 = 0xffffffffffffffff
+
+def modulo(key_hash, node_count):
+    return key_hash % node_count
+
+
+def jump(key_hash, node_count):
+    key = key_hash & MASK64
+    b = -1
+    j = 0
+    while j < node_count:
+        b = j
+        key = (key * 2862933555777941757 + 1) & MASK64
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+# 64 bit finalizer of SplitMix64, to score a (key, rank) pair
+def mix64(x):
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK64
+    return x ^ (x >> 31)
+
+def rendezvous(key_hash, node_count):
+    key = key_hash & MASK64
+    best = 0
+    best_score = -1
+    for rank in range(node_count):
+        score = mix64(key ^ ((rank + 1) * 0x9e3779b97f4a7c15 & MASK64))
+        if score > best_score:
+            (best, best_score) = (rank, score)
+    return best
+
+
+PLACEMENTS = {
+    "modulo": modulo,
+    "jump": jump,
+    "rendezvous": rendezvous,
+}
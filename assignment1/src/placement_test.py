@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import unittest
+
+import node
+import placement
+
+
+KEY_HASHES = [node.node_hash(str(i)) for i in range(5000)]
+
+class TestPlacement(unittest.TestCase):
+
+    def moved(self, place, before, after):
+        return [h for h in KEY_HASHES if place(h, before) != place(h, after)]
+
+    def test_ranks_in_range(self):
+        for place in placement.PLACEMENTS.values():
+            for count in [1, 2, 7]:
+                ranks = set(place(h, count) for h in KEY_HASHES)
+                self.assertEqual(ranks, set(range(count)))
+
+    def test_even_spread(self):
+        for place in placement.PLACEMENTS.values():
+            counts = [0] * 10
+            for h in KEY_HASHES:
+                counts[place(h, 10)] += 1
+            self.assertTrue(max(counts) < 1.3 * min(counts), counts)
+
+    def test_modulo_moves_most_keys(self):
+        moved = self.moved(placement.modulo, 9, 10)
+        self.assertTrue(len(moved) > 0.8 * len(KEY_HASHES))
+
+    def test_adding_a_node_moves_keys_to_it(self):
+        for place in [placement.jump, placement.rendezvous]:
+            moved = self.moved(place, 9, 10)
+            self.assertTrue(len(moved) < 0.13 * len(KEY_HASHES), len(moved))
+            for h in moved:
+                self.assertEqual(place(h, 10), 9)
+
+    def test_removing_a_node_moves_only_its_keys(self):
+        # Rendezvous scores do not depend on the other ranks
+        for h in KEY_HASHES:
+            if placement.rendezvous(h, 10) != 9:
+                self.assertEqual(placement.rendezvous(h, 9),
+                        placement.rendezvous(h, 10))
+
+    def test_node_uses_placement(self):
+        node_core = node.NodeCore(4, 1, "localhost", placement=placement.jump)
+        for h in KEY_HASHES[:100]:
+            self.assertEqual(node_core.responsible_for_hash(h),
+                    placement.jump(h, 4) == 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
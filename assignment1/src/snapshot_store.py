@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import array
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+# ----------------------------------------------------------
+# Point-in-time snapshots of a node's store
+#
+# A snapshot file holds every key and value of a store, followed by an
+# open-addressing hash table of the records:
+#
+#   [header][records ...][key crc32 x slots][record offset+1 x slots]
+#
+# Because the table is in the file, a restarted node can mmap the snapshot
+# and look keys up in it straight away, without reading it first. The keys
+# are then copied into the node's writable store in the background; once
+# that is done the snapshot is closed.
+#
+# Records and table use native byte order and 32 bit offsets, so a snapshot
+# is read on the host that wrote it and is limited to 4 gigabytes.
+#
+
+HEADER = struct.Struct("=8sIII")        # magic, record count, table slots, table offset
+RECORD = struct.Struct("=II")           # key length, value length
+MAGIC = "NODESNAP"
+
+LOAD_CHUNK = 10000                      # Records copied per lock acquisition while loading
+
+
+def key_crc(key):
+    return zlib.crc32(key) & 0xffffffff
+
+
+def table_slots(count):
+    slots = 16
+    while slots < count * 2:
+        slots *= 2
+    return slots
+
+
+# Write (key, value) pairs to a snapshot file. Returns the number written.
+#
+# The file is written under a temporary name and renamed, so an existing
+# snapshot is only replaced by a complete one.
+def write_snapshot(path, pairs):
+    pairs = list(pairs)
+    slots = table_slots(len(pairs))
+    crcs = array.array('I', [0]) * slots
+    offsets = array.array('I', [0]) * slots
+    mask = slots - 1
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0))
+        offset = HEADER.size
+        for (key, value) in pairs:
+            crc = key_crc(key)
+            slot = crc & mask
+            while offsets[slot] != 0:
+                slot = (slot + 1) & mask
+            crcs[slot] = crc
+            offsets[slot] = offset + 1
+
+            f.write(RECORD.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+            offset += RECORD.size + len(key) + len(value)
+
+        f.write(crcs.tostring())
+        f.write(offsets.tostring())
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(pairs), slots, offset))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(tmp, path)
+    return len(pairs)
+
+
+# Read-only, memory-mapped view of a snapshot file
+class SnapshotFile:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.count, self.slots, self.table_offset) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a snapshot file" % path)
+        self.mask = self.slots - 1
+        self.offsets_offset = self.table_offset + 4 * self.slots
+
+    def record_at(self, offset):
+        (key_length, value_length) = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        return (self.map[start:start+key_length],
+                self.map[start+key_length:start+key_length+value_length],
+                start + key_length + value_length)
+
+    def get(self, key, default=None):
+        crc = key_crc(key)
+        slot = crc & self.mask
+        while True:
+            (offset,) = struct.unpack_from("=I", self.map, self.offsets_offset + 4 * slot)
+            if offset == 0:
+                return default
+            (slot_crc,) = struct.unpack_from("=I", self.map, self.table_offset + 4 * slot)
+            if slot_crc == crc:
+                (record_key, value, end) = self.record_at(offset - 1)
+                if record_key == key:
+                    return value
+            slot = (slot + 1) & self.mask
+
+    # Yields (key, value, next offset) for records from offset on
+    def iteritems_from(self, offset):
+        while offset < self.table_offset:
+            (key, value, next_offset) = self.record_at(offset)
+            yield (key, value, next_offset)
+            offset = next_offset
+
+    def iteritems(self):
+        for (key, value, next_offset) in self.iteritems_from(HEADER.size):
+            yield (key, value)
+
+    # (key, key + value length) of every record, reading only the headers
+    # and keys
+    def entry_sizes(self):
+        (unpack, data, header_size) = (RECORD.unpack_from, self.map, RECORD.size)
+        (offset, end) = (HEADER.size, self.table_offset)
+        sizes = []
+        while offset < end:
+            (key_length, value_length) = unpack(data, offset)
+            offset += header_size
+            sizes.append((data[offset:offset+key_length], key_length + value_length))
+            offset += key_length + value_length
+        return sizes
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+# A store restored from a snapshot, usable before the restore finishes
+#
+# Writes go to the wrapped store. Reads look in the wrapped store first and
+# then in the mmapped snapshot, until the loader has copied the snapshot
+# into the wrapped store. Keys deleted before they were loaded are
+# remembered so the loader does not bring them back.
+class SnapshotStore:
+    def __init__(self, path, store):
+        self.store = store
+        self.snapshot = SnapshotFile(path)
+        self.position = HEADER.size     # Next snapshot record to load
+        self.deleted = set()
+        self.loaded = False
+        self.lock = threading.RLock()
+        self.loader = None
+
+    # Copy the next records into the store. Returns False when done.
+    def load_chunk(self, chunk=LOAD_CHUNK):
+        with self.lock:
+            if self.loaded:
+                return False
+            records = self.snapshot.iteritems_from(self.position)
+            for i in xrange(chunk):
+                try:
+                    (key, value, self.position) = records.next()
+                except StopIteration:
+                    self.loaded = True
+                    self.deleted = set()
+                    self.snapshot.close()
+                    self.snapshot = None
+                    return False
+                if key not in self.deleted and key not in self.store:
+                    self.store[key] = value
+            return True
+
+    def load(self):
+        while self.load_chunk():
+            pass
+
+    def start_loader(self):
+        self.loader = threading.Thread(name="snapshot loader", target=self.load)
+        self.loader.daemon = True
+        self.loader.start()
+
+    # ------------------------------------------------------
+    # Dict interface
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.store.get(key)
+            if value is not None or self.loaded or key in self.deleted:
+                return value if value is not None else default
+            return self.snapshot.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.store[key] = value
+
+    # Deadlines go to the wrapped store, if it keeps them
+    def put_expiring(self, key, value, deadline):
+        with self.lock:
+            if hasattr(self.store, "put_expiring"):
+                self.store.put_expiring(key, value, deadline)
+            else:
+                self.store[key] = value
+
+    def expiring(self):
+        with self.lock:
+            if hasattr(self.store, "expiring"):
+                return self.store.expiring()
+            return []
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            if key in self.store:
+                del self.store[key]
+            if not self.loaded:
+                self.deleted.add(key)
+
+    def pop(self, key, *default):
+        with self.lock:
+            value = self.get(key)
+            if value is None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            del self[key]
+            return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def update(self, pairs):
+        with self.lock:
+            self.store.update(pairs)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def items(self):
+        with self.lock:
+            items = dict(self.store.iteritems())
+            if not self.loaded:
+                for (key, value) in self.snapshot.iteritems():
+                    if key not in items and key not in self.deleted:
+                        items[key] = value
+            return items.items()
+
+    # (key, key + value length) of every entry. Values still in the snapshot
+    # are not read, so this is cheap enough to run before the restore is done.
+    def entry_sizes(self):
+        with self.lock:
+            if hasattr(self.store, "entry_sizes"):
+                sizes = list(self.store.entry_sizes())
+            else:
+                sizes = [(key, len(key) + len(value))
+                         for (key, value) in self.store.iteritems()]
+            if not self.loaded:
+                skip = self.deleted.union(key for (key, size) in sizes)
+                sizes.extend(entry for entry in self.snapshot.entry_sizes()
+                             if entry[0] not in skip)
+            return sizes
+
+    def keys(self):
+        return [key for (key, value) in self.items()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def __len__(self):
+        with self.lock:
+            if self.loaded:
+                return len(self.store)
+            return len(self.items())
+
+    def close(self):
+        with self.lock:
+            if self.snapshot is not None:
+                self.snapshot.close()
+                self.snapshot = None
+                self.loaded = True
+            if hasattr(self.store, "close"):
+                self.store.close()
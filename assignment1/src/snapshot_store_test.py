@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import arena_store
+import node
+import snapshot_store
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "node.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        pairs = [("/key%d" % i, "value %d" % i) for i in range(1000)]
+        self.assertEqual(snapshot_store.write_snapshot(self.path, pairs), 1000)
+
+        snapshot = snapshot_store.SnapshotFile(self.path)
+        self.assertEqual(snapshot.count, 1000)
+        for (key, value) in pairs:
+            self.assertEqual(snapshot.get(key), value)
+        self.assertEqual(snapshot.get("/missing"), None)
+        self.assertEqual(sorted(snapshot.iteritems()), sorted(pairs))
+        snapshot.close()
+
+    def test_empty(self):
+        snapshot_store.write_snapshot(self.path, [])
+        snapshot = snapshot_store.SnapshotFile(self.path)
+        self.assertEqual(snapshot.get("/a"), None)
+        self.assertEqual(list(snapshot.iteritems()), [])
+        snapshot.close()
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write("x" * 100)
+        self.assertRaises(ValueError, snapshot_store.SnapshotFile, self.path)
+
+    def test_serve_before_loaded(self):
+        snapshot_store.write_snapshot(self.path, [("/a", "1"), ("/b", "2"), ("/c", "3")])
+        store = snapshot_store.SnapshotStore(self.path, dict())
+
+        # Nothing loaded yet, reads come from the snapshot
+        self.assertEqual(store.store, {})
+        self.assertEqual(store.get("/a"), "1")
+
+        # Writes and deletes win over the snapshot, also after loading
+        store["/b"] = "new"
+        del store["/c"]
+        self.assertEqual(store.get("/b"), "new")
+        self.assertEqual(store.get("/c"), None)
+        self.assertEqual(len(store), 2)
+
+        store.load()
+        self.assertTrue(store.loaded)
+        self.assertEqual(store.store, {"/a": "1", "/b": "new"})
+        self.assertEqual(store.get("/c"), None)
+
+    def test_load_in_chunks(self):
+        pairs = [("/key%d" % i, "value %d" % i) for i in range(25)]
+        snapshot_store.write_snapshot(self.path, pairs)
+        store = snapshot_store.SnapshotStore(self.path, arena_store.ArenaStore())
+
+        self.assertTrue(store.load_chunk(10))
+        self.assertEqual(len(store.store), 10)
+        while store.load_chunk(10):
+            pass
+        self.assertEqual(dict(store.store.iteritems()), dict(pairs))
+
+    def test_entry_sizes_before_loaded(self):
+        snapshot_store.write_snapshot(self.path, [("/a", "1"), ("/b", "22"), ("/c", "333")])
+        store = snapshot_store.SnapshotStore(self.path, arena_store.ArenaStore())
+        store["/b"] = "new"
+        del store["/c"]
+
+        # Sizes come from the record headers, no value is read
+        def read_value(offset):
+            self.fail("value read at %d" % offset)
+        store.snapshot.record_at = read_value
+        self.assertEqual(sorted(store.entry_sizes()), [("/a", 3), ("/b", 5)])
+
+        node_core = node.NodeCore(1, 0, "NEXT", store)
+        self.assertEqual(node_core.policy.size, 8)
+
+    def test_node_snapshot_round_trip(self):
+        node_core = node.NodeCore(1, 0, "NEXT")
+        node_core.do_put("/a", "1")
+        node_core.do_put("/b", "2")
+        snapshot_store.write_snapshot(self.path, node_core.snapshot_items())
+
+        restored = node.NodeCore(1, 0, "NEXT",
+                snapshot_store.SnapshotStore(self.path, dict()))
+        self.assertEqual(restored.do_get("/a").value, "1")
+        self.assertEqual(restored.do_get("/b").value, "2")
+
+
+if __name__ == '__main__':
+    unittest.main()
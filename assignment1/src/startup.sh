@@ -24,6 +24,14 @@ fi
 directory=`pwd` #current working directory
 executable="node.py";
 
+# Key placement (modulo, jump or rendezvous). With jump or rendezvous, adding
+# nodes at the end of the list moves only the keys the new nodes take over.
+placement=${PLACEMENT:-modulo}
+
+# Copies of every key. With more than one, reads and writes wait for a
+# majority of them unless the request asks for another quorum.
+replicas=${REPLICAS:-1}
+
 #put the output into an array
 nodes_array=($nodes)
 
@@ -52,12 +60,12 @@ do
   fi
   
   #give the parameter to node.py
-  nohup ssh $current bash -c "'python -u $directory/$executable $node_count $rank $next_node'" 2>&1 | sed "s/^/$current: /" &
+  nohup ssh $current bash -c "'python -u $directory/$executable --placement $placement --replicas $replicas --nodes ${nodes// /,} $node_count $rank $next_node'" 2>&1 | sed "s/^/$current: /" &
 done
 
 # Run tests
 sleep 2
-#python storage_frontend.py --runtests $nodes
+#python storage_frontend.py --placement $placement --runtests $nodes
 
 # Wait/Run benchmarks
 HEALTY=1
@@ -2,6 +2,8 @@
 # vim: set sts=8 sw=8 noet:
 
 import BaseHTTPServer
+import Queue
+import SocketServer
 import sys
 import getopt
 import threading
@@ -12,12 +14,17 @@ import random
 import string
 import time
 
+import key_hash as khash
 import node_request
+import placement
+from node import node_hash
 
 MAX_CONTENT_LENGHT = 1024		# Maximum length of the content of the http request (1 kilobyte)
-MAX_STORAGE_SIZE = 104857600	# Maximum total storage allowed (100 megabytes)
+MAX_BATCH_CONTENT_LENGTH = 16777216	# Maximum length of a batch request (16 megabytes)
+KEEPALIVE_TIMEOUT = 60			# Seconds an idle keep-alive connection is kept open
 
 storageBackendNodes = list()
+keyPlacement = placement.modulo		# Must match the nodes' --placement
 httpdServeRequests = True
 
 node_httpserver_port = 8000
@@ -25,25 +32,118 @@ node_httpserver_port = 8000
 
 class StorageServerFrontend:
 	
-	def __init__(self):
-		self.size = 0
+	# Returns the node that owns a key hash, using the same placement as
+	# NodeCore.responsible_for_hash. The backend list must be given in rank
+	# order, which is the order startup.sh assigns ranks in.
+	def ownerNode(self, key_hash):
+		rank = keyPlacement(key_hash, len(storageBackendNodes))
+		return storageBackendNodes[rank]
 	
+	# Any node other than the owner. Every node forwards requests it is not
+	# responsible for, so this is the old (slower) path that still works when
+	# our list of nodes is stale.
+	def fallbackNode(self, owner):
+		others = [n for n in storageBackendNodes if n != owner]
+		if len(others) == 0:
+			return owner
+		return random.choice(others)
+	
+	# The key is hashed once here. The hash goes along with the request, so
+	# nodes that forward it do not hash the key again.
 	def sendGET(self, key):
-		node = random.choice(storageBackendNodes)
-		(status_code, content_type, data) = node_request.sendGET(
-				node, node_httpserver_port, key)
+		key_hash = node_hash(key)
+		owner = self.ownerNode(key_hash)
+		try:
+			(status_code, content_type, data) = node_request.sendGET(
+					owner, node_httpserver_port, key, key_hash)
+		except (socket.error, httplib.HTTPException):
+			(status_code, content_type, data) = node_request.sendGET(
+					self.fallbackNode(owner), node_httpserver_port, key, key_hash)
+		
+		if status_code != 200:
+			return None
 		return data
 		
-	def sendPUT(self, key, value, size):
-		self.size = self.size + size
-		node = random.choice(storageBackendNodes)
-		node_request.sendPUT(node, node_httpserver_port, key, value)
+	# Raises node_request.StorageFullError if the owner has no room
+	def sendPUT(self, key, value, ttl=None):
+		key_hash = node_hash(key)
+		owner = self.ownerNode(key_hash)
+		try:
+			node_request.sendPUT(owner, node_httpserver_port,
+					key, value, ttl, key_hash)
+		except node_request.StorageFullError:
+			raise
+		except (socket.error, httplib.HTTPException):
+			node_request.sendPUT(self.fallbackNode(owner),
+					node_httpserver_port, key, value, ttl, key_hash)
+	
+	# Splits items into one group per owning node. getKey gives the key of
+	# an item.
+	def groupByOwner(self, items, getKey):
+		groups = dict()
+		for item in items:
+			groups.setdefault(self.ownerNode(node_hash(getKey(item))), []).append(item)
+		return groups
+	
+	# Sends every group to its node in parallel with send(node, items).
+	# Returns a queue where each group's (items, result) arrives as soon as
+	# its node answers. A group whose owner can not be reached is sent to
+	# another node instead; if that fails too, the result is the exception.
+	def scatter(self, groups, send):
+		results = Queue.Queue()
+		
+		def worker(owner, items):
+			try:
+				try:
+					result = send(owner, items)
+				except node_request.StorageFullError:
+					raise
+				except (socket.error, httplib.HTTPException):
+					result = send(self.fallbackNode(owner), items)
+			except Exception as e:
+				result = e
+			results.put((items, result))
+		
+		for (owner, items) in groups.iteritems():
+			t = threading.Thread(target = worker, args = (owner, items))
+			t.daemon = True
+			t.start()
+		return results
+	
+	# Looks up many keys with one batch request per node. Yields a list of
+	# (key, value) pairs for each node as it answers; value is None for keys
+	# that were not found.
+	def sendMultiGET(self, keys):
+		groups = self.groupByOwner(keys, lambda key: key)
+		results = self.scatter(groups, lambda node, keys:
+				node_request.sendMultiGET(node, node_httpserver_port, keys))
+		
+		for i in range(len(groups)):
+			(keys, result) = results.get()
+			if isinstance(result, Exception):
+				raise result
+			yield result
+	
+	# Stores many key-value pairs with one batch request per node
+	def sendMultiPUT(self, pairs, ttl=None):
+		groups = self.groupByOwner(pairs, lambda pair: pair[0])
+		results = self.scatter(groups, lambda node, pairs:
+				node_request.sendMultiPUT(node, node_httpserver_port, pairs, ttl))
+		
+		for i in range(len(groups)):
+			(pairs, result) = results.get()
+			if isinstance(result, Exception):
+				raise result
 
 
 class FrontendHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 	global frontend 
 	frontend = StorageServerFrontend()
 	
+	# Keep client connections open between requests
+	protocol_version = "HTTP/1.1"
+	timeout = KEEPALIVE_TIMEOUT
+	
 	# Returns the 
 	def do_GET(self):
 		key = self.path
@@ -56,6 +156,7 @@ class FrontendHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 		# Write header
 		self.send_response(200)
 		self.send_header("Content-type", "application/octet-stream")
+		self.send_header("Content-Length", str(len(value)))
 		self.end_headers()
 		
 		# Write Body
@@ -64,29 +165,122 @@ class FrontendHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 	def do_PUT(self):
 		contentLength = int(self.headers['Content-Length'])
 		
+		# The body is left unread, so the connection can not be reused
 		if contentLength <= 0 or contentLength > MAX_CONTENT_LENGHT:
+			self.close_connection = 1
 			self.sendErrorResponse(400, "Content body to large")
 			return
 		
-		frontend.size += contentLength
-		if frontend.size > MAX_STORAGE_SIZE:
+		value = self.rfile.read(contentLength)
+		try:
+			ttl = node_request.parse_ttl(self.headers)
+		except ValueError as e:
+			self.sendErrorResponse(400, str(e))
+			return
+		
+		# Forward the request to the backend servers. Each node enforces
+		# its own storage budget.
+		try:
+			frontend.sendPUT(self.path, value, ttl)
+		except node_request.StorageFullError:
 			self.sendErrorResponse(400, "Storage server(s) exhausted")
 			return
+		except (socket.error, httplib.HTTPException):
+			self.sendErrorResponse(502, "Storage node(s) unreachable")
+			return
 		
-		# Forward the request to the backend servers
-		frontend.sendPUT(self.path, self.rfile.read(contentLength), contentLength)
+		self.send_response(200)
+		self.send_header("Content-type", "text/html")
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+		
+	# Bulk operations, in the batch format of node_request.encode_batch
+	#
+	#   /batch/get   body is a batch of keys, responds with a batch of values
+	#   /batch/put   body is a batch of key-value pairs to store, with the
+	#                time to live in the TTL header if any
+	#
+	def do_POST(self):
+		contentLength = int(self.headers['Content-Length'])
+		
+		if contentLength < 0 or contentLength > MAX_BATCH_CONTENT_LENGTH:
+			self.close_connection = 1
+			self.sendErrorResponse(400, "Content body to large")
+			return
+		
+		try:
+			pairs = node_request.decode_batch(self.rfile.read(contentLength))
+		except ValueError as e:
+			self.sendErrorResponse(400, str(e))
+			return
+		
+		if self.path == "/batch/get":
+			self.bulkGET([key for (key, value) in pairs])
+		elif self.path == "/batch/put":
+			self.bulkPUT(pairs)
+		else:
+			self.sendErrorResponse(404, "Unknown batch operation")
+	
+	# Streams the values back with chunked encoding, one chunk per node, as
+	# the nodes answer.
+	def bulkGET(self, keys):
+		self.send_response(200)
+		self.send_header("Content-type", "application/octet-stream")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+		
+		try:
+			for values in frontend.sendMultiGET(keys):
+				self.writeChunk(node_request.encode_batch(values))
+		except Exception:
+			# Too late to send an error status, and an error page would
+			# land in the middle of the body. Closing the connection
+			# without the last chunk tells the client the batch is incomplete.
+			self.close_connection = 1
+			return
+		
+		self.writeChunk("")
+	
+	def bulkPUT(self, pairs):
+		for (key, value) in pairs:
+			if not value or len(value) > MAX_CONTENT_LENGHT:
+				self.sendErrorResponse(400, "Bad value for key " + key)
+				return
+		
+		try:
+			ttl = node_request.parse_ttl(self.headers)
+		except ValueError as e:
+			self.sendErrorResponse(400, str(e))
+			return
+		
+		try:
+			frontend.sendMultiPUT(pairs, ttl)
+		except node_request.StorageFullError:
+			self.sendErrorResponse(400, "Storage server(s) exhausted")
+			return
+		except (socket.error, httplib.HTTPException):
+			self.sendErrorResponse(502, "Storage node(s) unreachable")
+			return
 		
 		self.send_response(200)
 		self.send_header("Content-type", "text/html")
+		self.send_header("Content-Length", "0")
 		self.end_headers()
+	
+	def writeChunk(self, data):
+		self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
 		
 	def sendErrorResponse(self, code, msg):
 		self.send_response(code)
 		self.send_header("Content-type", "text/html")
+		self.send_header("Content-Length", str(len(msg)))
 		self.end_headers()
 		self.wfile.write(msg)
 		
-class FrontendHTTPServer(BaseHTTPServer.HTTPServer):
+# Each keep-alive client connection is served by its own thread
+class FrontendHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	
+	daemon_threads = True
 	
 	def server_bind(self):
 		BaseHTTPServer.HTTPServer.server_bind(self)
@@ -195,19 +389,25 @@ class StorageServerTest:
 if __name__ == '__main__':
 
 	# time the function for the evaluation
-	time_start = time.time()
+	start_time = time.time()
 
 	run_tests = False
 	httpserver_port = 8000
+	hash_name = khash.name
+	key_bits = khash.bits
+	usage = (sys.argv[0] + ' [--port portnumber(default=8000)] [--runtests]'
+		+ ' [--placement modulo(default)|jump|rendezvous]'
+		+ ' [--hash %s(default=md5)] [--key-bits bits(default=128)]' % '|'.join(sorted(khash.FUNCTIONS))
+		+ ' compute-1-1 compute-1-1 ... compute-N-M')
 	
 	try:
-		optlist, args = getopt.getopt(sys.argv[1:], 'x', ['runtests', 'port='])
+		optlist, args = getopt.getopt(sys.argv[1:], 'x', ['runtests', 'port=', 'placement=', 'hash=', 'key-bits='])
 	except getopt.GetoptError:
-		print sys.argv[0] + ' [--port portnumber(default=8000)] [--runtests] compute-1-1 compute-1-1 ... compute-N-M'
+		print usage
 		sys.exit(2)
 	
 	if len(args) <= 0:
-		print sys.argv[0] + ' [--port portnumber(default=8000)] [--runtests] compute-1-1 compute-1-1 ... compute-N-M'
+		print usage
 		sys.exit(2)
 	
 	for opt, arg in optlist:
@@ -215,6 +415,22 @@ if __name__ == '__main__':
 			run_tests = True
 		elif opt in ("-port", "--port"):
 			httpserver_port = int(arg)
+		elif opt == "--placement":
+			if arg not in placement.PLACEMENTS:
+				print usage
+				sys.exit(2)
+			keyPlacement = placement.PLACEMENTS[arg]
+		elif opt == "--hash":
+			hash_name = arg
+		elif opt == "--key-bits":
+			key_bits = int(arg)
+	
+	# Must match the nodes, or keys are sent to the wrong owners
+	try:
+		khash.configure(hash_name, key_bits)
+	except ValueError, e:
+		print e
+		sys.exit(2)
 			
 	# Nodelist
 	for node in args:
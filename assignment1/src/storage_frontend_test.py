@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import StringIO
+import httplib
+import socket
+import threading
+import unittest
+
+import node
+import node_request
+import placement
+import storage_frontend
+
+
+NODES = ["node%d" % i for i in range(5)]
+KEY_HASHES = [node.node_hash("/key-%d" % i) for i in range(2000)]
+
+class TestOwnerSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (storage_frontend.storageBackendNodes, storage_frontend.keyPlacement)
+        storage_frontend.storageBackendNodes = list(NODES)
+        self.frontend = storage_frontend.StorageServerFrontend()
+
+    def tearDown(self):
+        (storage_frontend.storageBackendNodes, storage_frontend.keyPlacement) = self.saved
+
+    def test_owner_is_responsible_node(self):
+        for (name, place) in placement.PLACEMENTS.items():
+            storage_frontend.keyPlacement = place
+            cores = [node.NodeCore(len(NODES), rank, None, placement=place)
+                     for rank in range(len(NODES))]
+            for key_hash in KEY_HASHES:
+                rank = NODES.index(self.frontend.ownerNode(key_hash))
+                responsible = [c.rank for c in cores if c.responsible_for_hash(key_hash)]
+                self.assertEqual(responsible, [rank], name)
+
+    def test_fallback_is_not_owner(self):
+        for owner in NODES:
+            fallbacks = set(self.frontend.fallbackNode(owner) for i in range(200))
+            self.assertEqual(owner in fallbacks, False)
+            self.assertEqual(fallbacks, set(NODES) - set([owner]))
+
+    def test_fallback_single_node(self):
+        storage_frontend.storageBackendNodes = ["only"]
+        self.assertEqual(self.frontend.fallbackNode("only"), "only")
+
+
+# Answers batches like a node would: the value of a key is its name
+# reversed. Calls to the nodes in 'down' fail.
+class StubNodes:
+
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def send(self, host, items):
+        with self.lock:
+            self.calls.append((host, items))
+        if host in self.down:
+            raise socket.error("%s is down" % host)
+        return [(key, key[::-1]) for key in items]
+
+class TestScatterGather(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (storage_frontend.storageBackendNodes, storage_frontend.keyPlacement,
+                node_request.sendMultiGET, node_request.sendMultiPUT)
+        storage_frontend.storageBackendNodes = list(NODES)
+        storage_frontend.keyPlacement = placement.modulo
+        self.frontend = storage_frontend.StorageServerFrontend()
+        self.keys = ["/key-%d" % i for i in range(100)]
+
+    def tearDown(self):
+        (storage_frontend.storageBackendNodes, storage_frontend.keyPlacement,
+                node_request.sendMultiGET, node_request.sendMultiPUT) = self.saved
+
+    def gather(self, results, count):
+        pairs = [results.get(timeout=5) for i in range(count)]
+        return dict((tuple(items), result) for (items, result) in pairs)
+
+    def test_group_by_owner(self):
+        groups = self.frontend.groupByOwner(self.keys, lambda key: key)
+        self.assertEqual(sorted(k for keys in groups.values() for k in keys), sorted(self.keys))
+        for (owner, keys) in groups.items():
+            for key in keys:
+                self.assertEqual(self.frontend.ownerNode(node.node_hash(key)), owner)
+
+    def test_scatter_falls_back(self):
+        groups = self.frontend.groupByOwner(self.keys, lambda key: key)
+        nodes = StubNodes(down=[NODES[0]])
+        results = self.gather(self.frontend.scatter(groups, nodes.send), len(groups))
+        for (owner, keys) in groups.items():
+            self.assertEqual(results[tuple(keys)], [(key, key[::-1]) for key in keys])
+        # The group of the node that is down went to another one, once
+        retried = [host for (host, items) in nodes.calls if items == groups[NODES[0]]]
+        self.assertEqual(len(retried), 2)
+        self.assertEqual(retried[0], NODES[0])
+        self.assertNotEqual(retried[1], NODES[0])
+
+    def test_scatter_gives_up(self):
+        groups = {NODES[0]: ["/a"]}
+        nodes = StubNodes(down=NODES)
+        results = self.gather(self.frontend.scatter(groups, nodes.send), 1)
+        self.assertEqual(isinstance(results[("/a",)], socket.error), True)
+        self.assertEqual(len(nodes.calls), 2)
+
+    def test_storage_full_not_retried(self):
+        def send(host, items):
+            raise node_request.StorageFullError("full")
+        results = self.gather(self.frontend.scatter({NODES[0]: ["/a"]}, send), 1)
+        self.assertEqual(isinstance(results[("/a",)], node_request.StorageFullError), True)
+
+    def test_multi_get_merges(self):
+        nodes = StubNodes(down=[NODES[1]])
+        node_request.sendMultiGET = lambda host, port, keys: nodes.send(host, keys)
+        batches = list(self.frontend.sendMultiGET(self.keys))
+        self.assertEqual(len(batches), len(NODES))
+        merged = dict(pair for batch in batches for pair in batch)
+        self.assertEqual(merged, dict((key, key[::-1]) for key in self.keys))
+
+    def test_multi_get_raises(self):
+        nodes = StubNodes(down=NODES)
+        node_request.sendMultiGET = lambda host, port, keys: nodes.send(host, keys)
+        self.assertRaises(socket.error, list, self.frontend.sendMultiGET(self.keys))
+
+    def test_multi_put(self):
+        stored = dict()
+        def send(host, port, pairs, ttl):
+            self.assertEqual(ttl, 30)
+            for (key, value) in pairs:
+                self.assertEqual(self.frontend.ownerNode(node.node_hash(key)), host)
+                stored[key] = value
+        node_request.sendMultiPUT = send
+        self.frontend.sendMultiPUT([(key, "v") for key in self.keys], 30)
+        self.assertEqual(stored, dict((key, "v") for key in self.keys))
+
+        node_request.sendMultiPUT = lambda host, port, pairs, ttl: StubNodes(NODES).send(host, pairs)
+        self.assertRaises(socket.error, self.frontend.sendMultiPUT, [("/a", "v")])
+
+
+# Yields the batches, then raises error if given
+class StubFrontend:
+
+    def __init__(self, batches, error=None):
+        self.batches = batches
+        self.error = error
+
+    def sendMultiGET(self, keys):
+        for batch in self.batches:
+            yield batch
+        if self.error is not None:
+            raise self.error
+
+# A handler writing its response to a string, without a connection
+class OfflineHandler(storage_frontend.FrontendHttpHandler):
+
+    def __init__(self):
+        self.wfile = StringIO.StringIO()
+        (self.request_version, self.command, self.requestline) = (
+                "HTTP/1.1", "POST", "POST /batch/get HTTP/1.1")
+        self.client_address = ("127.0.0.1", 0)
+        self.close_connection = 0
+
+    def log_message(self, format, *args):
+        pass
+
+class TestBulkGET(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = storage_frontend.frontend
+
+    def tearDown(self):
+        storage_frontend.frontend = self.saved
+
+    def test_chunk_per_node(self):
+        storage_frontend.frontend = StubFrontend([[("/a", "1")], [("/b", None)]])
+        h = OfflineHandler()
+        h.bulkGET(["/a", "/b"])
+        body = h.wfile.getvalue().split("\r\n\r\n", 1)[1]
+        first = node_request.encode_batch([("/a", "1")])
+        second = node_request.encode_batch([("/b", None)])
+        self.assertEqual(body, "%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n"
+                % (len(first), first, len(second), second))
+        self.assertEqual(h.close_connection, 0)
+
+    def test_cut_off_on_error(self):
+        for error in [socket.error("down"), httplib.HTTPException("bad"), KeyError("/b")]:
+            storage_frontend.frontend = StubFrontend([[("/a", "1")]], error)
+            h = OfflineHandler()
+            h.bulkGET(["/a", "/b"])
+            body = h.wfile.getvalue().split("\r\n\r\n", 1)[1]
+            first = node_request.encode_batch([("/a", "1")])
+            # The first chunk, and no last chunk or error page after it
+            self.assertEqual(body, "%x\r\n%s\r\n" % (len(first), first))
+            self.assertEqual(h.close_connection, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import math
+
+
+# ----------------------------------------------------------
+# Hierarchical timer wheel
+#
+# Keeps deadlines for a large number of keys, so that the keys that expired
+# can be found without looking at the ones that did not. Scheduling and
+# cancelling a timer are O(1), and every timer is moved at most once per
+# level before it fires.
+#
+# Time is divided into ticks. Level 0 has one slot per tick for the next
+# `slots` ticks, level 1 one slot per `slots` ticks for the next slots**2
+# ticks, and so on. When the lower levels have gone all the way round, the
+# next slot of the level above is emptied into them (cascaded). Deadlines
+# beyond the range of the top level wait in its furthest slot and are
+# placed again when that slot cascades.
+#
+
+class TimerWheel:
+
+    def __init__(self, now, tick=1.0, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = self.tick_of(now)    # Last tick that has been processed
+
+        # Every slot maps key -> deadline tick
+        self.wheels = [[dict() for i in range(slots)] for level in range(levels)]
+        self.timers = dict()                # key -> slot the key is in
+
+    def tick_of(self, time):
+        return long(math.floor(time / self.tick))
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    # Fire key at time deadline, replacing an earlier timer for the key.
+    # Deadlines in the past fire on the next advance.
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        self.place(key, max(long(math.ceil(deadline / self.tick)), self.current + 1))
+
+    def cancel(self, key):
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def place(self, key, deadline):
+        delta = deadline - self.current
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots or level == self.levels - 1:
+                break
+            span *= self.slots
+
+        # Too far out, wait in the furthest slot of the top level
+        position = min(deadline, self.current + span * self.slots - 1)
+
+        slot = self.wheels[level][(position // span) % self.slots]
+        slot[key] = deadline
+        self.timers[key] = slot
+
+    # Process all ticks up to time now. Returns the keys whose deadline has
+    # passed; their timers are gone.
+    def advance(self, now):
+        target = self.tick_of(now)
+        expired = list()
+
+        while self.current < target:
+            # Nothing to wait for, skip ahead
+            if len(self.timers) == 0:
+                self.current = target
+                break
+
+            self.current += 1
+            self.cascade()
+
+            slot = self.wheels[0][self.current % self.slots]
+            for key in slot:
+                del self.timers[key]
+            expired.extend(slot.keys())
+            slot.clear()
+
+        return expired
+
+    # Move the timers of the slots that have come up in the upper levels
+    # down, top level first so they can go down more than one level.
+    def cascade(self):
+        spans = [self.slots ** level for level in range(self.levels)]
+        for level in range(self.levels - 1, 0, -1):
+            if self.current % spans[level] != 0:
+                continue
+            slot = self.wheels[level][(self.current // spans[level]) % self.slots]
+            timers = slot.items()
+            slot.clear()
+            for (key, deadline) in timers:
+                self.place(key, deadline)
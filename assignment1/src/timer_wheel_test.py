@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import random
+import unittest
+
+import timer_wheel
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_fires_at_deadline(self):
+        wheel = timer_wheel.TimerWheel(0)
+        wheel.schedule("/a", 5)
+        wheel.schedule("/b", 3.5)
+        self.assertEqual(wheel.advance(3), [])
+        self.assertEqual(wheel.advance(4), ["/b"])
+        self.assertEqual(wheel.advance(4.9), [])
+        self.assertEqual(wheel.advance(5), ["/a"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_past_deadline_fires_next(self):
+        wheel = timer_wheel.TimerWheel(100)
+        wheel.schedule("/a", 50)
+        self.assertEqual(wheel.advance(101), ["/a"])
+
+    def test_cancel_and_reschedule(self):
+        wheel = timer_wheel.TimerWheel(0)
+        wheel.schedule("/a", 10)
+        wheel.schedule("/b", 10)
+        wheel.cancel("/b")
+        wheel.cancel("/missing")
+        wheel.schedule("/a", 5000)
+        self.assertEqual(wheel.advance(4999), [])
+        self.assertTrue("/a" in wheel)
+        self.assertEqual(wheel.advance(5000), ["/a"])
+
+    def test_beyond_top_level(self):
+        wheel = timer_wheel.TimerWheel(0, slots=4, levels=2)
+        wheel.schedule("/a", 100)
+        self.assertEqual(wheel.advance(99), [])
+        self.assertEqual(wheel.advance(100), ["/a"])
+
+    def test_matches_brute_force(self):
+        rand = random.Random(7)
+        wheel = timer_wheel.TimerWheel(0, tick=0.5, slots=8, levels=3)
+        deadlines = dict()
+        now = 0
+        for step in range(2000):
+            key = "/key%d" % rand.randint(0, 200)
+            if rand.random() < 0.2:
+                wheel.cancel(key)
+                deadlines.pop(key, None)
+            else:
+                deadline = now + rand.uniform(0, 400)
+                wheel.schedule(key, deadline)
+                deadlines[key] = deadline
+
+            now += rand.uniform(0, 3)
+            expired = wheel.advance(now)
+            due = [k for (k, d) in deadlines.items() if d <= now - 0.5]
+            for k in expired:
+                self.assertTrue(deadlines.pop(k) <= now)
+            for k in due:
+                self.assertFalse(k in deadlines)
+        self.assertEqual(len(wheel), len(deadlines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import struct
+
+
+# ----------------------------------------------------------
+# Reed-Solomon erasure coding over GF(256)
+#
+# A value is cut into k data fragments and m parity fragments of the same
+# size, such that any k of them give the value back. Stored on k + m nodes,
+# that takes (k + m) / k times the space of the value, and survives m nodes
+# going down, where keeping m + 1 copies takes m + 1 times the space.
+#
+# The data fragments are the value itself, after its length, padded to a
+# multiple of k. Parity fragment j is the sum over i of C[j][i] * data[i],
+# with C a Cauchy matrix: every square matrix made of rows of C and of the
+# identity is invertible, so any k fragments can be solved for the data.
+#
+# Bytes are elements of GF(2**8) with the polynomial x^8 + x^4 + x^3 + x^2 + 1.
+# Adding is XOR. Multiplying a fragment by a constant is one str.translate
+# with the constant's row of the multiplication table, and adding fragments
+# is one XOR of long integers, so the loops over the bytes run in C.
+#
+
+MAX_FRAGMENTS = 256
+LENGTH = struct.Struct(">I")
+
+EXP = [0] * 512
+LOG = [0] * 256
+x = 1
+for i in range(255):
+    EXP[i] = x
+    LOG[x] = i
+    x <<= 1
+    if x & 0x100:
+        x ^= 0x11d
+for i in range(255, 512):
+    EXP[i] = EXP[i - 255]
+del x, i
+
+def mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+def inverse(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+# Rows of the multiplication table, as translation tables
+mul_tables = dict()
+
+def mul_table(c):
+    table = mul_tables.get(c)
+    if table is None:
+        table = "".join(chr(mul(c, b)) for b in range(256))
+        mul_tables[c] = table
+    return table
+
+def combine(coefficients, fragments, size):
+    """ The sum of the fragments times the coefficients """
+    total = 0L
+    for (c, fragment) in zip(coefficients, fragments):
+        if c != 0:
+            total ^= long(fragment.translate(mul_table(c)).encode("hex"), 16)
+    return ("%0*x" % (2 * size, total)).decode("hex")
+
+
+def check(k, m):
+    """ Raises ValueError if k data and m parity fragments can not be made """
+    if k < 1 or m < 0 or k + m > MAX_FRAGMENTS:
+        raise ValueError("Can not make %d data and %d parity fragments" % (k, m))
+
+def row(index, k):
+    """ The coefficients of fragment 'index' in terms of the data fragments """
+    if index < k:
+        return [1 if i == index else 0 for i in range(k)]
+    return [inverse(index ^ i) for i in range(k)]
+
+def invert(matrix):
+    """ The inverse of a square matrix over GF(256), by Gauss-Jordan
+    elimination. Raises ValueError if it is singular. """
+    n = len(matrix)
+    rows = [list(r) + [1 if i == j else 0 for j in range(n)]
+            for (i, r) in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col] != 0), None)
+        if pivot is None:
+            raise ValueError("Singular matrix")
+        (rows[col], rows[pivot]) = (rows[pivot], rows[col])
+        scale = inverse(rows[col][col])
+        rows[col] = [mul(scale, v) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor != 0:
+                rows[r] = [v ^ mul(factor, p) for (v, p) in zip(rows[r], rows[col])]
+    return [r[n:] for r in rows]
+
+
+def fragment_size(length, k):
+    """ The size of each fragment of a value of 'length' bytes """
+    return -(-(LENGTH.size + length) // k)
+
+def encode(value, k, m):
+    """ The k data and m parity fragments of value, in that order """
+    check(k, m)
+    size = fragment_size(len(value), k)
+    data = LENGTH.pack(len(value)) + value
+    data += "\0" * (size * k - len(data))
+    fragments = [data[i * size:(i + 1) * size] for i in range(k)]
+    for j in range(k, k + m):
+        fragments.append(combine(row(j, k), fragments[:k], size))
+    return fragments
+
+def decode(fragments, k, m):
+    """ The value back from a dict of fragment index -> fragment. Raises
+    ValueError if there are fewer than k of them, or they do not fit. """
+    check(k, m)
+    indexes = sorted(i for i in fragments if 0 <= i < k + m)[:k]
+    if len(indexes) < k:
+        raise ValueError("%d of the %d fragments needed" % (len(indexes), k))
+    size = len(fragments[indexes[0]])
+    if size < 1 or any(len(fragments[i]) != size for i in indexes):
+        raise ValueError("Fragments of different sizes")
+
+    # Solve for the data fragments that are missing
+    solution = invert([row(i, k) for i in indexes])
+    given = [fragments[i] for i in indexes]
+    data = "".join(fragments[i] if i in fragments else combine(solution[i], given, size)
+            for i in range(k))
+
+    (length,) = LENGTH.unpack_from(data)
+    if LENGTH.size + length > len(data):
+        raise ValueError("Fragments do not fit together")
+    return data[LENGTH.size:LENGTH.size + length]
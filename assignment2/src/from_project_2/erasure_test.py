@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import itertools
+import unittest
+
+import erasure
+
+
+class TestErasure(unittest.TestCase):
+
+    def test_field(self):
+        for a in range(1, 256):
+            self.assertEqual(erasure.mul(a, erasure.inverse(a)), 1)
+            self.assertEqual(erasure.mul(a, 0), 0)
+        self.assertEqual(erasure.mul(2, 0x80), 0x1d)
+
+    def test_data_fragments_are_the_value(self):
+        fragments = erasure.encode("hello world!", 4, 2)
+        self.assertEqual(len(fragments), 6)
+        self.assertEqual(set(len(f) for f in fragments), set([4]))
+        self.assertEqual("".join(fragments[:4])[4:16], "hello world!")
+
+    def test_any_k_fragments(self):
+        value = "".join(chr(i % 251) for i in range(1000))
+        for (k, m) in [(1, 0), (1, 2), (4, 2), (5, 3)]:
+            fragments = erasure.encode(value, k, m)
+            for indexes in itertools.combinations(range(k + m), k):
+                some = dict((i, fragments[i]) for i in indexes)
+                self.assertEqual(erasure.decode(some, k, m), value)
+
+    def test_empty_value(self):
+        fragments = erasure.encode("", 3, 2)
+        self.assertEqual(erasure.decode({3: fragments[3], 4: fragments[4], 0: fragments[0]}, 3, 2), "")
+
+    def test_too_few_fragments(self):
+        fragments = erasure.encode("value", 4, 2)
+        some = dict((i, fragments[i]) for i in [0, 2, 5])
+        self.assertRaises(ValueError, erasure.decode, some, 4, 2)
+        self.assertRaises(ValueError, erasure.encode, "value", 0, 2)
+        self.assertRaises(ValueError, erasure.encode, "value", 200, 57)
+
+
+if __name__ == '__main__':
+    unittest.main()
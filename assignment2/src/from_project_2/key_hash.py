@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import hashlib
+import struct
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# ----------------------------------------------------------
+# Hash functions that map keys and node addresses to the key space
+#
+# The key space is [0, 2**bits). A hash is cut down to that width by taking
+# its top bits. Up to 63 bits the hashes are plain Python ints; wider key
+# spaces make every ring comparison long (bignum) arithmetic.
+#
+# Every node and frontend of a cluster must use the same function and
+# width. They are set once at startup with configure(), and everything that
+# hashes keys goes through hash_key() or reads bits and space from here.
+#
+# This file is copied into assignment1/src, assignment2/src and
+# assignment2/src/from_project_2, which run on their own. The copies must
+# stay identical; key_hash_test.py checks that they are.
+#
+
+TOP64 = struct.Struct(">Q")
+
+def fnv1a_64(s):
+    """ 64 bit FNV-1a, a simple non-cryptographic hash """
+    h = 0xcbf29ce484222325
+    for c in s:
+        h = ((h ^ ord(c)) * 0x100000001b3) & 0xffffffffffffffff
+    return h
+
+
+def digest_hash(new, digest_bits, bits):
+    """ A hash function that takes the top bits of a hashlib style digest """
+    if bits <= 64:
+        shift = 64 - bits
+        unpack = TOP64.unpack_from
+        return lambda s: unpack(new(s).digest())[0] >> shift
+    else:
+        shift = digest_bits - bits
+        return lambda s: long(new(s).hexdigest(), 16) >> shift
+
+
+def int_hash(function, function_bits, bits):
+    """ A hash function that takes the top bits of an integer hash """
+    shift = function_bits - bits
+    return lambda s: function(s) >> shift
+
+
+# name -> (bits of the hash, function(bits) that makes the hash function)
+FUNCTIONS = {
+    "md5": (128, lambda bits: digest_hash(hashlib.md5, 128, bits)),
+    "sha1": (160, lambda bits: digest_hash(hashlib.sha1, 160, bits)),
+    "fnv1a": (64, lambda bits: int_hash(fnv1a_64, 64, bits)),
+}
+
+if blake2b is not None:
+    FUNCTIONS["blake2b"] = (512, lambda bits: digest_hash(blake2b, 512, bits))
+
+if xxhash is not None:
+    FUNCTIONS["xxh64"] = (64, lambda bits: int_hash(
+            lambda s: xxhash.xxh64(s).intdigest(), 64, bits))
+
+
+def make_hash(name, bits):
+    """ The hash function called name, for a key space of the given width """
+    if name not in FUNCTIONS:
+        raise ValueError("Unknown hash function '%s', choose from %s"
+                % (name, ", ".join(sorted(FUNCTIONS))))
+    (function_bits, make) = FUNCTIONS[name]
+    if not 1 <= bits <= function_bits:
+        raise ValueError("%s has %d bits, can not make a %d bit key space"
+                % (name, function_bits, bits))
+    return make(bits)
+
+
+# The current configuration
+name = "md5"
+bits = 128
+space = 2 ** bits
+hash_key = make_hash(name, bits)
+
+def configure(hash_name="md5", key_bits=128):
+    """ Set the hash function and key space width for this process """
+    global name, bits, space, hash_key
+    hash_key = make_hash(hash_name, key_bits)
+    (name, bits, space) = (hash_name, key_bits, 2 ** key_bits)
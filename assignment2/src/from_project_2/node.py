@@ -2,30 +2,59 @@
 # vim: set sts=4 sw=4 et:
 
 import BaseHTTPServer
+import Queue
 import SocketServer
+import bisect
+import collections
+import hashlib
 import time
 import threading
 import signal
+import socket
 import sys
 import os
+import tempfile
 import getopt
-import hashlib
+import httplib
 from pprint import pformat
 
+import erasure
+import key_hash as khash
 import node_request
 
 MAX_CONTENT_LENGHT = 1024		# Maximum length of the content of the http request (1 kilobyte)
 MAX_STORAGE_SIZE = 104857600	# Maximum total storage allowed (100 megabytes)
 
+FINGER_REFRESH_INTERVAL = 5     # Seconds between finger table refreshes
+MAX_ROUTES = 1024               # Key ranges kept in the route cache
+MIGRATION_BATCH_SIZE = 262144   # Bytes of keys and values per migration batch
+JOIN_RETRY_INTERVAL = 1         # Seconds between joins while the ring is busy
+LEAVE_BATCH_SIZE = 4194304      # Bytes of keys and values per batch when leaving
+LEAVE_TIMEOUT = 30              # Seconds to hand over all keys when leaving
+REPLICA_TIMEOUT = 5             # Seconds to wait for a node to store a copy
+REPLICATION_QUEUE_SIZE = 10000  # Copies waiting to be sent, when asynchronous
+SYNC_INTERVAL = 10              # Seconds between comparisons of copies with the successor
+STALE_SYNCS = 3                 # Sync intervals without a comparison before copies are stale
+MERKLE_DEPTH = 12               # Levels of hash tree above the buckets of keys
+REPAIR_LEAVES = 256             # Buckets of keys per repair batch
+CONNECT_TIMEOUT = 2             # Seconds to connect to a node we forward a request to
+HINT_QUEUE_SIZE = 67108864      # Bytes of writes kept for unreachable nodes (64 megabytes)
+HINT_REPLAY_INTERVAL = 2        # Seconds between tries to replay them
+
 node_httpserver_port = 8000
 
+# Copies of keys waiting to be sent, when replicating asynchronously
+replication_queue = None
+
+# Writes waiting for nodes that could not be reached, see HintQueue
+hints = None
+
 # Hashing function to map string keys to an integer key space
+#
+# The function and the width of the key space are set with --hash and
+# --key-bits (see key_hash.py); the default is the full 128 bit MD5.
 def node_hash(s):
-    md5 = hashlib.md5()
-    md5.update(s)
-    hexhash = md5.hexdigest()
-    numerichash = long(hexhash,16)
-    return numerichash
+    return khash.hash_key(s)
 
 
 
@@ -50,6 +79,158 @@ class NodeDescriptor:
         return "%s:%s" % (self.ip, self.port)
 
 
+def in_range(key_hash, start, end):
+    """ Whether key_hash is in [start, end) on the ring. The range wraps
+    around if end <= start, and is the whole ring if they are equal. """
+    if start < end:
+        return start <= key_hash and key_hash < end
+    else:
+        return start <= key_hash or key_hash < end
+
+
+def digest(s):
+    return long(hashlib.md5(s).hexdigest(), 16)
+
+class MerkleTree:
+    """ Hash tree over a set of (key, value) pairs, to find the pairs two
+    nodes disagree on without sending them all
+
+    The key space is cut into 2**depth buckets by the top bits of the key
+    hash. A leaf holds the XOR of the digests of the pairs in its bucket,
+    so a write updates it without rehashing the bucket, and every node
+    above holds the digest of its two children (0 if both are empty). Those
+    are rehashed when they are read, once for all the writes since.
+    Node 1 is the root and the children of node i are 2i and 2i + 1, so
+    the leaves are first_leaf to 2 * first_leaf - 1.
+
+    Two trees hold the same pairs if their roots are equal. If not, only
+    the children that differ have to be compared, down to the leaves.
+    """
+
+    def __init__(self, depth=MERKLE_DEPTH):
+        self.first_leaf = 2 ** depth
+        self.hashes = [0L] * (2 * self.first_leaf)
+        self.buckets = dict()           # leaf -> {key: digest of the pair}
+        self.changed = set()            # Leaves changed since the last rehash
+
+    def leaf(self, key_hash):
+        return self.first_leaf + key_hash * self.first_leaf // khash.space
+
+    def put(self, key, value, key_hash=None):
+        if key_hash is None:
+            key_hash = node_hash(key)
+        leaf = self.leaf(key_hash)
+        bucket = self.buckets.setdefault(leaf, dict())
+        d = digest("%d %s%s" % (len(key), key, value))
+        if bucket.get(key) == d:
+            return
+        self.hashes[leaf] ^= bucket.get(key, 0L) ^ d
+        bucket[key] = d
+        self.changed.add(leaf)
+
+    def remove(self, key):
+        leaf = self.leaf(node_hash(key))
+        bucket = self.buckets.get(leaf)
+        if bucket is None or key not in bucket:
+            return
+        self.hashes[leaf] ^= bucket.pop(key)
+        if len(bucket) == 0:
+            del self.buckets[leaf]
+        self.changed.add(leaf)
+
+    def node_hashes(self, indexes):
+        """ The hashes of the nodes at indexes """
+        # Rehash the nodes above the changed leaves, a level at a time
+        level = self.changed
+        while level:
+            level = set(i // 2 for i in level if i > 1)
+            for i in level:
+                (left, right) = (self.hashes[2 * i], self.hashes[2 * i + 1])
+                if left == 0 and right == 0:
+                    self.hashes[i] = 0L
+                else:
+                    self.hashes[i] = digest("%032x%032x" % (left, right))
+        self.changed = set()
+        return [self.hashes[i] for i in indexes]
+
+    def keys(self, leaf):
+        """ The keys in the bucket of a leaf """
+        return self.buckets.get(leaf, {}).keys()
+
+    def is_leaf(self, i):
+        return i >= self.first_leaf
+
+    def check(self, i):
+        """ Raises ValueError if i is not a node of the tree """
+        if not 1 <= i < 2 * self.first_leaf:
+            raise ValueError("No tree node %d" % i)
+
+
+class RouteCache:
+    """ Bounded cache of key ranges and the nodes responsible for them
+
+    Filled from the ranges owners stamp on their responses, so that repeat
+    requests go to the owner in one hop. Entries are only hints: a node
+    that is no longer responsible forwards the request as usual, and the
+    range stamped on the answer replaces the stale entry.
+
+    Shared by the threads serving requests, so changes take the lock.
+    """
+
+    def __init__(self, max_size=MAX_ROUTES):
+        self.max_size = max_size
+        self.starts = []                            # Sorted range starts
+        self.ranges = collections.OrderedDict()     # start -> (end, owner), least recently used first
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, key_hash):
+        """ The cached owner of key_hash, or None """
+        with self.lock:
+            if len(self.starts) == 0:
+                return None
+            # The range starting at or before the hash. Index -1 is the last
+            # range, which may wrap around to the hash.
+            start = self.starts[bisect.bisect_right(self.starts, key_hash) - 1]
+            (end, owner) = self.ranges[start]
+            if not in_range(key_hash, start, end):
+                return None
+            # Move to the most recently used end
+            self.ranges[start] = self.ranges.pop(start)
+            return owner
+
+    def add(self, start, end, owner):
+        """ Cache a range, replacing the ranges it overlaps """
+        with self.lock:
+            for (s, (e, o)) in self.ranges.items():
+                if in_range(s, start, end) or in_range(start, s, e):
+                    self.remove(s)
+
+            while len(self.starts) >= self.max_size:
+                self.remove(next(iter(self.ranges)))
+
+            bisect.insort(self.starts, start)
+            self.ranges[start] = (end, owner)
+
+    # Call with the lock held
+    def remove(self, start):
+        self.starts.remove(start)
+        del self.ranges[start]
+
+    def remove_owner(self, owner):
+        with self.lock:
+            for (s, (e, o)) in self.ranges.items():
+                if o.ip_port == owner.ip_port:
+                    self.remove(s)
+
+    def clear(self):
+        with self.lock:
+            self.starts = []
+            self.ranges.clear()
+
+
 # ----------------------------------------------------------
 # Small classes that represent node request results
 #
@@ -62,13 +243,185 @@ class ValueNotFound: pass
 
 class ValueStored: pass
 
+class WriteOutdated: pass                   # A newer write of the key is stored already
+
+class ReplicaFound:
+    def __init__(self, value):
+        self.value = value                  # From our copy, may be behind the owner
+
+# A copy of a key of a node whose copies are no longer kept up to date here.
+# The owner answers, or the copy if the owner can not be reached.
+class StaleReplicaFound:
+    def __init__(self, value, destination, key_hash):
+        self.value = value
+        self.destination = destination
+        self.key_hash = key_hash
+
+class ValueCoded:
+    def __init__(self, fragments):
+        self.fragments = fragments          # Ours is stored, the rest go along the ring
+
+class CodedFound:
+    def __init__(self, index, fragment, holders):
+        self.index = index                  # Of our fragment
+        self.fragment = fragment
+        self.holders = holders              # (index, ip:port) of every fragment
+
+# A fragment of a coded value of another node. The owner answers, or the
+# value is decoded from the fragments here and after us if the owner can
+# not be reached.
+class FragmentFound:
+    def __init__(self, index, fragment, holders, destination, key_hash):
+        self.index = index
+        self.fragment = fragment
+        self.holders = holders              # (index, ip:port) of ours and the ones after it
+        self.destination = destination
+        self.key_hash = key_hash
+
 class ForwardRequest:
-    def __init__(self, destination):
+    def __init__(self, destination, key_hash=None):
         self.destination = destination
+        self.key_hash = key_hash            # To pass on, so it is not hashed again
 
 class JoinAccepted:
-    def __init__(self, successor=None):
+    def __init__(self, successor=None, predecessor=None):
         self.successor = successor
+        self.predecessor = predecessor      # The node handing over the keys
+
+class JoinBusy: pass                        # Still handing over to another node
+
+class Draining: pass                        # Leaving, writes are not taken any more
+
+class JoinPending:
+    def __init__(self, destination):
+        self.destination = destination      # Node to ask until our join is accepted
+
+class ReadFallback:
+    def __init__(self, destination):
+        self.destination = destination      # Previous owner, that may still have the key
+
+class OwnerFound:
+    def __init__(self, owner):
+        self.owner = owner
+
+
+class Migration:
+    """ Keys of the range [start, end) on their way to a node that joined
+
+    The node that joined owns the range from the start. The keys are sent
+    in batches, and kept here until it confirms it has them all, so it can
+    read the ones that have not arrived yet from here.
+    """
+
+    def __init__(self, node, start, end, keys):
+        self.node = node
+        self.start = start
+        self.end = end
+        self.keys = set(keys)           # Every key of the range
+        self.pending = list(keys)       # Keys not sent yet
+
+    def restart(self, node):
+        """ Send every key again, to node """
+        self.node = node
+        self.pending = list(self.keys)
+
+
+class HintQueue:
+    """ Writes for nodes that could not be reached, kept on disk until they
+    can be replayed to them (hinted handoff)
+
+    A file per node in 'directory', named after its ip:port, of (key,
+    value, written) records in the order they were written, up to max_size
+    bytes for all nodes. written is when the write was taken, so the node
+    can drop it if it has a newer one. Files left by an earlier run are
+    replayed too.
+
+    Shared by the threads serving requests, so it takes a lock.
+    """
+
+    def __init__(self, directory, max_size=HINT_QUEUE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.sizes = dict()             # ip:port -> bytes in its file
+        self.offsets = dict()           # ip:port -> bytes of it replayed
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            if name.endswith(".hints"):
+                ip_port = name[:-len(".hints")]
+                self.sizes[ip_port] = os.path.getsize(self.path(ip_port))
+                self.offsets[ip_port] = 0
+
+    def path(self, ip_port):
+        return os.path.join(self.directory, ip_port + ".hints")
+
+    def size(self):
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def add(self, ip_port, key, value, written):
+        """ Queue a write for ip_port. Returns False if the queue is full. """
+        record = node_request.HINT_LENGTHS.pack(written, len(key), len(value)) + key + value
+        with self.lock:
+            if sum(self.sizes.values()) + len(record) > self.max_size:
+                return False
+            with open(self.path(ip_port), "ab") as f:
+                f.write(record)
+            self.sizes[ip_port] = self.sizes.get(ip_port, 0) + len(record)
+            self.offsets.setdefault(ip_port, 0)
+            return True
+
+    def pending(self, ip_port):
+        """ Whether there are writes waiting for ip_port """
+        with self.lock:
+            return ip_port in self.sizes
+
+    def destinations(self):
+        with self.lock:
+            return self.sizes.keys()
+
+    def next_batch(self, ip_port, max_size=MIGRATION_BATCH_SIZE):
+        """ The next (key, value, written) writes to replay to ip_port, up
+        to about max_size bytes, and the offset after each one, to confirm
+        the writes up to it with (see done). Once all are confirmed, the
+        file is removed and the writes are empty.
+        """
+        with self.lock:
+            if ip_port not in self.sizes:
+                return ([], [])
+            offset = self.offsets[ip_port]
+            lengths = node_request.HINT_LENGTHS
+            writes = []
+            offsets = []
+            with open(self.path(ip_port), "rb") as f:
+                f.seek(offset)
+                while offset - self.offsets[ip_port] < max_size:
+                    header = f.read(lengths.size)
+                    if len(header) < lengths.size:
+                        break
+                    (written, key_length, value_length) = lengths.unpack(header)
+                    key = f.read(key_length)
+                    value = f.read(value_length)
+                    if len(key) < key_length or len(value) < value_length:
+                        break
+                    writes.append((key, value, written))
+                    offset += lengths.size + key_length + value_length
+                    offsets.append(offset)
+
+            if len(writes) == 0:
+                # All replayed, or only a record cut short by a crash
+                os.remove(self.path(ip_port))
+                del self.sizes[ip_port]
+                del self.offsets[ip_port]
+            return (writes, offsets)
+
+    def done(self, ip_port, offset):
+        """ The writes up to offset have been replayed """
+        with self.lock:
+            if ip_port in self.offsets:
+                self.offsets[ip_port] = offset
 
 
 # ----------------------------------------------------------
@@ -82,8 +435,55 @@ class JoinAccepted:
 class NodeCore:
 
     def __init__(self, *args, **kwargs):
-        # desc=None, predecessor=None, succesor=None):
+        # desc=None, predecessor=None, succesor=None, replication=1):
         self.map = dict()
+        self.tree = MerkleTree()        # Of the pairs in map
+
+        # Copies of every key are kept on the owner and the replication - 1
+        # nodes after it on the ring, see next_replica. Each node compares
+        # the copies on its successor with its own now and then, see
+        # sync_owners.
+        self.replication = kwargs.get("replication", 1)
+        self.replicas = dict()          # Copies of keys of the nodes before us
+        self.replica_owners = dict()    # Key -> ip:port of the owner it is a copy of
+        self.replica_trees = dict()     # Owner -> MerkleTree of its copies here
+        self.replica_copies = dict()    # Owner -> copies still to make after ours
+
+        # While we are one of the replication - 1 nodes after an owner, the
+        # node before us stores or compares its copies with ours every sync
+        # interval. Copies not compared for replica_lifetime seconds are
+        # stale: the ring has changed and they are no longer kept up to
+        # date, see replica_current. None if they are never compared.
+        self.replica_checked = dict()   # Owner -> when the node before us last did
+        self.replica_lifetime = kwargs.get("replica_lifetime")
+        self.clock = kwargs.get("clock", time.time)
+
+        # Values stored erasure coded, as (k, m) fragments on the owner and
+        # the k + m - 1 nodes after it, see do_put. None if not configured.
+        # The owner knows where all fragments are, the other holders where
+        # theirs and the ones after it are. So the holders of fragments 1 to
+        # m can decode the value without the owner.
+        self.erasure = kwargs.get("erasure")
+        self.fragments = dict()         # Key -> (index, fragment) stored here
+        self.coded = dict()             # Key -> (index, ip:port) of the fragments we know of
+
+        # Joins hand over keys while requests are served, see join_request.
+        # Requests and the migration take turns through this lock.
+        self.lock = threading.Lock()
+        self.migration = None           # Keys being handed over to a new node
+        self.importing_from = None      # Previous owner of our range, while we join
+        self.imported_writes = set()    # Keys written here since we joined
+        self.written = dict()           # Key -> when its value here was written, on clock
+        self.draining = False           # Leaving, see start_leave
+
+        # Chord finger table: fingers[i] is the node responsible for
+        # rank + 2**i, or None if that is this node or not known yet.
+        # Requests are forwarded to the closest finger before their key,
+        # which takes O(log n) hops instead of O(n) along successors.
+        self.fingers = [None] * khash.bits
+
+        # Owners of key ranges learned from forwarded requests
+        self.routes = RouteCache()
 
         if "desc" in kwargs:
             desc = kwargs['desc']
@@ -102,7 +502,8 @@ class NodeCore:
             self.rank = rank
             self.next_node = next_node
 
-            long_max_digit = 100000000000000000000000000000000000000L
+            # 10**38 in a 128 bit key space, scaled to the configured one
+            long_max_digit = 100000000000000000000000000000000000000L * khash.space // 2 ** 128
 
             self.desc = NodeDescriptor(ip="127.0.0.1", port=node_httpserver_port)
             self.desc.rank = rank * long_max_digit
@@ -133,54 +534,439 @@ class NodeCore:
             return self.desc.rank <= key_hash or key_hash < self.successor.rank
 
 
+    def finger_start(self, i):
+        """ The hash that finger i is responsible for """
+        return (self.desc.rank + 2 ** i) % khash.space
+
+    def next_hop(self, key_hash):
+        """ The node to forward a request for key_hash to
+
+        That is the known node with the largest rank not past key_hash,
+        which may be the node responsible for it. The successor if no finger
+        is closer.
+        """
+        rank = self.desc.rank
+        limit = (key_hash - rank) % khash.space
+
+        best = self.successor
+        best_distance = (best.rank - rank) % khash.space
+        for f in self.fingers:
+            if f is None:
+                continue
+            distance = (f.rank - rank) % khash.space
+            if best_distance < distance <= limit:
+                (best, best_distance) = (f, distance)
+        return best
+
+    def route(self, key_hash):
+        """ The node to forward a request for key_hash to: its owner if that
+        is in the route cache, the next hop otherwise """
+        owner = self.routes.lookup(key_hash)
+        if owner is not None and owner.ip_port != self.desc.ip_port:
+            return owner
+        return self.next_hop(key_hash)
+
+    def owner_range(self):
+        """ The (start, end) of the range of hashes this node is responsible for """
+        if self.successor == None:
+            return (self.desc.rank, self.desc.rank)
+        return (self.desc.rank, self.successor.rank)
+
+    def learn_route(self, start, end, owner):
+        """ Remember the owner of a range, stamped on a forwarded response """
+        if owner.ip_port != self.desc.ip_port:
+            self.routes.add(start, end, owner)
+
+    def set_finger(self, i, node):
+        if node.ip_port == self.desc.ip_port:
+            node = None
+        self.fingers[i] = node
+
+    def forget_node(self, node):
+        """ Stop forwarding to a node, after it could not be reached """
+        self.fingers = [None if f is not None and f.ip_port == node.ip_port else f
+                for f in self.fingers]
+        self.routes.remove_owner(node)
+
+    def fingers_to_fix(self):
+        """ The (finger, hash) pairs that have to be looked up to refresh the
+        finger table. Fingers that point to this node are cleared. """
+        lookups = []
+        for i in range(khash.bits):
+            start = self.finger_start(i)
+            if self.responsible_for_hash(start):
+                self.fingers[i] = None
+            else:
+                lookups.append((i, start))
+        return lookups
+
+    # Handle a request to find the node responsible for a hash
+    #
+    # Returns an OwnerFound instance if it is this node, or a ForwardRequest
+    # instance if the request should be forwarded to another node.
+    #
+    def find_owner(self, key_hash):
+        if self.responsible_for_hash(key_hash):
+            return OwnerFound(self.desc)
+        else:
+            return ForwardRequest(self.next_hop(key_hash))
+
 
     # Handle a request to store a key-value pair
     #
     # Returns a ValueStored instance if the value was stored successfully, or a
     # ForwardReqest instance if the request should be forwarded to another node.
+    # If coded, the value is erasure coded instead, and a ValueCoded instance
+    # is returned with the fragments, the first of which is stored here. The
+    # rest have to be stored on the nodes after us, see store_coded.
     #
-    def do_put(self, key, value):
-        if self.responsible_for_key(key):
-            self.map[key] = value
-            return ValueStored()
-        else:
-            return ForwardRequest(self.successor)
+    # key_hash is the hash of the key if the caller already has it.
+    #
+    # written is when a write replayed from a hint queue was first taken,
+    # on the clock of the node that took it. If the value stored here was
+    # written later, a WriteOutdated instance is returned and nothing is
+    # stored. Other writes are stamped with our clock.
+    #
+    def do_put(self, key, value, key_hash=None, coded=False, written=None):
+        if key_hash is None:
+            key_hash = node_hash(key)
+        if self.join_pending():
+            return JoinPending(self.importing_from)
+        elif not self.responsible_for_hash(key_hash):
+            return ForwardRequest(self.route(key_hash), key_hash)
+
+        if coded:
+            fragments = erasure.encode(value, *self.erasure)
+        with self.lock:
+            if self.draining:
+                return Draining()
+            if written is not None and written <= self.written.get(key, 0):
+                return WriteOutdated()
+            self.written[key] = written if written is not None else self.clock()
+            self.coded.pop(key, None)
+            self.fragments.pop(key, None)
+            if coded:
+                self.map.pop(key, None)
+                self.tree.remove(key)
+                self.fragments[key] = (0, fragments[0])
+            else:
+                self.map[key] = value
+                self.tree.put(key, value, key_hash)
+            if self.importing_from is not None:
+                # Newer than the copy still on its way
+                self.imported_writes.add(key)
+        if coded:
+            return ValueCoded(fragments)
+        return ValueStored()
 
     # Handle a request to look up a key
     #
     # Returns a ValueFound instance if the value was found in this node, a
     # ValueNotFound instance if this node is responsible for the key but there
     # is nothing stored there yet, and a ForwardReqest instance if the request
-    # should be forwarded to another node.
+    # should be forwarded to another node. While keys are still being handed
+    # over to this node, a ReadFallback instance if the previous owner may
+    # have the key. A ReplicaFound instance if another node is responsible,
+    # but this node has a copy, or a StaleReplicaFound instance if that copy
+    # is no longer kept up to date. A CodedFound instance if the value is
+    # erasure coded, with the fragment here and where to fetch the others,
+    # or a FragmentFound instance if another node is responsible for it.
     #
-    def do_get(self, key):
-        if self.responsible_for_key(key):
-            value = self.map.get(key)
-            if value: return ValueFound(value)
-            else: return ValueNotFound()
-        else:
-            return ForwardRequest(self.successor)
+    # key_hash is the hash of the key if the caller already has it.
+    #
+    def do_get(self, key, key_hash=None):
+        if key_hash is None:
+            key_hash = node_hash(key)
+        if self.join_pending():
+            return JoinPending(self.importing_from)
+        elif not self.responsible_for_hash(key_hash):
+            value = self.replicas.get(key)
+            holders = self.coded.get(key)
+            fragment = self.fragments.get(key)
+            if value is not None and self.replica_current(self.replica_owners.get(key)):
+                return ReplicaFound(value)
+            elif value is not None:
+                return StaleReplicaFound(value, self.route(key_hash), key_hash)
+            elif holders and fragment:
+                return FragmentFound(fragment[0], fragment[1], holders,
+                        self.route(key_hash), key_hash)
+            return ForwardRequest(self.route(key_hash), key_hash)
+
+        value = self.map.get(key)
+        holders = self.coded.get(key)
+        fragment = self.fragments.get(key)
+        if value is not None: return ValueFound(value)
+        elif holders and fragment: return CodedFound(fragment[0], fragment[1], holders)
+        elif self.importing_from is not None: return ReadFallback(self.importing_from)
+        else: return ValueNotFound()
+
+    # Handle a read from the node a range is being handed over to, for a key
+    # that has not arrived there yet
+    #
+    # Returns ValueFound or ValueNotFound, from the copy kept for the handover.
+    #
+    def fallback_get(self, key):
+        with self.lock:
+            m = self.migration
+            if m is not None and key in m.keys:
+                return ValueFound(self.map[key])
+            return ValueNotFound()
 
 
     def join_request(self, new_node):
-        """ Handle a request from a new node to join the network """
+        """ Handle a request from a new node to join the network
+
+        The new node takes over the part of our range from its rank on,
+        right away. Its keys are sent over in batches (see migration_batch),
+        and kept here until it has them all (see finish_migration), so it
+        can read the rest from us meanwhile. One join at a time, and none
+        while our own keys are still arriving.
+        """
         if self.responsible_for_hash(new_node.rank):
 
-            if self.successor != None:
-                successor_for_new_node = self.successor
-            else:
-                successor_for_new_node = self.desc
+            with self.lock:
+                if self.migration is not None or self.importing_from is not None:
+                    return JoinBusy()
+
+                if self.successor != None:
+                    successor_for_new_node = self.successor
+                else:
+                    successor_for_new_node = self.desc
+
+                (start, end) = (new_node.rank, successor_for_new_node.rank)
+                keys = [k for k in self.map if in_range(node_hash(k), start, end)]
+                self.migration = Migration(new_node, start, end, keys)
+                self.successor = new_node
+
+            self.routes.clear()
+            return JoinAccepted(successor=successor_for_new_node,
+                    predecessor=self.desc)
+
+        else:
+            return ForwardRequest(self.next_hop(new_node.rank))
+
+    def migration_batch(self, max_size=MIGRATION_BATCH_SIZE):
+        """ The next (key, value) pairs to send to the joining node, up to
+        max_size bytes. Empty when all keys have been sent. """
+        with self.lock:
+            m = self.migration
+            pairs = []
+            size = 0
+            while size < max_size and m.pending:
+                key = m.pending.pop()
+                pairs.append((key, self.map[key]))
+                size += len(key) + len(self.map[key])
+            return pairs
+
+    def finish_migration(self):
+        """ Drop the keys handed over, once the new node has them all """
+        with self.lock:
+            for key in self.migration.keys:
+                del self.map[key]
+                self.tree.remove(key)
+                self.written.pop(key, None)
+            self.migration = None
+
+    def start_join(self, existing):
+        """ About to ask node 'existing' to join its network
+
+        Until the join is accepted, requests are sent back to 'existing'.
+        Until the keys of our range have all arrived (see receive_keys),
+        reads of keys that are not here yet go to the node handing them
+        over.
+        """
+        self.importing_from = existing
+
+    def next_replica(self, copies, owner):
+        """ The node to send a copy of a key of 'owner' (ip:port) to, that
+        has 'copies' more copies to be made: our successor, or None if there
+        are no more to make or the copies have gone round the ring """
+        if copies <= 0 or self.successor == None or self.successor.ip_port == owner:
+            return None
+        return self.successor
+
+    def store_coded(self, key, holders):
+        """ The fragments of a coded value have been stored, on the
+        (index, ip:port) holders: all of them if it is ours, ours and the
+        ones after it otherwise """
+        with self.lock:
+            if key in self.fragments:
+                self.coded[key] = holders
+
+    def store_fragment(self, key, index, fragment):
+        """ Store a fragment of a coded value of one of the nodes before us """
+        with self.lock:
+            self.coded.pop(key, None)
+            self.fragments[key] = (index, fragment)
+
+    def get_fragment(self, key):
+        """ The (index, fragment) of a coded value stored here, or None """
+        return self.fragments.get(key)
+
+    def fragment_count(self):
+        if self.erasure is None:
+            return 0
+        return sum(self.erasure)
+
+    def store_replica(self, key, value, owner, copies):
+        """ Store a copy of a key of 'owner' (ip:port), one of the nodes
+        before us. 'copies' is the number still to make, counting ours. """
+        with self.lock:
+            self.add_replica(key, value, owner)
+            self.replicas_checked(owner, copies)
+
+    # Call with the lock held
+    def add_replica(self, key, value, owner):
+        previous = self.replica_owners.get(key)
+        if previous is not None and previous != owner:
+            self.replica_trees[previous].remove(key)
+        self.replicas[key] = value
+        self.replica_owners[key] = owner
+        self.replica_trees.setdefault(owner, MerkleTree()).put(key, value)
+
+    # Call with the lock held
+    def remove_replica(self, key):
+        owner = self.replica_owners.pop(key)
+        self.replica_trees[owner].remove(key)
+        del self.replicas[key]
+
+    def check_replicas(self, owner, copies):
+        """ The node before us has compared the copies of 'owner' (ip:port)
+        here with its own. 'copies' is the number still to make, counting
+        ours. """
+        with self.lock:
+            self.replicas_checked(owner, copies)
+
+    # Call with the lock held
+    def replicas_checked(self, owner, copies):
+        self.replica_copies[owner] = copies - 1
+        self.replica_checked[owner] = self.clock()
+
+    def replica_current(self, owner):
+        """ If our copies of the keys of 'owner' are still kept up to date """
+        if self.replica_lifetime is None:
+            return True
+        checked = self.replica_checked.get(owner)
+        return checked is not None and self.clock() - checked <= self.replica_lifetime
+
+    def sync_owners(self):
+        """ The (owner ip:port, copies) pairs of the keys to compare with
+        the copies on our successor: our own, and those we hold copies of
+        that have more copies after ours. None while keys are being handed
+        over, as the ranges are changing.
+
+        A copy is brought up to date from the one before it, so after a
+        failure the copies converge one sync interval per node.
+        """
+        with self.lock:
+            if (self.migration is not None or self.importing_from is not None
+                    or self.draining):
+                return []
+            owners = [(self.desc.ip_port, self.replication - 1)]
+            owners += [(owner, copies) for (owner, copies) in self.replica_copies.items()
+                       if self.replica_current(owner)]
+            return [(owner, copies) for (owner, copies) in owners
+                    if self.next_replica(copies, owner) is not None]
+
+    # The tree of the keys of 'owner' (ip:port) here. Call with the lock held.
+    def owner_tree(self, owner):
+        if owner == self.desc.ip_port:
+            return self.tree
+        return self.replica_trees.get(owner) or MerkleTree()
+
+    def tree_hashes(self, owner, indexes):
+        """ The (index, hash) pairs of the nodes of the tree of the keys of
+        'owner' here """
+        with self.lock:
+            return zip(indexes, self.owner_tree(owner).node_hashes(indexes))
+
+    def differing_nodes(self, owner, hashes):
+        """ The indexes of the nodes among the (index, hash) pairs of another
+        node's tree that differ from our tree of the copies of 'owner' """
+        with self.lock:
+            tree = self.owner_tree(owner)
+            for (i, h) in hashes:
+                tree.check(i)
+            ours = tree.node_hashes([i for (i, h) in hashes])
+            return [i for ((i, h), mine) in zip(hashes, ours) if mine != h]
+
+    def leaf_pairs(self, owner, leaves):
+        """ The (key, value) pairs of 'owner' here, in the buckets of leaves """
+        with self.lock:
+            tree = self.owner_tree(owner)
+            store = self.map if owner == self.desc.ip_port else self.replicas
+            return [(key, store[key]) for leaf in leaves for key in tree.keys(leaf)]
+
+    def repair_replicas(self, owner, copies, leaves, pairs):
+        """ Replace our copies of the keys of 'owner' in the buckets of
+        leaves with pairs, from the node before us """
+        with self.lock:
+            tree = self.owner_tree(owner)
+            for leaf in leaves:
+                tree.check(leaf)
+                if not tree.is_leaf(leaf):
+                    raise ValueError("Tree node %d is not a leaf" % leaf)
+            for leaf in leaves:
+                for key in tree.keys(leaf):
+                    self.remove_replica(key)
+            for (key, value) in pairs:
+                self.add_replica(key, value, owner)
+            self.replicas_checked(owner, copies)
+
+    def start_leave(self):
+        """ Stop taking writes, to hand every key over before leaving
+
+        The keys go to our predecessor, which takes over our range (see
+        node_left). Returns False, and changes nothing, while keys are still
+        being handed over for a join.
+        """
+        with self.lock:
+            if self.migration is not None or self.importing_from is not None:
+                return False
+            self.draining = True
+            (start, end) = self.owner_range()
+            self.migration = Migration(None, start, end, self.map.keys())
+            return True
 
-            self.successor = new_node
-            return JoinAccepted(successor=successor_for_new_node)
+    def node_left(self, leaving, successor):
+        """ Take over the range of our successor 'leaving', that has handed
+        its keys over to us. 'successor' is its successor.
 
+        Returns False if 'leaving' is not our successor (any more).
+        """
+        if self.successor == None or self.successor.ip_port != leaving.ip_port:
+            return False
+        if successor.ip_port == self.desc.ip_port:
+            self.successor = None
         else:
-            return ForwardRequest(self.successor)
+            self.successor = successor
+        self.forget_node(leaving)
+        self.routes.clear()
+        return True
 
+    def join_pending(self):
+        return self.successor == None and self.importing_from is not None
 
     def join_accepted(self, join_result):
         """ Join a network when a join is accepted """
         self.successor = join_result.successor
+        self.routes.clear()
+        if self.importing_from is not None and join_result.predecessor is not None:
+            self.importing_from = join_result.predecessor
+
+    def receive_keys(self, pairs, done=False):
+        """ Store keys handed over by our predecessor. done with the last.
+
+        Keys written here since the join are newer, and are kept.
+        """
+        with self.lock:
+            for (key, value) in pairs:
+                if key not in self.imported_writes:
+                    self.map[key] = value
+                    self.tree.put(key, value)
+            if done:
+                self.importing_from = None
+                self.imported_writes.clear()
 
 
 
@@ -200,23 +986,113 @@ class NodeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # The URL path is the key
         key = self.path
 
+        try:
+            key_hash = node_request.parse_key_hash(self.headers)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        # A fragment of a coded value, for its owner
+        if self.headers.get(node_request.FRAGMENT_HEADER) is not None:
+            found = node.get_fragment(key)
+            if found is None:
+                self.respond(404, "text/html", "No fragment")
+            else:
+                self.respond(200, "application/octet-stream", found[1],
+                        {node_request.FRAGMENT_HEADER: str(found[0])})
+            return
+
         # Defer to NodeCore
-        result = node.do_get(key)
+        if self.headers.get(node_request.MIGRATION_HEADER) == "fallback":
+            result = node.fallback_get(key)
+        else:
+            result = node.do_get(key, key_hash)
 
         # Take action depending on NodeCore decision
         if isinstance(result, ValueFound):
+            self.respond(200, "application/octet-stream", result.value,
+                    self.owner_headers())
+
+        elif isinstance(result, ReplicaFound):
             self.respond(200, "application/octet-stream", result.value)
 
+        elif isinstance(result, StaleReplicaFound) and self.iterative():
+            self.redirect(result.destination, key)
+
+        elif isinstance(result, StaleReplicaFound):
+            # Ask the owner, our copy may be behind. A 503 is from a node on
+            # the way that could not reach it either.
+            try:
+                (response, data) = forward_get(result.destination, result.key_hash, key)
+            except (socket.error, httplib.HTTPException):
+                response = None
+            if response is None or response.status == 503:
+                self.respond(200, "application/octet-stream", result.value)
+                return
+            self.respond(response.status, response.getheader("Content-Type"), data,
+                    relay_headers(response))
+
+        elif isinstance(result, FragmentFound) and self.iterative():
+            self.redirect(result.destination, key)
+
+        elif isinstance(result, FragmentFound):
+            # Ask the owner, or decode without it. A 503 is from a node on
+            # the way that could not reach it either.
+            try:
+                (response, data) = forward_get(result.destination, result.key_hash, key)
+            except (socket.error, httplib.HTTPException):
+                response = None
+            if response is not None and response.status != 503:
+                self.respond(response.status, response.getheader("Content-Type"), data,
+                        relay_headers(response))
+                return
+            try:
+                value = fetch_coded(key, result)
+            except ValueError as e:
+                self.respond(503, "text/html", "Owner unreachable, can not decode: %s" % e)
+                return
+            self.respond(200, "application/octet-stream", value)
+
+        elif isinstance(result, CodedFound):
+            try:
+                value = fetch_coded(key, result)
+            except ValueError as e:
+                self.respond(503, "text/html", "Can not decode: %s" % e)
+                return
+            self.respond(200, "application/octet-stream", value, self.owner_headers())
+
         elif isinstance(result, ValueNotFound):
-            self.respond(404, "text/html", "Key not found")
+            self.respond(404, "text/html", "Key not found", self.owner_headers())
+
+        elif isinstance(result, JoinPending):
+            self.redirect(result.destination, key)
+
+        elif isinstance(result, ReadFallback):
+            # Not handed over to us yet, read the previous owner's copy
+            d = result.destination
+            try:
+                (response, data) = node_request.send(d.ip, d.port, "GET", key, None,
+                        {node_request.MIGRATION_HEADER: "fallback"})
+            except (socket.error, httplib.HTTPException):
+                self.respond(503, "text/html", "Key not handed over yet")
+                return
+            self.respond(response.status, response.getheader("Content-Type"), data,
+                    self.owner_headers())
+
+        elif isinstance(result, ForwardRequest) and self.iterative():
+            self.redirect(result.destination, key)
 
         elif isinstance(result, ForwardRequest):
             # Forward request to specified node
-            (status_code, content_type, data) = node_request.sendGET(
-                    result.destination.ip, result.destination.port, key)
+            try:
+                (response, data) = forward_get(result.destination, result.key_hash, key)
+            except (socket.error, httplib.HTTPException) as e:
+                self.respond(503, "text/html", "Owner unreachable: %s" % e)
+                return
 
             # Relay response to requesting node
-            self.respond(status_code, content_type, data)
+            self.respond(response.status, response.getheader("Content-Type"), data,
+                    relay_headers(response))
 
         else:
             raise Exception("Unknown result command: " + pformat(result))
@@ -227,43 +1103,656 @@ class NodeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # The URL path is the key
         key = self.path
 
-        # Reject values that are too long
+        # Reject values that are too long. The fragments of a coded value
+        # come in one body.
         contentLength = int(self.headers['Content-Length'])
+        max_length = MAX_CONTENT_LENGHT
+        if (self.headers.get(node_request.FRAGMENT_HEADER) is not None
+                and node.erasure is not None):
+            max_length = (erasure.fragment_size(MAX_CONTENT_LENGHT, node.erasure[0])
+                    * node.fragment_count())
 
-        if contentLength <= 0 or contentLength > MAX_CONTENT_LENGHT:
+        if contentLength <= 0 or contentLength > max_length:
             self.respond(400, "text/html", "Content body too large")
             return
 
         # The value is the body of the PUT request
         value = self.rfile.read(contentLength)
 
+        try:
+            key_hash = node_request.parse_key_hash(self.headers)
+            replica = node_request.parse_replica(self.headers)
+            fragment = node_request.parse_fragment(self.headers)
+            coded = node_request.parse_storage_class(self.headers)
+            written = node_request.parse_written(self.headers)
+            if coded and node.erasure is None:
+                raise ValueError("Erasure coding is not configured")
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        # Fragments of a coded value of a node before us, to store and pass on
+        if fragment is not None:
+            self.store_fragments(key, value, fragment)
+            return
+
+        # A copy of a key of a node before us, to store and pass on
+        if replica is not None:
+            (copies, owner) = replica
+            node.store_replica(key, value, owner, copies)
+            replicate(key, value, copies - 1, owner)
+            self.respond(200, "application/octet-stream", "")
+            return
+
         # Defer to NodeCore
-        result = node.do_put(key, value)
+        result = node.do_put(key, value, key_hash, coded, written)
 
         # Take action depending on NodeCore decision
         if isinstance(result, ValueStored):
-            self.respond(200, "application/octet-stream", "")
+            replicate(key, value, node.replication - 1, node.desc.ip_port)
+            self.respond(200, "application/octet-stream", "", self.owner_headers())
+
+        elif isinstance(result, WriteOutdated):
+            self.respond(200, "application/octet-stream", "", self.owner_headers())
+
+        elif isinstance(result, ValueCoded):
+            try:
+                holders = send_fragments(key, 1, result.fragments[1:], node.desc.ip_port)
+            except (socket.error, httplib.HTTPException) as e:
+                self.respond(503, "text/html", "Storing fragments failed: %s" % e)
+                return
+            node.store_coded(key, [(0, node.desc.ip_port)] + holders)
+            self.respond(200, "application/octet-stream", "", self.owner_headers())
+
+        elif isinstance(result, JoinPending):
+            self.redirect(result.destination, key)
+
+        elif isinstance(result, Draining):
+            self.respond(503, "text/html", "Node is leaving, try again later")
+
+        elif isinstance(result, ForwardRequest) and self.iterative():
+            self.redirect(result.destination, key)
 
         elif isinstance(result, ForwardRequest):
-            node_request.sendPUT(result.destination.ip, result.destination.port, key, value)
-            self.respond(200, "application/octet-stream", "")
+            try:
+                headers = node_request.storage_class_headers(coded)
+                if written is not None:
+                    headers.update(node_request.written_headers(written))
+                (response, data) = forward_put(result.destination, result.key_hash,
+                        key, value, headers)
+            except (WritesWaiting, socket.error, httplib.HTTPException) as e:
+                # Keep the write until the ring gets through again. Hints
+                # are stored as they are, so coded values are not kept.
+                if not coded and hint(key, value, written):
+                    self.respond(200, "application/octet-stream", "")
+                else:
+                    self.respond(503, "text/html", "Owner unreachable: %s" % e)
+                return
+            self.respond(response.status, response.getheader("Content-Type"), data,
+                    relay_headers(response))
+
+        else:
+            raise Exception("Unknown result command: " + pformat(result))
+
+
+    # Handle a POST request, for ring lookups and joins
+    #
+    #   /owner   body is a hash, responds with "ip:port rank" of the node
+    #            responsible for it. Frontends can use this to send requests
+    #            for a key straight to its owner.
+    #   /join    body is "ip:port rank" of a new node, see
+    #            node_request.sendJoin
+    #   /migrate body is a batch of keys handed over by our predecessor, or
+    #            by our successor when it leaves, see node_request.sendMigration
+    #   /leave   our successor has left, see node_request.sendLeave
+    #   /sync    compare hash trees of copies, see node_request.sendSync
+    #   /repair  copies that differ, see node_request.sendRepair
+    #   /hints   writes kept while we could not be reached, see
+    #            node_request.sendHints
+    def do_POST(self):
+        contentLength = int(self.headers['Content-Length'])
+        body = self.rfile.read(contentLength)
+
+        if self.path == "/join":
+            self.join(body)
+            return
+        elif self.path == "/migrate":
+            self.migrate(body)
+            return
+        elif self.path == "/leave":
+            self.leave(body)
+            return
+        elif self.path == "/sync":
+            self.sync(body)
+            return
+        elif self.path == "/repair":
+            self.repair(body)
+            return
+        elif self.path == "/hints":
+            self.replay(body)
+            return
+        elif self.path != "/owner":
+            self.respond(404, "text/html", "Unknown operation")
+            return
+
+        try:
+            key_hash = long(body)
+        except ValueError:
+            self.respond(400, "text/html", "Bad hash")
+            return
+
+        result = node.find_owner(key_hash)
+
+        if isinstance(result, OwnerFound):
+            owner = result.owner
+        elif isinstance(result, ForwardRequest) and self.iterative():
+            self.redirect(result.destination, self.path)
+            return
+        elif isinstance(result, ForwardRequest):
+            owner = forward(result.destination, key_hash,
+                    lambda d: lookup_owner(d, key_hash))
+        else:
+            raise Exception("Unknown result command: " + pformat(result))
+
+        self.respond(200, "text/plain", "%s %d" % (owner.ip_port, owner.rank))
+
+
+    def join(self, body):
+        try:
+            (ip_port, rank) = body.split(" ")
+            new_node = NodeDescriptor(ip_port=ip_port)
+            new_node.rank = long(rank)
+        except ValueError:
+            self.respond(400, "text/html", "Bad node")
+            return
 
+        result = node.join_request(new_node)
+
+        if isinstance(result, JoinAccepted):
+            self.respond(200, "text/plain", "successor %s %d\npredecessor %s %d\n"
+                    % (result.successor.ip_port, result.successor.rank,
+                       result.predecessor.ip_port, result.predecessor.rank))
+            migration_thread = threading.Thread(name="migration", target=hand_over_keys)
+            migration_thread.daemon = True
+            migration_thread.start()
+        elif isinstance(result, JoinBusy):
+            self.respond(503, "text/html", "Handing over keys, try again later")
+        elif isinstance(result, ForwardRequest):
+            (response, data) = forward(result.destination, new_node.rank,
+                    lambda d: node_request.send(d.ip, d.port, "POST", "/join", body))
+            self.respond(response.status, response.getheader("Content-Type"), data)
         else:
             raise Exception("Unknown result command: " + pformat(result))
 
+    def migrate(self, body):
+        try:
+            pairs = node_request.decode_pairs(body)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+        done = self.headers.get(node_request.MIGRATION_HEADER) == "done"
+        node.receive_keys(pairs, done)
+        self.respond(200, "text/plain", "")
+
+    def leave(self, body):
+        try:
+            nodes = dict()
+            for line in body.splitlines():
+                (role, ip_port, rank) = line.split(" ")
+                nodes[role] = NodeDescriptor(ip_port=ip_port)
+                nodes[role].rank = long(rank)
+            (leaving, successor) = (nodes["leaving"], nodes["successor"])
+        except (ValueError, KeyError):
+            self.respond(400, "text/html", "Bad nodes")
+            return
+
+        if node.node_left(leaving, successor):
+            print "%s left, new successor %s" % (leaving, node.successor)
+            self.respond(200, "text/plain", "")
+        else:
+            self.respond(409, "text/html", "Not our successor")
+
+    # Store the first of the fragments in body, and send the rest on to our
+    # successor. Answers with the (index, ip:port) of every node that stored
+    # one, see node_request.sendFragments.
+    def store_fragments(self, key, body, fragment):
+        (index, owner) = fragment
+        try:
+            fragments = node_request.split_fragments(body, node.fragment_count() - index)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        node.store_fragment(key, index, fragments[0])
+        holders = [(index, node.desc.ip_port)]
+        try:
+            holders += send_fragments(key, index + 1, fragments[1:], owner)
+        except (socket.error, httplib.HTTPException) as e:
+            self.respond(503, "text/html", "Storing fragments failed: %s" % e)
+            return
+        node.store_coded(key, holders)
+        self.respond(200, "text/plain", node_request.format_holders(holders))
+
+    def sync(self, body):
+        try:
+            (copies, owner) = node_request.parse_replica(self.headers)
+            differing = node.differing_nodes(owner, node_request.parse_hashes(body))
+        except (TypeError, ValueError) as e:
+            self.respond(400, "text/html", "Bad sync: %s" % e)
+            return
+        node.check_replicas(owner, copies)
+        self.respond(200, "text/plain", "".join("%d\n" % i for i in differing))
+
+    def repair(self, body):
+        try:
+            (copies, owner) = node_request.parse_replica(self.headers)
+            leaves = node_request.parse_leaves(self.headers)
+            pairs = node_request.decode_pairs(body)
+            node.repair_replicas(owner, copies, leaves, pairs)
+        except (TypeError, ValueError) as e:
+            self.respond(400, "text/html", "Bad repair: %s" % e)
+            return
+        self.respond(200, "text/plain", "")
+
+    # Store writes replayed to us in order, like PUTs from a client, and
+    # answer with the number taken. Writes older than the value stored
+    # already are dropped, and count as taken. If we can not take them all
+    # now, the answer is 503 and the rest is sent again later.
+    def replay(self, body):
+        try:
+            writes = node_request.decode_hints(body)
+        except ValueError as e:
+            self.respond(400, "text/html", str(e))
+            return
+
+        taken = 0
+        for (key, value, written) in writes:
+            if not replay_write(key, value, written):
+                break
+            taken += 1
+        self.respond(200 if taken == len(writes) else 503, "text/plain", str(taken))
+
+    # Whether the caller asked for hints instead of forwarded requests, see
+    # node_request.sendIterative
+    def iterative(self):
+        return self.headers.get(node_request.LOOKUP_HEADER) == "iterative"
+
+    # Tell the caller to send its request to destination instead
+    def redirect(self, destination, path):
+        self.send_response(307)
+        self.send_header("Location", "http://%s%s" % (destination.ip_port, path))
+        self.end_headers()
+
+    # Tell the caller the range of hashes this node is responsible for, so
+    # nodes that forwarded the request can send the next one straight here
+    def owner_headers(self):
+        (start, end) = node.owner_range()
+        return node_request.owner_headers(node.desc.ip_port, start, end)
 
     # Convenience method to make it easier to send responses
-    def respond(self, status_code, content_type, body):
+    def respond(self, status_code, content_type, body, headers={}):
         self.send_response(status_code)
         self.send_header("Content-type", content_type)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(body)
 
 
+# ----------------------------------------------------------
+# Forwarding between nodes
+#
+
+# Send a forwarded request with send(destination). A destination that can
+# not be reached, or drops the connection without an answer, is dropped from
+# the finger table, and the request goes to the next closest node instead,
+# down to the successor.
+def forward(destination, key_hash, send):
+    while True:
+        try:
+            return send(destination)
+        except (socket.error, httplib.HTTPException):
+            if destination is node.successor:
+                raise
+            node.forget_node(destination)
+            destination = node.route(key_hash)
+
+# The headers of a forwarded response to pass on to our caller: the owner
+# stamp, and where to go instead while a node is joining
+def relay_headers(response):
+    headers = learn_owner(response)
+    if response.status == 307:
+        headers["Location"] = response.getheader("Location")
+    return headers
+
+# Learn the owner stamped on a forwarded response. Returns the headers to
+# relay it to our caller.
+def learn_owner(response):
+    stamp = node_request.parse_owner(response)
+    if stamp is None:
+        return {}
+    (ip_port, start, end) = stamp
+    owner = NodeDescriptor(ip_port=ip_port)
+    owner.rank = start
+    node.learn_route(start, end, owner)
+    return node_request.owner_headers(ip_port, start, end)
+
+# Forward a GET towards the node responsible for the key
+def forward_get(destination, key_hash, key):
+    return forward(destination, key_hash,
+            lambda d: node_request.send(d.ip, d.port, "GET", key, None,
+                node_request.key_hash_headers(key_hash),
+                connect_timeout=CONNECT_TIMEOUT))
+
+# Raised instead of forwarding a write to a node that has writes waiting
+# for it in the hint queue. The node may be up: the write has to be queued
+# behind them, see hint, and the node is not given up on.
+class WritesWaiting(Exception): pass
+
+# Forward a PUT towards the node responsible for the key. Raises
+# WritesWaiting if the write has to go into the hint queue, so that it is
+# stored after the older writes there.
+def forward_put(destination, key_hash, key, value, headers={}):
+    headers = dict(headers, **node_request.key_hash_headers(key_hash))
+    def send(d):
+        if hints is not None and hints.pending(d.ip_port):
+            raise WritesWaiting("%s has writes waiting" % d)
+        return node_request.send(d.ip, d.port, "PUT", key, value, headers,
+                connect_timeout=CONNECT_TIMEOUT)
+    return forward(destination, key_hash, send)
+
+# Keep a write that could not be forwarded for our successor, which every
+# forwarded request ends up at when nothing else gets through. Returns False
+# if it can not be kept. written is when the write was first taken, now if
+# None.
+def hint(key, value, written=None):
+    if hints is None or node.successor == None:
+        return False
+    if written is None:
+        written = node.clock()
+    return hints.add(node.successor.ip_port, key, value, written)
+
+# Store or pass on one write replayed to us, see NodeHttpHandler.replay.
+# Returns False if it can not be taken now.
+def replay_write(key, value, written):
+    result = node.do_put(key, value, written=written)
+    if isinstance(result, ValueStored):
+        replicate(key, value, node.replication - 1, node.desc.ip_port)
+        return True
+    elif isinstance(result, WriteOutdated):
+        return True
+    elif isinstance(result, ForwardRequest):
+        try:
+            (response, data) = forward_put(result.destination, result.key_hash,
+                    key, value, node_request.written_headers(written))
+            return response.status == 200
+        except (WritesWaiting, socket.error, httplib.HTTPException):
+            return hint(key, value, written)
+    return False
+
+# Replay the writes kept for every node that can be reached again, a batch
+# at a time, oldest first. Writes the node took are not sent again, even if
+# it could not take the whole batch.
+def replay_hints():
+    for ip_port in hints.destinations():
+        destination = NodeDescriptor(ip_port=ip_port)
+        replayed = 0
+        try:
+            while True:
+                (writes, offsets) = hints.next_batch(ip_port)
+                if len(writes) == 0:
+                    break
+                taken = node_request.sendHints(destination.ip, destination.port, writes)
+                if taken > 0:
+                    hints.done(ip_port, offsets[taken - 1])
+                    replayed += taken
+                if taken < len(writes):
+                    break
+        except (socket.error, httplib.HTTPException):
+            # Still down, try again later
+            pass
+        if replayed > 0:
+            print "Replayed %d writes to %s" % (replayed, destination)
+
+# Ask a node who is responsible for key_hash
+def lookup_owner(destination, key_hash):
+    (ip_port, rank) = node_request.sendFindOwner(
+            destination.ip, destination.port, key_hash)
+    owner = NodeDescriptor(ip_port=ip_port)
+    owner.rank = rank
+    return owner
+
+# Send the fragments of a coded value of 'owner' (ip:port), from fragment
+# 'index' on, to our successor, which stores the first and passes the rest
+# on. Returns the (index, ip:port) of the nodes that stored them.
+def send_fragments(key, index, fragments, owner):
+    if len(fragments) == 0:
+        return []
+    destination = node.next_replica(len(fragments), owner)
+    if destination is None:
+        raise httplib.HTTPException("Not enough nodes for %d fragments"
+                % node.fragment_count())
+    return node_request.sendFragments(destination.ip, destination.port,
+            key, index, owner, fragments)
+
+# Fetch the fragments of a coded value from the nodes that hold them, all at
+# once, and decode it from the first k to arrive, with ours. Raises
+# ValueError if fewer than k can be had.
+def fetch_coded(key, found):
+    (k, m) = node.erasure
+    fragments = {found.index: found.fragment}
+    others = [h for h in found.holders if h[0] != found.index]
+    answers = Queue.Queue()
+    for (index, ip_port) in others:
+        t = threading.Thread(target=fetch_fragment,
+                args=(key, NodeDescriptor(ip_port=ip_port), answers))
+        t.daemon = True
+        t.start()
+    for i in range(len(others)):
+        if len(fragments) >= k:
+            break
+        answer = answers.get()
+        if answer is not None:
+            fragments[answer[0]] = answer[1]
+    return erasure.decode(fragments, k, m)
+
+# Put the (index, fragment) of a coded value on destination in answers, or
+# None if it can not be had in time
+def fetch_fragment(key, destination, answers):
+    try:
+        answers.put(node_request.sendFragmentGET(
+                destination.ip, destination.port, key, REPLICA_TIMEOUT))
+    except (socket.error, httplib.HTTPException, ValueError):
+        answers.put(None)
+
+# Send 'copies' more copies of a key of 'owner' (ip:port) along the ring, see
+# NodeCore.next_replica. Waits until they are stored, unless replicating
+# asynchronously.
+def replicate(key, value, copies, owner):
+    destination = node.next_replica(copies, owner)
+    if destination is None:
+        return
+    if replication_queue is not None:
+        replication_queue.put((destination, key, value, copies, owner))
+    else:
+        send_replica(destination, key, value, copies, owner)
+
+# A node that does not store the copy in time does not get it
+def send_replica(destination, key, value, copies, owner):
+    try:
+        (response, data) = node_request.send(destination.ip, destination.port,
+                "PUT", key, value, node_request.replica_headers(copies, owner),
+                REPLICA_TIMEOUT)
+        if response.status != 200:
+            raise httplib.HTTPException("%d %s" % (response.status, data))
+    except (socket.error, httplib.HTTPException) as e:
+        print "Copying %s to %s failed: %s" % (key, destination, e)
+
+# Send the queued copies, on a thread of its own
+def send_replicas():
+    while True:
+        send_replica(*replication_queue.get())
+
+# Bring the copies of the keys of 'owner' (ip:port) on our successor up to
+# date with ours, sending only the buckets of keys whose hashes differ, see
+# MerkleTree. 'copies' is the number of copies after ours. Returns the number
+# of tree nodes compared and of keys sent.
+def sync_replicas(owner, copies):
+    destination = node.next_replica(copies, owner)
+    if destination is None:
+        return (0, 0)
+
+    compared = 0
+    indexes = [1]
+    while True:
+        hashes = node.tree_hashes(owner, indexes)
+        compared += len(hashes)
+        differing = node_request.sendSync(destination.ip, destination.port,
+                copies, owner, hashes)
+        if len(differing) == 0 or node.tree.is_leaf(differing[0]):
+            break
+        indexes = [c for i in differing for c in (2 * i, 2 * i + 1)]
+
+    sent = 0
+    for start in range(0, len(differing), REPAIR_LEAVES):
+        leaves = differing[start:start + REPAIR_LEAVES]
+        pairs = node.leaf_pairs(owner, leaves)
+        node_request.sendRepair(destination.ip, destination.port,
+                copies, owner, leaves, pairs)
+        sent += len(pairs)
+    return (compared, sent)
+
+# Compare the copies on our successor with ours, for every owner, see
+# NodeCore.sync_owners
+def sync_all_replicas():
+    for (owner, copies) in node.sync_owners():
+        try:
+            (compared, sent) = sync_replicas(owner, copies)
+        except (socket.error, httplib.HTTPException) as e:
+            print "Syncing copies of %s with %s failed: %s" % (owner, node.successor, e)
+            continue
+        if sent > 0:
+            print "Synced copies of %s with %s: compared %d hashes, sent %d keys" % (
+                    owner, node.successor, compared, sent)
+
+# Send a batch of keys to destination, trying again until it is stored or
+# the deadline (a time.time()) has passed
+def send_batch(destination, pairs, done=False, deadline=None):
+    while True:
+        try:
+            return node_request.sendMigration(
+                    destination.ip, destination.port, pairs, done)
+        except (socket.error, httplib.HTTPException) as e:
+            if deadline is not None and time.time() + JOIN_RETRY_INTERVAL > deadline:
+                raise
+            print "Handing over keys to %s failed, retrying: %s" % (destination, e)
+            time.sleep(JOIN_RETRY_INTERVAL)
+
+# Send the keys of the range a new node took over, a batch at a time, then
+# drop our copy. Runs on its own thread, while requests are served. A batch
+# that fails is sent again; the new node owns the range already, so the keys
+# stay here until it has them.
+def hand_over_keys():
+    destination = node.migration.node
+    while True:
+        pairs = node.migration_batch()
+        if len(pairs) == 0:
+            break
+        send_batch(destination, pairs)
+    send_batch(destination, [], True)
+    node.finish_migration()
+    print "Handed over keys to %s" % destination
+
+# Hand our keys over to our predecessor, which takes over our range, before
+# leaving the network. Writes are turned away meanwhile, reads are served.
+# Gives up after 'timeout' seconds, losing the keys.
+def leave_network(timeout):
+    if node.successor == None:
+        print "Last node, leaving with %d keys" % len(node.map)
+        return
+    deadline = time.time() + timeout
+    while not node.start_leave():
+        if time.time() > deadline:
+            print "Still handing over keys for a join, leaving with %d keys" % len(node.map)
+            return
+        time.sleep(JOIN_RETRY_INTERVAL)
+
+    last = (node.desc.rank - 1) % khash.space
+    try:
+        while True:
+            predecessor = forward(node.successor, last, lambda d: lookup_owner(d, last))
+            node.migration.restart(predecessor)
+            send_keys(predecessor, deadline)
+            if node_request.sendLeave(predecessor.ip, predecessor.port,
+                    (node.desc.ip_port, node.desc.rank),
+                    (node.successor.ip_port, node.successor.rank)):
+                break
+            # A node joined in front of us meanwhile, hand over to it instead
+    except (socket.error, httplib.HTTPException, RuntimeError) as e:
+        print "Leaving failed, %d keys lost: %s" % (len(node.map), e)
+        return
+    print "Left, %s took over" % predecessor
+
+# Send every key of a leaving node to destination, reporting progress
+def send_keys(destination, deadline):
+    total = len(node.migration.keys)
+    (sent, size) = (0, 0)
+    start = reported = time.time()
+    while True:
+        pairs = node.migration_batch(LEAVE_BATCH_SIZE)
+        if len(pairs) == 0:
+            break
+        if time.time() > deadline:
+            raise RuntimeError("Timed out after %d of %d keys" % (sent, total))
+        send_batch(destination, pairs, deadline=deadline)
+
+        sent += len(pairs)
+        size += sum(len(key) + len(value) for (key, value) in pairs)
+        if time.time() - reported >= 1:
+            reported = time.time()
+            print "Handed over %d of %d keys to %s, %.1f MB/s" % (
+                    sent, total, destination, size / 1e6 / (reported - start))
+
+    seconds = time.time() - start
+    print "Handed over %d keys (%.1f MB) to %s in %.2fs, %.1f MB/s" % (
+            sent, size / 1e6, destination, seconds, size / 1e6 / max(seconds, 1e-6))
+
+# Join the network of node 'existing', retrying while it is busy
+def join_network(existing):
+    node.start_join(existing)
+    while True:
+        result = node_request.sendJoin(existing.ip, existing.port,
+                node.desc.ip_port, node.desc.rank)
+        if result is not None:
+            break
+        time.sleep(JOIN_RETRY_INTERVAL)
+
+    (successor, predecessor) = [NodeDescriptor(ip_port=ip_port) for (ip_port, rank) in result]
+    (successor.rank, predecessor.rank) = (result[0][1], result[1][1])
+    node.join_accepted(JoinAccepted(successor, predecessor))
+
+# Look up the current owner of every finger
+def refresh_fingers():
+    for (i, start) in node.fingers_to_fix():
+        try:
+            owner = forward(node.next_hop(start), start,
+                    lambda d: lookup_owner(d, start))
+        except (socket.error, httplib.HTTPException) as e:
+            print "Finger %d lookup failed: %s" % (i, e)
+            continue
+        node.set_finger(i, owner)
+
+
 # ----------------------------------------------------------
 # Basic HTTP server
 #
-class NodeServer(BaseHTTPServer.HTTPServer, SocketServer.ForkingMixIn, SocketServer.ThreadingMixIn):
+# Every connection is served on a thread of its own. Nodes wait on each other
+# (forwarding, copies), and a node serving one request at a time could be
+# waited on by the very node it is waiting for.
+#
+class NodeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
 
     def server_bind(self):
         BaseHTTPServer.HTTPServer.server_bind(self)
@@ -291,14 +1780,109 @@ class NodeServer(BaseHTTPServer.HTTPServer, SocketServer.ForkingMixIn, SocketSer
 if __name__ == '__main__':
 
     httpserver_port = 8000
+    hash_name = khash.name
+    key_bits = khash.bits
+    existing = None
+    leave_timeout = LEAVE_TIMEOUT
+    replication = 1
+    async_replication = False
+    sync_interval = SYNC_INTERVAL
+    hint_directory = None
+    coding = None
+
+    usage = (sys.argv[0]
+            + " [--port portnumber(default=8000)]"
+            + " [--leave-timeout seconds(default=%d)]" % LEAVE_TIMEOUT
+            + " [--replicas count(default=1)] [--async-replication]"
+            + " [--sync-interval seconds(default=%d, 0 for never)]" % SYNC_INTERVAL
+            + " [--erasure k+m]"
+            + " [--hint-dir directory(default=%s)]" % os.path.join(
+                tempfile.gettempdir(), "hints-<port>")
+            + " [--hash %s(default=md5)]" % "|".join(sorted(khash.FUNCTIONS))
+            + " [--key-bits bits(default=128)]"
+            + " (node_count rank next_node | --join host:port)")
 
-    # sys.argv[1] --> node_count
-    # sys.argv[2] --> rank
-    # sys.argv[3] --> next_node
-    node_count = sys.argv[1]
-    rank = long(sys.argv[2])
-    next_node = sys.argv[3]
-    node = NodeCore(node_count, rank, next_node)
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], '', ['port=', 'join=', 'leave-timeout=',
+            'replicas=', 'async-replication', 'sync-interval=', 'erasure=',
+            'hint-dir=', 'hash=', 'key-bits='])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+
+    for opt, arg in optlist:
+        if opt == "--port":
+            httpserver_port = int(arg)
+        elif opt == "--join":
+            existing = NodeDescriptor(ip_port=arg)
+        elif opt == "--leave-timeout":
+            leave_timeout = float(arg)
+        elif opt == "--replicas":
+            replication = int(arg)
+        elif opt == "--async-replication":
+            async_replication = True
+        elif opt == "--sync-interval":
+            sync_interval = float(arg)
+        elif opt == "--erasure":
+            try:
+                coding = tuple(int(n) for n in arg.split("+"))
+                (k, m) = coding
+                erasure.check(k, m)
+            except ValueError:
+                print usage
+                sys.exit(2)
+        elif opt == "--hint-dir":
+            hint_directory = arg
+        elif opt == "--hash":
+            hash_name = arg
+        elif opt == "--key-bits":
+            key_bits = int(arg)
+
+    if len(args) != (0 if existing else 3) or replication < 1:
+        print usage
+        sys.exit(2)
+
+    try:
+        khash.configure(hash_name, key_bits)
+    except ValueError, e:
+        print e
+        sys.exit(2)
+
+    # Lookups tell other nodes our address, so use one they can reach
+    desc = NodeDescriptor(ip=socket.gethostname(), port=httpserver_port)
+
+    # Copies the node before us has stopped comparing are not served as is
+    replica_lifetime = STALE_SYNCS * sync_interval if sync_interval > 0 else None
+
+    if existing:
+        node = NodeCore(desc=desc, replication=replication, erasure=coding,
+                replica_lifetime=replica_lifetime)
+    else:
+        # args[0] --> node_count
+        # args[1] --> rank
+        # args[2] --> next_node
+        node_httpserver_port = httpserver_port
+        node_count = args[0]
+        rank = long(args[1])
+        next_node = args[2]
+        node = NodeCore(node_count, rank, next_node, replication=replication,
+                erasure=coding, replica_lifetime=replica_lifetime)
+        desc.rank = node.desc.rank
+        node.desc = desc
+
+    # Copies are sent by a thread of their own, when asynchronous
+    if async_replication:
+        replication_queue = Queue.Queue(REPLICATION_QUEUE_SIZE)
+        replication_thread = threading.Thread(name="replication", target=send_replicas)
+        replication_thread.daemon = True
+        replication_thread.start()
+
+    # Writes for nodes that can not be reached are kept on disk
+    if hint_directory is None:
+        hint_directory = os.path.join(tempfile.gettempdir(), "hints-%d" % httpserver_port)
+    hints = HintQueue(hint_directory)
+    if hints.size() > 0:
+        print "%d bytes of writes waiting in %s" % (hints.size(), hint_directory)
 
     # Start the webserver which handles incomming requests
     try:
@@ -308,14 +1892,51 @@ if __name__ == '__main__':
         server_thread.daemon = True
         server_thread.start()
 
+        # Hand our keys over before stopping
         def handler(signum, frame):
+            if not node.draining:
+                leave_network(leave_timeout)
             print "Stopping http server..."
             httpd.stop()
         signal.signal(signal.SIGINT, handler)
+        signal.signal(signal.SIGTERM, handler)
 
     except Exception as e:
         print "Error: unable to start http server thread"
         raise e
 
+    # Join the network, taking over our range of keys
+    if existing:
+        join_network(existing)
+        print "Joined, successor %s" % node.successor
+
+    # Keep the finger table up to date
+    def refresh_periodically():
+        while True:
+            time.sleep(FINGER_REFRESH_INTERVAL)
+            refresh_fingers()
+    finger_thread = threading.Thread(name="finger refresh", target=refresh_periodically)
+    finger_thread.daemon = True
+    finger_thread.start()
+
+    # Bring the copies on our successor up to date now and then
+    def sync_periodically():
+        while True:
+            time.sleep(sync_interval)
+            sync_all_replicas()
+    if replication > 1 and sync_interval > 0:
+        sync_thread = threading.Thread(name="replica sync", target=sync_periodically)
+        sync_thread.daemon = True
+        sync_thread.start()
+
+    # Hand the kept writes over once their node is back
+    def replay_periodically():
+        while True:
+            time.sleep(HINT_REPLAY_INTERVAL)
+            replay_hints()
+    hint_thread = threading.Thread(name="hint replay", target=replay_periodically)
+    hint_thread.daemon = True
+    hint_thread.start()
+
     # Wait for server thread to exit
     server_thread.join(100)
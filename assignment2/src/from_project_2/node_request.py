@@ -2,6 +2,12 @@
 # vim: set sts=4 sw=4 et:
 
 import httplib
+import socket
+import struct
+import urlparse
+import zlib
+
+import key_hash as khash
 
 """ Common routines for parsing and sending HTTP reqests to nodes """
 
@@ -65,7 +71,7 @@ def sendPUT(hostname, port, key, value):
     data = response.read()
 
     if response.status!=200:
-        raise
+        raise httplib.HTTPException("PUT %s failed: %d %s" % (key, response.status, data))
 
 
 # Send a GET request, to look up a key
@@ -79,3 +85,424 @@ def sendGET(hostname, port, key):
     data = response.read()
 
     return (status_code, content_type, data)
+
+
+# Key hashes
+#
+# The node a request enters at hashes the key, and passes the hash on in a
+# header, so nodes the request is forwarded through do not hash it again.
+
+KEY_HASH_HEADER = "X-Key-Hash"
+
+def key_hash_headers(key_hash):
+    return {KEY_HASH_HEADER: str(key_hash)}
+
+# The key hash in the request headers, None if there is none. Only checked to
+# be in the key space: whoever sends it is trusted to have hashed the key.
+def parse_key_hash(headers):
+    value = headers.get(KEY_HASH_HEADER)
+    if value is None:
+        return None
+    key_hash = long(value)
+    if not 0 <= key_hash < khash.space:
+        raise ValueError("%s is out of the key space" % KEY_HASH_HEADER)
+    return key_hash
+
+
+# Owner stamps
+#
+# A node that handles a key itself tells the caller which range of hashes
+# it is responsible for in the owner header, as "ip:port start end".
+# Forwarding nodes relay it, and cache the range (see node.RouteCache).
+
+OWNER_HEADER = "X-Owner"
+
+def owner_headers(ip_port, start, end):
+    return {OWNER_HEADER: "%s %d %d" % (ip_port, start, end)}
+
+# Returns (ip:port, start, end) stamped on a response, or None
+def parse_owner(response):
+    stamp = response.getheader(OWNER_HEADER)
+    if stamp is None:
+        return None
+    (ip_port, start, end) = stamp.split(" ")
+    return (ip_port, long(start), long(end))
+
+
+# Iterative lookups
+#
+# By default a node that is not responsible for a key forwards the request
+# and relays the answer. With the lookup header set to "iterative" it
+# answers 307 instead, with the next node to ask in the Location header
+# (the owner itself, if it knows it), and the caller follows the hints.
+# No node then holds a connection open or buffers the value for others.
+
+LOOKUP_HEADER = "X-Lookup"
+MAX_LOOKUP_HOPS = 256
+
+# connect_timeout, if given, is the timeout to connect, and timeout the one
+# for the answer after that
+def send(hostname, port, method, path, body=None, headers={}, timeout=None,
+        connect_timeout=None):
+    if connect_timeout is None:
+        conn = httplib.HTTPConnection(hostname, port, timeout=timeout)
+    else:
+        conn = httplib.HTTPConnection(hostname, port, timeout=connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(timeout)
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return (response, data)
+
+# Send a request iteratively, following the hints
+#
+# Returns (response, data, hostname, port), where hostname and port are of
+# the node that answered. If a hint can not be reached, the node that gave
+# it is asked to forward the request itself, which routes around the node.
+#
+def sendIterative(hostname, port, method, path, body=None):
+    previous = None
+    for hop in range(MAX_LOOKUP_HOPS):
+        try:
+            (response, data) = send(hostname, port, method, path, body,
+                    {LOOKUP_HEADER: "iterative"})
+        except socket.error:
+            if previous is None:
+                raise
+            (hostname, port) = previous
+            (response, data) = send(hostname, port, method, path, body)
+            return (response, data, hostname, port)
+
+        if response.status != 307:
+            return (response, data, hostname, port)
+
+        previous = (hostname, port)
+        location = urlparse.urlparse(response.getheader("Location"))
+        (hostname, port) = (location.hostname, location.port)
+
+    raise httplib.HTTPException("%s %s took more than %d hops"
+            % (method, path, MAX_LOOKUP_HOPS))
+
+# Look up a key iteratively. Returns (status_code, content_type, data).
+def sendIterativeGET(hostname, port, key):
+    (response, data, hostname, port) = sendIterative(hostname, port, "GET", key)
+    return (response.status, response.getheader("Content-Type"), data)
+
+# Store a key-value pair iteratively
+def sendIterativePUT(hostname, port, key, value):
+    (response, data, hostname, port) = sendIterative(hostname, port, "PUT", key, value)
+    if response.status!=200:
+        raise httplib.HTTPException("PUT %s failed: %d %s" % (key, response.status, data))
+
+# Ask who is responsible for key_hash, starting at a node and following the
+# hints. Returns (ip:port, rank) of the owner.
+def sendFindOwner(hostname, port, key_hash):
+    (response, data, hostname, port) = sendIterative(
+            hostname, port, "POST", "/owner", str(key_hash))
+
+    if response.status!=200:
+        raise httplib.HTTPException("Owner lookup failed: %d %s" % (response.status, data))
+
+    (ip_port, rank) = data.split(" ")
+    return (ip_port, long(rank))
+
+
+# Replication
+#
+# The owner of a key stores copies of it on the nodes after it on the ring,
+# each passing the copy on to its successor: PUT with the replica header set
+# to "copies ip:port", the number of copies still to make, counting the one
+# sent, and the owner. The copies stop before they get back to the owner.
+
+REPLICA_HEADER = "X-Replica"
+
+def replica_headers(copies, owner_ip_port):
+    return {REPLICA_HEADER: "%d %s" % (copies, owner_ip_port)}
+
+# (copies, owner ip:port) from the request headers, None if the request is
+# not a copy. Raises ValueError if the header is malformed.
+def parse_replica(headers):
+    value = headers.get(REPLICA_HEADER)
+    if value is None:
+        return None
+    (copies, owner) = value.split(" ")
+    return (int(copies), owner)
+
+
+# Erasure coding
+#
+# A PUT with the storage class header set to "erasure" is stored as k + m
+# fragments (see erasure.py) on the owner and the nodes after it, instead of
+# as a value with copies. The owner keeps the first, and sends the rest to
+# its successor, PUT with the fragment header set to "index ip:port", the
+# index of the first fragment in the body and the owner. The body is the
+# fragments, all the same size, one after the other. Each node stores the
+# first and passes the rest on, and answers with "index ip:port" lines of
+# the nodes that stored them. A GET with the fragment header (set to
+# anything) answers with the fragment stored there, and its index in the
+# fragment header.
+
+STORAGE_CLASS_HEADER = "X-Storage-Class"
+FRAGMENT_HEADER = "X-Fragment"
+
+def storage_class_headers(coded):
+    if coded:
+        return {STORAGE_CLASS_HEADER: "erasure"}
+    return {}
+
+# Whether the request asks for the value to be erasure coded. Raises
+# ValueError for a storage class that is not known.
+def parse_storage_class(headers):
+    value = headers.get(STORAGE_CLASS_HEADER, "replicated")
+    if value not in ("replicated", "erasure"):
+        raise ValueError("Unknown storage class '%s'" % value)
+    return value == "erasure"
+
+# (index, owner ip:port) from the request headers, None if the request is
+# not fragments. Raises ValueError if the header is malformed.
+def parse_fragment(headers):
+    value = headers.get(FRAGMENT_HEADER)
+    if value is None:
+        return None
+    (index, owner) = value.split(" ")
+    return (int(index), owner)
+
+# Raises ValueError if body can not be 'count' fragments
+def split_fragments(body, count):
+    if count < 1 or len(body) % count != 0:
+        raise ValueError("%d bytes are not %d fragments" % (len(body), count))
+    size = len(body) // count
+    return [body[i * size:(i + 1) * size] for i in range(count)]
+
+def format_holders(holders):
+    return "".join("%d %s\n" % (index, ip_port) for (index, ip_port) in holders)
+
+# Returns the (index, ip:port) of the nodes that stored the fragments
+def sendFragments(hostname, port, key, index, owner_ip_port, fragments):
+    (response, data) = send(hostname, port, "PUT", key, "".join(fragments),
+            {FRAGMENT_HEADER: "%d %s" % (index, owner_ip_port)})
+    if response.status != 200:
+        raise httplib.HTTPException("Storing fragments failed: %d %s" % (response.status, data))
+    holders = []
+    for line in data.splitlines():
+        (i, ip_port) = line.split(" ")
+        holders.append((int(i), ip_port))
+    return holders
+
+# Returns the (index, fragment) stored on a node for key, or None
+def sendFragmentGET(hostname, port, key, timeout=None):
+    (response, data) = send(hostname, port, "GET", key, None,
+            {FRAGMENT_HEADER: "fetch"}, timeout)
+    if response.status != 200:
+        return None
+    return (int(response.getheader(FRAGMENT_HEADER)), data)
+
+
+# Anti-entropy
+#
+# Copies that missed writes, on a node that was down or did not answer in
+# time, are brought up to date from the node before them, which holds the
+# owner's keys or an earlier copy. The nodes compare hash trees of the
+# copies (see node.MerkleTree), a level at a time from the root: POST /sync
+# with the replica header and "index hash" lines of tree nodes, hash in
+# hex, answers with the indexes of those that differ, a line each. Then the
+# pairs in the buckets of the leaves that differ are sent, POST /repair
+# with the replica header, the leaves header listing the leaves, and the
+# pairs encoded like a migration batch. They replace the copies of the
+# owner's keys in those buckets.
+
+LEAVES_HEADER = "X-Leaves"
+
+# hashes are (index, hash) pairs. Returns the indexes of those that differ.
+def sendSync(hostname, port, copies, owner_ip_port, hashes):
+    body = "".join("%d %x\n" % (i, h) for (i, h) in hashes)
+    (response, data) = send(hostname, port, "POST", "/sync", body,
+            replica_headers(copies, owner_ip_port))
+    if response.status != 200:
+        raise httplib.HTTPException("Sync failed: %d %s" % (response.status, data))
+    return [int(i) for i in data.split()]
+
+# Raises ValueError if a line is not "index hash"
+def parse_hashes(body):
+    hashes = []
+    for line in body.splitlines():
+        (i, h) = line.split(" ")
+        hashes.append((int(i), long(h, 16)))
+    return hashes
+
+def sendRepair(hostname, port, copies, owner_ip_port, leaves, pairs):
+    headers = replica_headers(copies, owner_ip_port)
+    headers[LEAVES_HEADER] = " ".join(str(leaf) for leaf in leaves)
+    (response, data) = send(hostname, port, "POST", "/repair",
+            encode_pairs(pairs), headers)
+    if response.status != 200:
+        raise httplib.HTTPException("Repair failed: %d %s" % (response.status, data))
+
+# Raises ValueError if the leaves header is missing or malformed
+def parse_leaves(headers):
+    value = headers.get(LEAVES_HEADER)
+    if value is None:
+        raise ValueError("No %s header" % LEAVES_HEADER)
+    return [int(leaf) for leaf in value.split()]
+
+
+# Joins
+#
+# A new node asks any node of the ring to let it join, POST /join with
+# "ip:port rank". The node responsible for the rank answers with
+# "successor ip:port rank" and "predecessor ip:port rank" lines, or 503
+# while it is still handing keys over to another new node.
+
+# Returns ((ip:port, rank) of the successor, (ip:port, rank) of the
+# predecessor), or None if the join has to be tried again later
+def sendJoin(hostname, port, ip_port, rank):
+    (response, data) = send(hostname, port, "POST", "/join", "%s %d" % (ip_port, rank))
+    if response.status == 503:
+        return None
+    if response.status != 200:
+        raise httplib.HTTPException("Join failed: %d %s" % (response.status, data))
+
+    nodes = dict()
+    for line in data.splitlines():
+        (role, ip_port, rank) = line.split(" ")
+        nodes[role] = (ip_port, long(rank))
+    return (nodes["successor"], nodes["predecessor"])
+
+
+# Key migration
+#
+# The node that accepts a join sends the new node the keys of its range,
+# POST /migrate, in batches of zlib compressed (key, value) pairs. It waits
+# for each batch to be stored before sending the next. The last batch has
+# the migration header set to "done". Until then, the new node reads keys it
+# does not have yet from the old one, with a GET that has the migration
+# header set to "fallback".
+
+MIGRATION_HEADER = "X-Migration"
+PAIR_LENGTHS = struct.Struct(">II")
+
+def encode_pairs(pairs):
+    parts = []
+    for (key, value) in pairs:
+        parts.append(PAIR_LENGTHS.pack(len(key), len(value)))
+        parts.append(key)
+        parts.append(value)
+    return zlib.compress("".join(parts))
+
+# Raises ValueError if data is not a batch of pairs
+def decode_pairs(data):
+    try:
+        data = zlib.decompress(data)
+    except zlib.error as e:
+        raise ValueError("Bad batch: %s" % e)
+
+    pairs = []
+    offset = 0
+    while offset < len(data):
+        if offset + PAIR_LENGTHS.size > len(data):
+            raise ValueError("Bad batch: truncated")
+        (key_length, value_length) = PAIR_LENGTHS.unpack_from(data, offset)
+        offset += PAIR_LENGTHS.size
+        if offset + key_length + value_length > len(data):
+            raise ValueError("Bad batch: truncated")
+        key = data[offset:offset + key_length]
+        offset += key_length
+        pairs.append((key, data[offset:offset + value_length]))
+        offset += value_length
+    return pairs
+
+def sendMigration(hostname, port, pairs, done=False):
+    headers = {MIGRATION_HEADER: "done"} if done else {}
+    (response, data) = send(hostname, port, "POST", "/migrate",
+            encode_pairs(pairs), headers)
+    if response.status != 200:
+        raise httplib.HTTPException("Migration failed: %d %s" % (response.status, data))
+
+
+# Leaving
+#
+# A node that leaves the ring hands its keys over to its predecessor, which
+# takes over its range, with POST /migrate. It then asks the predecessor to
+# take over, POST /leave with "leaving ip:port rank" and "successor ip:port
+# rank" lines, for itself and its successor. 409 if the predecessor has
+# another successor by now.
+
+# leaving and successor are (ip:port, rank) pairs. Returns False if the node
+# has another successor.
+def sendLeave(hostname, port, leaving, successor):
+    body = "leaving %s %d\nsuccessor %s %d\n" % (leaving + successor)
+    (response, data) = send(hostname, port, "POST", "/leave", body)
+    if response.status == 409:
+        return False
+    if response.status != 200:
+        raise httplib.HTTPException("Leave failed: %d %s" % (response.status, data))
+    return True
+
+
+# Hinted handoff
+#
+# A node that can not forward a write, as its successor is down, stores it
+# in its hint queue (see node.HintQueue) and answers 200. Once the
+# successor is back, the writes are replayed to it in order, POST /hints
+# with batches of (key, value, written) encoded like a migration batch,
+# with the time the write was taken in front of each pair. The successor
+# stores or forwards them like PUTs, with the written header set to that
+# time, so a node that has a newer value drops them. It answers with the
+# number of writes it took, and 503 if that is not all of them yet; the
+# rest is sent again later.
+
+WRITTEN_HEADER = "X-Written"
+HINT_LENGTHS = struct.Struct(">dII")
+
+def written_headers(written):
+    return {WRITTEN_HEADER: repr(written)}
+
+# When a replayed write was first taken, None if the request is not one.
+# Raises ValueError if the header is malformed.
+def parse_written(headers):
+    value = headers.get(WRITTEN_HEADER)
+    if value is None:
+        return None
+    return float(value)
+
+def encode_hints(writes):
+    parts = []
+    for (key, value, written) in writes:
+        parts.append(HINT_LENGTHS.pack(written, len(key), len(value)))
+        parts.append(key)
+        parts.append(value)
+    return zlib.compress("".join(parts))
+
+# Raises ValueError if data is not a batch of writes
+def decode_hints(data):
+    try:
+        data = zlib.decompress(data)
+    except zlib.error as e:
+        raise ValueError("Bad batch: %s" % e)
+
+    writes = []
+    offset = 0
+    while offset < len(data):
+        if offset + HINT_LENGTHS.size > len(data):
+            raise ValueError("Bad batch: truncated")
+        (written, key_length, value_length) = HINT_LENGTHS.unpack_from(data, offset)
+        offset += HINT_LENGTHS.size
+        if offset + key_length + value_length > len(data):
+            raise ValueError("Bad batch: truncated")
+        key = data[offset:offset + key_length]
+        offset += key_length
+        writes.append((key, data[offset:offset + value_length], written))
+        offset += value_length
+    return writes
+
+# Returns the number of writes the node took, from the first on
+def sendHints(hostname, port, writes):
+    (response, data) = send(hostname, port, "POST", "/hints", encode_hints(writes))
+    if response.status not in (200, 503):
+        raise httplib.HTTPException("Replaying writes failed: %d %s" % (response.status, data))
+    try:
+        return int(data)
+    except ValueError:
+        raise httplib.HTTPException("Replaying writes failed: %d %s" % (response.status, data))
@@ -1,7 +1,15 @@
 #!/usr/bin/python
 # vim: set sts=4 sw=4 et:
 
+import BaseHTTPServer
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
+import erasure
 import node
 import node_request
 from pprint import pformat
@@ -248,6 +256,667 @@ class TestNodeCore(unittest.TestCase):
         self.assertEqual(isinstance(result, node.ForwardRequest), True)
         self.assertEqual(result.destination, d1)
 
+    def test_forward_to_closest_finger(self):
+        d0 = node_ranked(0)
+        d1 = node_ranked(1)
+        d2 = node_ranked(2)
+        node0 = node.NodeCore(desc=d0, successor=d1)
+
+        key = key_ranked(2)
+        self.assertEqual(node0.do_get(key).destination, d1)
+
+        node0.set_finger(127, d2)
+        self.assertEqual(node0.do_get(key).destination, d2)
+        self.assertEqual(node0.do_put(key, "VALUE").destination, d2)
+        self.assertEqual(node0.do_get(key_ranked(1)).destination, d1)
+
+        # Unreachable fingers are no longer used
+        node0.forget_node(node_ranked(2))
+        self.assertEqual(node0.do_get(key).destination, d1)
+
+    def test_forward_carries_hash(self):
+        d0 = node_ranked(0)
+        d1 = node_ranked(1)
+        node0 = node.NodeCore(desc=d0, successor=d1)
+
+        key = key_ranked(1)
+        self.assertEqual(node0.do_get(key).key_hash, node.node_hash(key))
+
+        # A given hash is used as is
+        self.assertEqual(isinstance(node0.do_put(key, "VALUE", key_hash=5), node.ValueStored), True)
+        self.assertEqual(node0.do_get(key, key_hash=5).value, "VALUE")
+
+    def test_find_owner(self):
+        d0 = node_ranked(0)
+        d1 = node_ranked(1)
+        node0 = node.NodeCore(desc=d0, successor=d1)
+
+        self.assertEqual(node0.find_owner(d0.rank + 5).owner, d0)
+        self.assertEqual(node0.find_owner(d1.rank + 5).destination, d1)
+
+    def test_fingers_to_fix(self):
+        d0 = node_ranked(0)
+        node0 = node.NodeCore(desc=d0, successor=node_ranked(1))
+        lookups = node0.fingers_to_fix()
+
+        # Only fingers past the successor, 10**38 away, need looking up
+        self.assertEqual([i for (i, start) in lookups], [127])
+        self.assertEqual(lookups[0][1], 2**127)
+
+
+class TestRouteCache(unittest.TestCase):
+
+    def test_lookup(self):
+        cache = node.RouteCache()
+        cache.add(10, 20, node_ranked(1))
+        cache.add(50, 5, node_ranked(2))
+
+        self.assertEqual(cache.lookup(10).ip_port, node_ranked(1).ip_port)
+        self.assertEqual(cache.lookup(15).ip_port, node_ranked(1).ip_port)
+        self.assertEqual(cache.lookup(20), None)
+        self.assertEqual(cache.lookup(30), None)
+        self.assertEqual(cache.lookup(60).ip_port, node_ranked(2).ip_port)
+        self.assertEqual(cache.lookup(2).ip_port, node_ranked(2).ip_port)
+        self.assertEqual(cache.lookup(7), None)
+
+    def test_overlapping_range_replaced(self):
+        cache = node.RouteCache()
+        cache.add(10, 20, node_ranked(1))
+        cache.add(15, 30, node_ranked(2))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.lookup(12), None)
+        self.assertEqual(cache.lookup(25).ip_port, node_ranked(2).ip_port)
+
+    def test_bounded(self):
+        cache = node.RouteCache(max_size=3)
+        for i in range(4):
+            cache.add(i * 10, i * 10 + 5, node_ranked(i))
+        cache.lookup(10)
+        cache.add(100, 105, node_ranked(9))
+
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.lookup(0), None)
+        self.assertEqual(cache.lookup(20), None)
+        self.assertEqual(cache.lookup(10).ip_port, node_ranked(1).ip_port)
+
+    def test_remove_owner(self):
+        cache = node.RouteCache()
+        cache.add(10, 20, node_ranked(1))
+        cache.add(30, 40, node_ranked(2))
+        cache.remove_owner(node_ranked(1))
+        self.assertEqual(cache.lookup(15), None)
+        self.assertEqual(cache.lookup(35).ip_port, node_ranked(2).ip_port)
+
+    def test_node_routes_to_cached_owner(self):
+        d0 = node_ranked(0)
+        d1 = node_ranked(1)
+        d2 = node_ranked(2)
+        node0 = node.NodeCore(desc=d0, successor=d1)
+        key = key_ranked(2)
+        self.assertEqual(node0.do_get(key).destination, d1)
+
+        node0.learn_route(d2.rank, d2.rank * 2, d2)
+        self.assertEqual(node0.do_get(key).destination, d2)
+
+        # Unreachable or changed membership drops the cached routes
+        node0.forget_node(d2)
+        self.assertEqual(node0.do_get(key).destination, d1)
+        node0.learn_route(d2.rank, d2.rank * 2, d2)
+        new_node = node.NodeDescriptor(ip="127.0.0.1", port=9000)
+        new_node.rank = d0.rank + 5
+        node0.join_request(new_node)
+        self.assertEqual(len(node0.routes), 0)
+
+    def test_owner_range(self):
+        d0 = node_ranked(0)
+        self.assertEqual(node.NodeCore(desc=d0).owner_range(), (d0.rank, d0.rank))
+        node0 = node.NodeCore(desc=d0, successor=node_ranked(1))
+        self.assertEqual(node0.owner_range(), (d0.rank, node_ranked(1).rank))
+
+
+class TestMigration(unittest.TestCase):
+
+    def setUp(self):
+        (self.d0, self.d1, self.d2) = (node_ranked(0), node_ranked(1), node_ranked(2))
+        self.node0 = node.NodeCore(desc=self.d0)
+        self.node1 = node.NodeCore(desc=self.d1)
+        self.keys = [key_ranked(r) for r in [0, 1, 2]]
+        # Another key in the range of node 1
+        self.other = [str(i) for i in range(1000) if str(i) != self.keys[1]
+                and node.node_hash(str(i)) / self.d1.rank == 1][0]
+        for key in self.keys:
+            self.node0.do_put(key, "v" + key)
+
+    def join(self):
+        self.node1.start_join(self.d0)
+        result = self.node0.join_request(self.d1)
+        self.node1.join_accepted(result)
+        return result
+
+    def send_all(self):
+        while True:
+            pairs = self.node0.migration_batch(1)
+            if len(pairs) == 0:
+                break
+            self.node1.receive_keys(pairs)
+        self.node1.receive_keys([], True)
+        self.node0.finish_migration()
+
+    def test_keys_of_new_range_move(self):
+        self.assertEqual(isinstance(self.join(), node.JoinAccepted), True)
+        self.send_all()
+
+        self.assertEqual(sorted(self.node1.map), sorted(self.keys[1:]))
+        self.assertEqual(self.node0.map.keys(), self.keys[:1])
+        self.assertEqual(self.node0.successor, self.d1)
+        self.assertEqual(self.node1.do_get(self.keys[2]).value, "v" + self.keys[2])
+        self.assertEqual(self.node0.do_get(self.keys[2]).destination, self.d1)
+        self.assertEqual(isinstance(self.node1.do_get(self.other), node.ValueNotFound), True)
+
+    def test_join_pending_redirects(self):
+        self.node1.start_join(self.d0)
+        result = self.node1.do_get(self.keys[1])
+        self.assertEqual(isinstance(result, node.JoinPending), True)
+        self.assertEqual(result.destination, self.d0)
+        result = self.node1.do_put(self.keys[1], "new")
+        self.assertEqual(isinstance(result, node.JoinPending), True)
+
+    def test_new_owner_falls_back_to_old_owner(self):
+        self.join()
+        self.assertEqual(self.node0.do_get(self.keys[1]).destination, self.d1)
+
+        # Not received yet: read from the copy the old owner keeps
+        result = self.node1.do_get(self.keys[1])
+        self.assertEqual(isinstance(result, node.ReadFallback), True)
+        self.assertEqual(result.destination, self.d0)
+        self.assertEqual(self.node0.fallback_get(self.keys[1]).value, "v" + self.keys[1])
+        self.assertEqual(isinstance(self.node0.fallback_get(self.keys[0]), node.ValueNotFound), True)
+        self.assertEqual(isinstance(self.node0.fallback_get(self.other), node.ValueNotFound), True)
+
+        # Received: served here
+        self.node1.receive_keys(self.node0.migration_batch())
+        self.assertEqual(self.node1.do_get(self.keys[1]).value, "v" + self.keys[1])
+
+    def test_writes_during_migration_go_to_new_owner(self):
+        self.join()
+        self.assertEqual(self.node0.do_put(self.keys[1], "new").destination, self.d1)
+        self.assertEqual(isinstance(self.node1.do_put(self.keys[1], "new"), node.ValueStored), True)
+        self.node1.do_put(self.other, "added")
+        self.node0.do_put(self.keys[0], "stays")
+        self.send_all()
+
+        self.assertEqual(self.node1.map[self.keys[1]], "new")
+        self.assertEqual(self.node1.map[self.other], "added")
+        self.assertEqual(self.node0.map, {self.keys[0]: "stays"})
+
+        # Once the handover is done, keys sent again are stored
+        self.node1.receive_keys([(self.keys[1], "newer")])
+        self.assertEqual(self.node1.map[self.keys[1]], "newer")
+
+    def test_old_copy_dropped_once_handed_over(self):
+        self.join()
+        while self.node0.migration_batch():
+            pass
+        self.assertEqual(sorted(self.node0.map), sorted(self.keys))
+        self.node0.finish_migration()
+        self.assertEqual(self.node0.map.keys(), self.keys[:1])
+        self.assertEqual(isinstance(self.node0.fallback_get(self.keys[1]), node.ValueNotFound), True)
+
+    def test_one_join_at_a_time(self):
+        self.join()
+        d = node_ranked(0)
+        d.rank += 5
+        self.assertEqual(isinstance(self.node0.join_request(d), node.JoinBusy), True)
+        self.assertEqual(self.node0.join_request(self.d2).destination, self.d1)
+        self.assertEqual(isinstance(self.node1.join_request(self.d2), node.JoinBusy), True)
+        self.send_all()
+        self.assertEqual(isinstance(self.node0.join_request(d), node.JoinAccepted), True)
+        self.assertEqual(isinstance(self.node1.join_request(self.d2), node.JoinAccepted), True)
+
+    def test_leave_hands_every_key_to_predecessor(self):
+        self.join()
+        self.send_all()
+        self.assertEqual(self.node1.start_leave(), True)
+
+        # Reads are served, writes turned away
+        self.assertEqual(self.node1.do_get(self.keys[1]).value, "v" + self.keys[1])
+        self.assertEqual(isinstance(self.node1.do_put(self.keys[1], "new"), node.Draining), True)
+        self.assertEqual(isinstance(self.node1.join_request(self.d2), node.JoinBusy), True)
+
+        self.node1.migration.restart(self.d0)
+        while True:
+            pairs = self.node1.migration_batch()
+            if len(pairs) == 0:
+                break
+            self.node0.receive_keys(pairs)
+        self.assertEqual(self.node0.node_left(self.d1, self.d0), True)
+
+        self.assertEqual(self.node0.successor, None)
+        for key in self.keys:
+            self.assertEqual(self.node0.do_get(key).value, "v" + key)
+
+    def test_leave_waits_for_join(self):
+        self.join()
+        self.assertEqual(self.node0.start_leave(), False)
+        self.assertEqual(self.node1.start_leave(), False)
+        self.send_all()
+        self.assertEqual(self.node0.start_leave(), True)
+        self.assertEqual(self.node0.migration.keys, set(self.keys[:1]))
+
+    def test_node_left_only_for_successor(self):
+        node0 = node.NodeCore(desc=self.d0, successor=self.d1)
+        self.assertEqual(node0.node_left(self.d2, self.d0), False)
+        self.assertEqual(node0.successor, self.d1)
+        self.assertEqual(node0.node_left(self.d1, self.d2), True)
+        self.assertEqual(node0.successor, self.d2)
+
+    def test_pairs_round_trip(self):
+        pairs = [("/a", "1"), ("/b", ""), ("/\x00", "x" * 1000)]
+        data = node_request.encode_pairs(pairs)
+        self.assertTrue(len(data) < 1000)
+        self.assertEqual(node_request.decode_pairs(data), pairs)
+        self.assertRaises(ValueError, node_request.decode_pairs, "garbage")
+        self.assertRaises(ValueError, node_request.decode_pairs, data[:-1])
+
+
+class TestReplication(unittest.TestCase):
+
+    def setUp(self):
+        (self.d0, self.d1, self.d2) = (node_ranked(0), node_ranked(1), node_ranked(2))
+        self.node0 = node.NodeCore(desc=self.d0, successor=self.d1, replication=3)
+        self.node1 = node.NodeCore(desc=self.d1, successor=self.d2, replication=3)
+        self.node2 = node.NodeCore(desc=self.d2, successor=self.d0, replication=3)
+
+    def test_copies_go_to_successors(self):
+        owner = self.d0.ip_port
+        self.assertEqual(self.node0.next_replica(2, owner), self.d1)
+        self.assertEqual(self.node1.next_replica(1, owner), self.d2)
+        self.assertEqual(self.node2.next_replica(0, owner), None)
+
+    def test_copies_stop_at_owner(self):
+        owner = self.d0.ip_port
+        self.assertEqual(self.node2.next_replica(5, owner), None)
+        self.assertEqual(node.NodeCore(desc=self.d0).next_replica(2, owner), None)
+
+    def test_read_from_copy(self):
+        key = key_ranked(0)
+        self.assertEqual(self.node1.do_get(key).destination, self.d2)
+        self.node1.store_replica(key, "copy", self.d0.ip_port, 2)
+        self.assertEqual(self.node1.do_get(key).value, "copy")
+        self.assertEqual(isinstance(self.node1.do_get(key), node.ReplicaFound), True)
+
+        # The owner answers from its own store
+        self.node0.do_put(key, "value")
+        self.node0.store_replica(key, "stale", self.d2.ip_port, 1)
+        self.assertEqual(self.node0.do_get(key).value, "value")
+
+    def test_stale_copy_asks_owner(self):
+        now = [0]
+        node2 = node.NodeCore(desc=self.d2, successor=self.d0, replication=3,
+                replica_lifetime=30, clock=lambda: now[0])
+        (key, owner) = (key_ranked(1), self.d1.ip_port)
+        node2.store_replica(key, "copy", owner, 2)
+        self.assertEqual(isinstance(node2.do_get(key), node.ReplicaFound), True)
+        self.assertEqual(node2.sync_owners(), [(self.d2.ip_port, 2), (owner, 1)])
+
+        # No longer compared by the node before us, after a node joined
+        now[0] = 31
+        result = node2.do_get(key)
+        self.assertEqual(isinstance(result, node.StaleReplicaFound), True)
+        self.assertEqual((result.value, result.destination), ("copy", self.d0))
+        self.assertEqual(node2.sync_owners(), [(self.d2.ip_port, 2)])
+
+        node2.check_replicas(owner, 2)
+        self.assertEqual(isinstance(node2.do_get(key), node.ReplicaFound), True)
+
+    def test_empty_value_found(self):
+        key = key_ranked(0)
+        self.node1.store_replica(key, "", self.d0.ip_port, 2)
+        self.assertEqual(self.node1.do_get(key).value, "")
+        self.node0.do_put(key, "")
+        self.assertEqual(isinstance(self.node0.do_get(key), node.ValueFound), True)
+
+    def test_replica_header(self):
+        headers = node_request.replica_headers(2, "127.0.0.1:8000")
+        self.assertEqual(node_request.parse_replica(headers), (2, "127.0.0.1:8000"))
+        self.assertEqual(node_request.parse_replica({}), None)
+        bad = {node_request.REPLICA_HEADER: "two"}
+        self.assertRaises(ValueError, node_request.parse_replica, bad)
+
+
+class TestErasureCoding(unittest.TestCase):
+
+    def setUp(self):
+        (self.d0, self.d1) = (node_ranked(0), node_ranked(1))
+        self.node0 = node.NodeCore(desc=self.d0, successor=self.d1, erasure=(2, 1))
+        self.key = key_ranked(0)
+
+    def test_coded_put(self):
+        self.node0.do_put(self.key, "plain")
+        result = self.node0.do_put(self.key, "coded value", coded=True)
+        self.assertEqual(isinstance(result, node.ValueCoded), True)
+        self.assertEqual(len(result.fragments), 3)
+        self.assertEqual(self.key in self.node0.map, False)
+
+        # Not readable until every fragment is stored
+        self.assertEqual(isinstance(self.node0.do_get(self.key), node.ValueNotFound), True)
+        holders = [(0, self.d0.ip_port), (1, self.d1.ip_port), (2, "127.0.0.1:2")]
+        self.node0.store_coded(self.key, holders)
+        found = self.node0.do_get(self.key)
+        self.assertEqual(isinstance(found, node.CodedFound), True)
+        self.assertEqual((found.index, found.holders), (0, holders))
+        self.assertEqual(erasure.decode({0: found.fragment, 2: result.fragments[2]}, 2, 1),
+                "coded value")
+
+        # A plain write replaces it
+        self.node0.do_put(self.key, "plain again")
+        self.assertEqual(self.node0.do_get(self.key).value, "plain again")
+        self.assertEqual(self.node0.get_fragment(self.key), None)
+
+    def test_fragments_along_the_ring(self):
+        # Two nodes can not hold three fragments
+        node1 = node.NodeCore(desc=self.d1, successor=self.d0, erasure=(2, 1))
+        self.assertEqual(node1.next_replica(1, self.d0.ip_port), None)
+        node1.successor = node_ranked(2)
+        self.assertEqual(node1.next_replica(1, self.d0.ip_port), node1.successor)
+        self.assertEqual(self.node0.fragment_count(), 3)
+        node1.store_fragment(self.key, 1, "frag")
+        self.assertEqual(node1.get_fragment(self.key), (1, "frag"))
+
+    def test_holder_knows_fragments_after_it(self):
+        node1 = node.NodeCore(desc=self.d1, successor=node_ranked(2), erasure=(2, 1))
+        fragments = erasure.encode("coded value", 2, 1)
+        node1.store_fragment(self.key, 1, fragments[1])
+        self.assertEqual(isinstance(node1.do_get(self.key), node.ForwardRequest), True)
+
+        # Enough to decode without the owner
+        holders = [(1, self.d1.ip_port), (2, node_ranked(2).ip_port)]
+        node1.store_coded(self.key, holders)
+        found = node1.do_get(self.key)
+        self.assertEqual(isinstance(found, node.FragmentFound), True)
+        self.assertEqual((found.index, found.holders, found.destination),
+                (1, holders, node1.successor))
+        self.assertEqual(erasure.decode({1: found.fragment, 2: fragments[2]}, 2, 1),
+                "coded value")
+
+        # A new fragment waits for its own holders
+        node1.store_fragment(self.key, 1, "new")
+        self.assertEqual(isinstance(node1.do_get(self.key), node.ForwardRequest), True)
+
+    def test_fragment_headers(self):
+        self.assertEqual(node_request.parse_storage_class({}), False)
+        self.assertEqual(node_request.parse_storage_class(
+                node_request.storage_class_headers(True)), True)
+        self.assertRaises(ValueError, node_request.parse_storage_class,
+                {node_request.STORAGE_CLASS_HEADER: "cold"})
+        self.assertEqual(node_request.parse_fragment(
+                {node_request.FRAGMENT_HEADER: "1 127.0.0.1:0"}), (1, "127.0.0.1:0"))
+        self.assertEqual(node_request.split_fragments("aabbcc", 3), ["aa", "bb", "cc"])
+        self.assertRaises(ValueError, node_request.split_fragments, "aabbc", 3)
+        self.assertRaises(ValueError, node_request.split_fragments, "", 0)
+
+
+class TestAntiEntropy(unittest.TestCase):
+
+    def setUp(self):
+        (self.d0, self.d1, self.d2) = (node_ranked(0), node_ranked(1), node_ranked(2))
+        self.node0 = node.NodeCore(desc=self.d0, successor=self.d1, replication=3)
+        self.node1 = node.NodeCore(desc=self.d1, successor=self.d2, replication=3)
+        self.owner = self.d0.ip_port
+        self.keys = [k for k in ("/key-%d" % i for i in range(1500))
+                if self.node0.responsible_for_key(k)]
+        for key in self.keys:
+            self.node0.do_put(key, "value")
+            self.node1.store_replica(key, "value", self.owner, 2)
+
+        # Talk to node1 straight away, instead of over HTTP
+        self.saved = (getattr(node, "node", None), node_request.sendSync, node_request.sendRepair)
+        node.node = self.node0
+        self.sent = []
+        def send_sync(host, port, copies, owner, hashes):
+            return self.node1.differing_nodes(owner, hashes)
+        def send_repair(host, port, copies, owner, leaves, pairs):
+            self.sent.extend(pairs)
+            self.node1.repair_replicas(owner, copies, leaves, pairs)
+        (node_request.sendSync, node_request.sendRepair) = (send_sync, send_repair)
+
+    def tearDown(self):
+        (node.node, node_request.sendSync, node_request.sendRepair) = self.saved
+
+    def test_tree_of_same_pairs(self):
+        (a, b) = (node.MerkleTree(), node.MerkleTree())
+        for key in self.keys:
+            a.put(key, "value")
+        for key in reversed(self.keys):
+            b.put(key, "old")
+            b.put(key, "value")
+        b.put("/extra", "value")
+        self.assertNotEqual(a.node_hashes([1]), b.node_hashes([1]))
+        b.remove("/extra")
+        every = range(1, 2 * a.first_leaf)
+        self.assertEqual(a.node_hashes(every), b.node_hashes(every))
+        for key in self.keys:
+            a.remove(key)
+        self.assertEqual(a.node_hashes([1]), [0])
+
+    def test_in_sync_compares_root(self):
+        self.assertEqual(node.sync_replicas(self.owner, 2), (1, 0))
+
+    def test_only_differing_keys_sent(self):
+        self.node0.do_put(self.keys[7], "changed")
+        self.node1.remove_replica(self.keys[8])
+        self.node1.store_replica(key_ranked(0), "value", self.owner, 2)
+
+        (compared, sent) = node.sync_replicas(self.owner, 2)
+        self.assertEqual(self.node1.tree_hashes(self.owner, [1]),
+                self.node0.tree_hashes(self.owner, [1]))
+        self.assertEqual(self.node1.replicas[self.keys[7]], "changed")
+        self.assertEqual(self.node1.replicas[self.keys[8]], "value")
+        self.assertEqual(key_ranked(0) in self.node1.replicas, False)
+        self.assertTrue(sent < 10, "%d keys sent" % sent)
+        self.assertTrue(compared <= 2 * 3 * node.MERKLE_DEPTH + 1)
+
+    def test_empty_copy_filled(self):
+        self.node1 = node.NodeCore(desc=self.d1, successor=self.d2, replication=3)
+        node.sync_replicas(self.owner, 2)
+        self.assertEqual(len(self.sent), len(self.keys))
+        self.assertEqual(self.node1.tree_hashes(self.owner, [1]),
+                self.node0.tree_hashes(self.owner, [1]))
+        # node1 passes them on to the last copy
+        self.assertEqual(self.node1.sync_owners(),
+                [(self.d1.ip_port, 2), (self.owner, 1)])
+
+    def test_no_sync_while_handing_over(self):
+        self.assertEqual(self.node0.sync_owners(), [(self.owner, 2)])
+        self.node0.start_leave()
+        self.assertEqual(self.node0.sync_owners(), [])
+
+    def test_hashes_round_trip(self):
+        hashes = [(1, 0L), (5, 2 ** 127 + 3)]
+        body = "".join("%d %x\n" % (i, h) for (i, h) in hashes)
+        self.assertEqual(node_request.parse_hashes(body), hashes)
+        self.assertRaises(ValueError, node_request.parse_hashes, "1\n")
+        self.assertRaises(ValueError, self.node1.differing_nodes, self.owner, [(0, 0L)])
+        self.assertRaises(ValueError, self.node1.repair_replicas, self.owner, 2, [1], [])
+
+
+class TestHintedHandoff(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hints = node.HintQueue(self.directory, 1000)
+        self.saved = (getattr(node, "node", None), node.hints)
+
+    def tearDown(self):
+        (node.node, node.hints) = self.saved
+        shutil.rmtree(self.directory)
+
+    def test_replayed_in_order(self):
+        for i in range(10):
+            self.assertEqual(self.hints.add("n:1", "/key-%d" % i, "value", 100.0 + i), True)
+        self.assertEqual(self.hints.pending("n:1"), True)
+        self.assertEqual(self.hints.pending("n:2"), False)
+
+        (first, offsets) = self.hints.next_batch("n:1", 50)
+        self.assertEqual(first[0], ("/key-0", "value", 100.0))
+        self.assertEqual(len(offsets), len(first))
+        # Not confirmed, so sent again
+        self.assertEqual(self.hints.next_batch("n:1", 50)[0], first)
+        # Only the first one confirmed
+        self.hints.done("n:1", offsets[0])
+        self.assertEqual(self.hints.next_batch("n:1", 50)[0][0], first[1])
+        self.hints.done("n:1", offsets[-1])
+        (rest, offsets) = self.hints.next_batch("n:1", 1000)
+        self.assertEqual(first + rest,
+                [("/key-%d" % i, "value", 100.0 + i) for i in range(10)])
+        self.hints.done("n:1", offsets[-1])
+
+        self.assertEqual(self.hints.next_batch("n:1")[0], [])
+        self.assertEqual(self.hints.pending("n:1"), False)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_bounded(self):
+        while self.hints.add("n:1", "/key", "x" * 100, 1.0):
+            pass
+        self.assertTrue(self.hints.size() <= 1000)
+        self.assertEqual(self.hints.add("n:2", "/key", "x" * 100, 1.0), False)
+
+    def test_kept_on_disk(self):
+        self.hints.add("n:1", "/key", "value", 1.0)
+        self.hints.add("n:1", "/cut", "short", 2.0)
+        with open(self.hints.path("n:1"), "r+b") as f:
+            f.truncate(os.path.getsize(self.hints.path("n:1")) - 1)
+
+        hints = node.HintQueue(self.directory)
+        self.assertEqual(hints.pending("n:1"), True)
+        self.assertEqual(hints.next_batch("n:1")[0], [("/key", "value", 1.0)])
+
+    def test_older_write_is_dropped(self):
+        node_core = node.NodeCore(desc=node_ranked(0))
+        self.assertEqual(isinstance(node_core.do_put("/key", "hinted", written=10.0),
+                node.ValueStored), True)
+        self.assertEqual(isinstance(node_core.do_put("/key", "older", written=5.0),
+                node.WriteOutdated), True)
+        self.assertEqual(node_core.do_get("/key").value, "hinted")
+        # A write taken here is newer than any hint from before
+        node_core.do_put("/key", "direct")
+        self.assertEqual(isinstance(node_core.do_put("/key", "late", written=10.0),
+                node.WriteOutdated), True)
+        self.assertEqual(node_core.do_get("/key").value, "direct")
+
+    def test_hint_batch_round_trip(self):
+        writes = [("/a", "1", 1.5), ("/b", "", 1e9 + 0.25)]
+        data = node_request.encode_hints(writes)
+        self.assertEqual(node_request.decode_hints(data), writes)
+        self.assertRaises(ValueError, node_request.decode_hints, "garbage")
+        self.assertRaises(ValueError, node_request.decode_hints, data[:-1])
+        self.assertEqual(node_request.parse_written(node_request.written_headers(1e9 + 0.25)),
+                1e9 + 0.25)
+
+    def test_unreachable_successor_gets_hint(self):
+        # Find a port nobody listens on
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        closed = node.NodeDescriptor(ip="127.0.0.1", port=sock.getsockname()[1])
+        sock.close()
+        closed.rank = 10 ** 38
+
+        node.node = node.NodeCore(desc=node_ranked(0), successor=closed)
+        node.hints = self.hints
+        key_hash = node.node_hash("/key")
+        self.assertRaises(socket.error, node.forward_put, closed, key_hash, "/key", "value")
+        self.assertEqual(node.hint("/key", "value"), True)
+
+        # Later writes wait behind it, even once the node is back
+        self.assertEqual(self.hints.pending(closed.ip_port), True)
+        self.assertRaises(node.WritesWaiting, node.forward_put, closed, key_hash, "/key", "newer")
+
+    def test_writes_waiting_keeps_route(self):
+        node.node = node.NodeCore(desc=node_ranked(0), successor=node_ranked(1))
+        node.hints = self.hints
+        waiting = node_ranked(2)
+        node.node.set_finger(0, waiting)
+        self.hints.add(waiting.ip_port, "/key", "value", 1.0)
+
+        self.assertRaises(node.WritesWaiting, node.forward_put, waiting, waiting.rank,
+                "/key", "newer")
+        self.assertEqual(node.node.fingers[0], waiting)
+
+    def test_dropped_connection_routes_around(self):
+        node.node = node.NodeCore(desc=node_ranked(0), successor=node_ranked(1))
+        dropping = node_ranked(2)
+        node.node.set_finger(0, dropping)
+        def send(d):
+            if d.ip_port == dropping.ip_port:
+                raise httplib.BadStatusLine("''")
+            return d
+        # Treated like a node that can not be reached
+        self.assertEqual(node.forward(dropping, dropping.rank, send), node.node.successor)
+        self.assertEqual(node.node.fingers[0], None)
+
+        dropping = node.node.successor
+        self.assertRaises(httplib.HTTPException,
+                node.forward, dropping, dropping.rank, send)
+
+
+class QuietNodeHandler(node.NodeHttpHandler):
+    def log_message(self, *args):
+        pass
+
+class TestHintReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = (getattr(node, "node", None), node.hints, node.replay_write)
+        self.server = node.NodeServer(("127.0.0.1", 0), QuietNodeHandler)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+        desc = node.NodeDescriptor(ip="127.0.0.1", port=self.server.server_port)
+        desc.rank = 0
+        self.ip_port = desc.ip_port
+        node.node = node.NodeCore(desc=desc)
+        node.hints = node.HintQueue(self.directory)
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.server.server_close()
+        (node.node, node.hints, node.replay_write) = self.saved
+        shutil.rmtree(self.directory)
+
+    def test_newer_writes_win(self):
+        node.node.do_put("/direct", "direct")
+        now = node.node.clock()
+        # Queued by two nodes, replayed out of order
+        node.hints.add(self.ip_port, "/direct", "hinted", now - 10)
+        node.hints.add(self.ip_port, "/both", "newer", now - 1)
+        node.hints.add(self.ip_port, "/both", "older", now - 5)
+        node.replay_hints()
+
+        self.assertEqual(node.node.do_get("/direct").value, "direct")
+        self.assertEqual(node.node.do_get("/both").value, "newer")
+        self.assertEqual(node.hints.pending(self.ip_port), False)
+
+    def test_taken_writes_not_sent_again(self):
+        taken = []
+        def replay_write(key, value, written):
+            if key == "/refused":
+                return False
+            taken.append(key)
+            return True
+        node.replay_write = replay_write
+
+        for key in ["/a", "/b", "/refused", "/c"]:
+            node.hints.add(self.ip_port, key, "value", 1.0)
+        node.replay_hints()
+        self.assertEqual(taken, ["/a", "/b"])
+
+        node.replay_write = lambda key, value, written: taken.append(key) or True
+        node.replay_hints()
+        self.assertEqual(taken, ["/a", "/b", "/refused", "/c"])
+
 
 class TestNodeRequest(unittest.TestCase):
 
@@ -276,5 +945,66 @@ class TestNodeRequest(unittest.TestCase):
         self.assertEqual(r.body, "SOME VALUE")
 
 
+# Answers every request with a redirect to 'hint', or with 200 and the
+# port it listens on if there is no hint or the caller is not iterative
+class HintHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        iterative = self.headers.get(node_request.LOOKUP_HEADER) == "iterative"
+        if self.server.hint and iterative:
+            self.send_response(307)
+            self.send_header("Location", "http://%s%s" % (self.server.hint, self.path))
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(str(self.server.server_port))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestIterativeLookup(unittest.TestCase):
+
+    def start_server(self, hint=None):
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), HintHandler)
+        server.hint = hint
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+        self.servers.append(server)
+        return server.server_port
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_follows_hints(self):
+        owner = self.start_server()
+        middle = self.start_server("127.0.0.1:%d" % owner)
+        first = self.start_server("127.0.0.1:%d" % middle)
+
+        (status, content_type, data) = node_request.sendIterativeGET("127.0.0.1", first, "/key")
+        self.assertEqual(status, 200)
+        self.assertEqual(data, str(owner))
+
+    def test_unreachable_hint(self):
+        # Find a port nobody listens on
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        closed = sock.getsockname()[1]
+        sock.close()
+
+        first = self.start_server("127.0.0.1:%d" % closed)
+        (status, content_type, data) = node_request.sendIterativeGET("127.0.0.1", first, "/key")
+
+        # The node that gave the hint is asked to forward instead
+        self.assertEqual(data, str(first))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -24,6 +24,15 @@ fi
 directory=`pwd` #current working directory
 executable="node.py";
 
+# Copies of every key (1 for none). Set REPLICATION=--async-replication to
+# answer writes before the copies are stored.
+replicas=${REPLICAS:-1}
+replication=${REPLICATION:-}
+
+# Set ERASURE=k+m (e.g. 4+2) to let PUTs with "X-Storage-Class: erasure"
+# store values as k + m fragments instead. Needs at least k + m nodes.
+erasure=${ERASURE:+--erasure $ERASURE}
+
 #put the output into an array
 nodes_array=($nodes)
 
@@ -52,7 +61,7 @@ do
   fi
   
   #give the parameter to node.py
-  nohup ssh $current bash -c "'python -u $directory/$executable $node_count $rank $next_node'" 2>&1 | sed "s/^/$current: /" &
+  nohup ssh $current bash -c "'python -u $directory/$executable --replicas $replicas $replication $erasure $node_count $rank $next_node'" 2>&1 | sed "s/^/$current: /" &
 done
 
 # Run tests
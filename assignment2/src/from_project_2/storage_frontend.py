@@ -28,16 +28,20 @@ class StorageServerFrontend:
 	def __init__(self):
 		self.size = 0
 	
+	# Requests start at any node and follow its hints to the owner, so the
+	# value is not relayed through the nodes in between.
 	def sendGET(self, key):
 		node = random.choice(storageBackendNodes)
-		(status_code, content_type, data) = node_request.sendGET(
+		(status_code, content_type, data) = node_request.sendIterativeGET(
 				node, node_httpserver_port, key)
+		if status_code != 200:
+			return None
 		return data
 		
 	def sendPUT(self, key, value, size):
 		self.size = self.size + size
 		node = random.choice(storageBackendNodes)
-		node_request.sendPUT(node, node_httpserver_port, key, value)
+		node_request.sendIterativePUT(node, node_httpserver_port, key, value)
 
 
 class FrontendHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
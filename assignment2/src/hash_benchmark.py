@@ -0,0 +1,108 @@
+import bisect
+import getopt
+import math
+import sys
+import time
+
+import key_hash
+
+# Compares the key hash functions of key_hash.py, to pick one for --hash and
+# --key-bits: how fast they hash keys, how evenly they spread keys over the
+# nodes, and how fast ring positions of that width compare.
+
+WIDTHS = [32, 63, 64, 128]
+RING_SIZES = [4, 16, 64, 256]
+
+def make_keys(count):
+    return ["key-%d" % i for i in range(count)]
+
+def node_addresses(count):
+    return ["10.0.0.%d:8000" % i for i in range(count)]
+
+def time_calls(function, args):
+    start = time.time()
+    for a in args:
+        function(a)
+    return time.time() - start
+
+# max/mean and stddev/mean of the keys per node; 1.0 and 0.0 when even
+def spread(counts):
+    mean = float(sum(counts)) / len(counts)
+    stddev = math.sqrt(sum((c - mean) ** 2 for c in counts) / len(counts))
+    return (max(counts) / mean, stddev / mean)
+
+# Keys per node, with every key on the last node at or before its hash, as
+# node ranks are the start of their range (wrapping round to the last node)
+def ring_counts(hash_key, nodes, hashes):
+    ranks = sorted(hash_key(n) for n in nodes)
+    counts = [0] * len(ranks)
+    for h in hashes:
+        counts[bisect.bisect_right(ranks, h) - 1] += 1
+    return counts
+
+# Keys per node, with every key on node hash % node count
+def modulo_counts(node_count, hashes):
+    counts = [0] * node_count
+    for h in hashes:
+        counts[h % node_count] += 1
+    return counts
+
+
+class Benchmark():
+
+    def __init__(self, key_count, functions):
+        self.keys = make_keys(key_count)
+        self.functions = functions
+
+    def run(self):
+        print "%d keys" % len(self.keys)
+        for name in self.functions:
+            (function_bits, make) = key_hash.FUNCTIONS[name]
+            for bits in WIDTHS:
+                if bits <= function_bits:
+                    self.run_one(name, bits, key_hash.make_hash(name, bits))
+
+    def run_one(self, name, bits, hash_key):
+        seconds = time_calls(hash_key, self.keys)
+        print "\n%s, %d bits: %.3f us per key, %.0f keys per second" % (
+                name, bits, seconds / len(self.keys) * 1e6, len(self.keys) / seconds)
+
+        hashes = [hash_key(k) for k in self.keys]
+        for node_count in RING_SIZES:
+            ring = spread(ring_counts(hash_key, node_addresses(node_count), hashes))
+            modulo = spread(modulo_counts(node_count, hashes))
+            print ("  %4d nodes: ring max/mean %.2f stddev/mean %.3f,"
+                   " modulo max/mean %.2f stddev/mean %.3f"
+                   % ((node_count,) + ring + modulo))
+
+        # The comparisons that routing does on every hop
+        pivot = hashes[0]
+        seconds = time_calls(lambda h: pivot <= h < pivot + 2 ** (bits - 1), hashes)
+        print "  range check: %.3f us" % (seconds / len(hashes) * 1e6)
+
+
+if __name__ == '__main__':
+
+    key_count = 100000
+    functions = sorted(key_hash.FUNCTIONS)
+    usage = (sys.argv[0] + ' [--keys count(default=%d)]' % key_count
+        + ' [--functions %s]' % ','.join(functions))
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], '', ['keys=', 'functions='])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+
+    for opt, arg in optlist:
+        if opt == "--keys":
+            key_count = int(arg)
+        elif opt == "--functions":
+            functions = arg.split(",")
+
+    unknown = [f for f in functions if f not in key_hash.FUNCTIONS]
+    if key_count <= 0 or unknown:
+        print usage
+        sys.exit(2)
+
+    Benchmark(key_count, functions).run()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# vim: set sts=4 sw=4 et:
+
+import hashlib
+import os
+import unittest
+
+import key_hash
+
+
+# Directories holding a copy of key_hash.py, relative to the repository
+COPIES = ["assignment1/src", "assignment2/src", "assignment2/src/from_project_2"]
+
+def repository_root():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while not all(os.path.isdir(os.path.join(directory, d)) for d in COPIES):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    return directory
+
+
+class TestKeyHash(unittest.TestCase):
+
+    def tearDown(self):
+        key_hash.configure()
+
+    def test_default_is_full_md5(self):
+        self.assertEqual(key_hash.hash_key("hello world!"),
+                long(hashlib.md5("hello world!").hexdigest(), 16))
+        self.assertEqual(key_hash.space, 2 ** 128)
+
+    def test_narrow_hash_is_top_bits(self):
+        for name in key_hash.FUNCTIONS:
+            (function_bits, make) = key_hash.FUNCTIONS[name]
+            full = key_hash.make_hash(name, function_bits)
+            for bits in [1, 32, 63, 64]:
+                h = key_hash.make_hash(name, bits)("hello world!")
+                self.assertTrue(0 <= h < 2 ** bits)
+                self.assertEqual(h, full("hello world!") >> (function_bits - bits))
+
+    def test_narrow_hash_fits_an_int(self):
+        self.assertIsInstance(key_hash.make_hash("md5", 63)("a"), int)
+
+    def test_fnv1a(self):
+        self.assertEqual(key_hash.fnv1a_64(""), 0xcbf29ce484222325)
+        self.assertEqual(key_hash.fnv1a_64("a"), 0xaf63dc4c8601ec8c)
+
+    def test_bad_configuration(self):
+        self.assertRaises(ValueError, key_hash.make_hash, "crc", 32)
+        self.assertRaises(ValueError, key_hash.make_hash, "md5", 0)
+        self.assertRaises(ValueError, key_hash.make_hash, "fnv1a", 65)
+        self.assertRaises(ValueError, key_hash.configure, "md5", 129)
+        self.assertEqual(key_hash.bits, 128)
+
+    def test_configure(self):
+        key_hash.configure("sha1", 32)
+        self.assertEqual((key_hash.name, key_hash.bits, key_hash.space),
+                ("sha1", 32, 2 ** 32))
+        self.assertEqual(key_hash.hash_key("a"),
+                long(hashlib.sha1("a").hexdigest(), 16) >> 128)
+
+    def test_copies_are_identical(self):
+        root = repository_root()
+        if root is None:
+            self.skipTest("not run from the repository")
+        sources = set()
+        for directory in COPIES:
+            with open(os.path.join(root, directory, "key_hash.py")) as f:
+                sources.add(f.read())
+        self.assertEqual(len(sources), 1, "the copies of key_hash.py differ")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,9 +6,13 @@ import argparse
 import collections
 import httplib
 import logging
+import select
 import signal
+import socket
+import SocketServer
 import sys
 import threading
+import time
 
 import node_core2 as ncore
 
@@ -34,6 +38,8 @@ logger.addFilter(CoreFilter())
 
 # HTTP Abstractions
 
+VNODE_HEADER = "X-Vnode"
+
 class HttpRequest:
     """ Abstraction of an HTTP request to a node """
     def __init__(self,
@@ -51,6 +57,11 @@ class HttpRequest:
             self.host = destination.host
             self.port = destination.port
 
+        # Which of the virtual nodes of the server the request is for
+        self.headers = dict()
+        if destination != None and destination.vnode != 0:
+            self.headers[VNODE_HEADER] = str(self.destination.vnode)
+
         self.method = method
 
         if not path.startswith("/"):
@@ -89,9 +100,18 @@ def parse_node_descriptor_dict(s):
         rdmap[role.strip()] = ncore.NodeDescriptor(host_port=hp.strip())
     return rdmap
 
+def parse_fields(s):
+    """ Parse a string as lines of name = value """
+    fields = dict()
+    for line in s.split("\n"):
+        if line.strip() == "": continue
+        (name, value) = line.split("=")
+        fields[name.strip()] = value.strip()
+    return fields
+
 def build_node_descriptor_list(node_list):
-    """ Produce a simple list of host:port pairs, one on each line. """
-    return "\n".join( [n.host_port for n in node_list] )
+    """ Produce a simple list of node names (host:port[#vnode]), one on each line. """
+    return "\n".join( [n.name for n in node_list] )
 
 def parse_node_descriptor_list(s):
     s = s.strip()
@@ -109,7 +129,7 @@ def build_request(msg):
                 destination = msg.destination,
                 method = "POST",
                 path = "/join",
-                body = msg.new_node.host_port)
+                body = msg.new_node.name)
 
     if isinstance(msg, ncore.JoinAccepted):
         return HttpRequest(
@@ -127,14 +147,14 @@ leader = %s
                 destination = msg.destination,
                 method = "PUT",
                 path = "/predecessor",
-                body = msg.predecessor.host_port)
+                body = msg.predecessor.name)
 
     if isinstance(msg, ncore.NewSuccessor):
         return HttpRequest(
                 destination = msg.destination,
                 method = "PUT",
                 path = "/successor",
-                body = msg.successor.host_port)
+                body = msg.successor.name)
 
     if isinstance(msg, ncore.Election):
         return HttpRequest(
@@ -148,7 +168,7 @@ leader = %s
                 destination = msg.destination,
                 method = "POST",
                 path = "/election/result",
-                body = msg.new_leader.host_port)
+                body = msg.new_leader.name)
 
     if isinstance(msg, ncore.GetNeighbors):
         return HttpRequest(
@@ -161,6 +181,27 @@ leader = %s
                 destination = msg.destination,
                 method = "GET",
                 path = "/getCurrentLeader")
+
+    if isinstance(msg, ncore.FindOwner):
+        return HttpRequest(
+                destination = msg.destination,
+                method = "POST",
+                path = "/findOwner",
+                body =
+"""key_hash = %s
+requester = %s
+finger = %s
+""" % (msg.key_hash, msg.requester, msg.finger) )
+
+    if isinstance(msg, ncore.OwnerFound):
+        return HttpRequest(
+                destination = msg.destination,
+                method = "POST",
+                path = "/findOwner/result",
+                body =
+"""owner = %s
+finger = %s
+""" % (msg.owner, msg.finger) )
     else:
         raise RuntimeError("Do not know how to build HTTP for message %s" % (msg,))
 
@@ -202,6 +243,21 @@ def parse_request(hr):
     if hr.path=="/getCurrentLeader" and hr.method=="GET":
         return ncore.GetLeader(destination=hr.destination)
 
+    if hr.path=="/findOwner" and hr.method=="POST":
+        fields = parse_fields(hr.body)
+        return ncore.FindOwner(
+                destination=hr.destination,
+                key_hash=long(fields["key_hash"]),
+                requester=parse_single_node_descriptor(fields["requester"]),
+                finger=int(fields["finger"]))
+
+    if hr.path=="/findOwner/result" and hr.method=="POST":
+        fields = parse_fields(hr.body)
+        return ncore.OwnerFound(
+                destination=hr.destination,
+                owner=parse_single_node_descriptor(fields["owner"]),
+                finger=int(fields["finger"]))
+
     else:
         raise RuntimeError("Do not know how to parse request %s %s" % (hr.method, hr.path))
 
@@ -214,13 +270,82 @@ def build_response(dr):
         return HttpResponse(200)
 
     if isinstance(dr, ncore.NodeList):
-        body = build_node_descriptor_list(dr.nodes)
+        # Clients only need the servers, not which of their virtual nodes
+        body = "\n".join( [n.host_port for n in dr.nodes] )
         return HttpResponse(200, body)
 
     else:
         raise RuntimeError("Do not know how to build response for %s" % (dr,) )
 
 
+# Persistent Connections
+
+MAX_IDLE_CONNECTIONS = 4        # Idle keep-alive connections kept per node
+CONNECTION_TIMEOUT = 30         # Seconds to wait on a connection
+KEEPALIVE_TIMEOUT = 60          # Seconds the server keeps an idle connection
+
+FINGER_REFRESH_INTERVAL = 5     # Seconds between finger table refreshes
+
+class ConnectionPool:
+    """ Idle keep-alive connections to a single node, bounded in size """
+
+    def __init__(self, host, port, max_idle=MAX_IDLE_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Get a (connection, reused) pair, skipping dead idle connections """
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                conn = self.idle.pop()
+            if connection_healthy(conn):
+                return (conn, True)
+            conn.close()
+
+        conn = httplib.HTTPConnection(self.host, self.port,
+                timeout=CONNECTION_TIMEOUT)
+        return (conn, False)
+
+    def release(self, conn):
+        """ Return a connection whose response has been fully read """
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+
+def connection_healthy(conn):
+    """ An idle connection is usable if it is open and has nothing to read
+
+    Anything readable on an idle connection means the other end closed it.
+    """
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error):
+        return False
+    return len(readable) == 0
+
+
+connection_pools = dict()
+connection_pools_lock = threading.Lock()
+
+def get_connection_pool(host, port):
+    with connection_pools_lock:
+        pool = connection_pools.get((host, port))
+        if pool is None:
+            pool = ConnectionPool(host, port)
+            connection_pools[(host, port)] = pool
+        return pool
+
+
 # Actually Send Requests
 
 def send_message(msg):
@@ -231,25 +356,41 @@ def send_message(msg):
 
 
 def send_request(hr):
-    """ Actually send a request to a server via HTTP """
-
-    conn = httplib.HTTPConnection(hr.host, hr.port)
-    conn.request(hr.method, hr.path, hr.body)
-    logger.debug("Sent request: %s:%d %s %s '%s'" %
-            (hr.host, hr.port, hr.method, hr.path, hr.body))
-
-    # Must read response even if we don't do anything with it.
-    # If we don't, the server will get broken pipe errors.
-    #	1. Return without reading response
-    #	2. Server might not be finish sending response yet.
-    #	3. Library code here closes connection.
-    #	4. Server code tries to finish writing to closed pipe.
-    #	5. Broken pipe.
-    response = conn.getresponse()
-    data = response.read()
+    """ Actually send a request to a server via HTTP
+
+    Uses a pooled keep-alive connection. A reused connection may have been
+    closed by the server in the meantime, so a failure on one is retried once
+    on a fresh connection.
+    """
+
+    pool = get_connection_pool(hr.host, hr.port)
+
+    while True:
+        (conn, reused) = pool.acquire()
+        try:
+            conn.request(hr.method, hr.path, hr.body, hr.headers)
+            logger.debug("Sent request: %s:%d %s %s '%s'" %
+                    (hr.host, hr.port, hr.method, hr.path, hr.body))
+
+            # Must read response even if we don't do anything with it.
+            # If we don't, the server will get broken pipe errors, and the
+            # connection can not be reused.
+            response = conn.getresponse()
+            data = response.read()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if reused:
+                continue
+            raise
+        break
+
+    if response.will_close:
+        conn.close()
+    else:
+        pool.release(conn)
 
     if response.status!=200:
-        raise RuntimeException("Got bad response: %s" % response.status)
+        raise RuntimeError("Got bad response: %s" % response.status)
 
     logger.debug("Got OK response: %s %s" % (hr.method, hr.path))
 
@@ -258,10 +399,18 @@ def send_request(hr):
 
 server_node_core = None     # Core decision module for server
 
+# Node cores are not thread safe. Connections are served on their own threads
+# so idle keep-alive connections do not block each other, but messages are
+# still handled one at a time.
+server_node_core_lock = threading.Lock()
+
 class HttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     global server_node_core
 
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
     def do_GET(self):
         self.handle_request("GET")
 
@@ -276,14 +425,23 @@ class HttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         content_length = int(self.headers.getheader('content-length', 0))
         body = self.rfile.read(content_length)
 
+        vnode = int(self.headers.getheader(VNODE_HEADER, 0))
+        destination = server_node_core.descriptor.virtual(vnode)
+        if server_node_core.core_for(destination) == None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
         msg = parse_request(HttpRequest(
-                destination = server_node_core.descriptor,
+                destination = destination,
                 method = method,
                 path = self.path,
                 body = body))
         logger.debug("Parsed message: %s" % (msg,))
 
-        action = server_node_core.handle_message(msg)
+        with server_node_core_lock:
+            action = server_node_core.handle_message(msg)
 
         self.send_response_for_action(action)
         message_queue.put_all(action.new_messages)
@@ -292,6 +450,7 @@ class HttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         hr = build_response(action)
         logger.debug("Responding with %s" % (action,))
         self.send_response(hr.status)
+        self.send_header("Content-Length", str(len(hr.body)))
         self.end_headers()
         self.wfile.write(hr.body)
 
@@ -304,7 +463,9 @@ class HttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 # ----------------------------------------------------------
 # Basic HTTP server
 #
-class NodeServer(BaseHTTPServer.HTTPServer):
+class NodeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
 
     def server_bind(self):
         BaseHTTPServer.HTTPServer.server_bind(self)
@@ -345,8 +506,17 @@ class MessageQueue:
         def sender():
             while True:
                 msg = self.outbox.get()
-                send_message(msg)
-                self.outbox.task_done()
+                try:
+                    send_message(msg)
+                except (socket.error, httplib.HTTPException) as e:
+                    # Let the core route around the node
+                    logger.warning("Could not send %s: %s" % (msg, e))
+                    with server_node_core_lock:
+                        result = server_node_core.handle_message(
+                                ncore.Undeliverable(message=msg))
+                    self.put_all(result.new_messages)
+                finally:
+                    self.outbox.task_done()
 
         self.thread = threading.Thread(
                 name="msg queue sender",
@@ -378,18 +548,33 @@ if __name__ == '__main__':
             help="external hostname (or IP) and port for this server")
     parser.add_argument("--join", metavar="host:port", default=None,
             help="another server to join")
+    parser.add_argument("--vnodes", type=int, default=1,
+            help="virtual nodes (ranks on the ring) per unit of weight")
+    parser.add_argument("--weight", type=float, default=1.0,
+            help="relative capacity of this server")
+    parser.add_argument("--hash", default="md5",
+            choices=sorted(ncore.khash.FUNCTIONS),
+            help="key hash function, the same on every server")
+    parser.add_argument("--key-bits", type=int, default=128,
+            help="width of the key space in bits")
     args = parser.parse_args()
 
+    try:
+        ncore.khash.configure(args.hash, args.key_bits)
+    except ValueError, e:
+        parser.error(str(e))
+
     if args.verbose:
         ncore.logger.setLevel(logging.DEBUG)
         logger.setLevel(logging.DEBUG)
 
     descriptor = ncore.NodeDescriptor(host_port=args.host_port)
     join_descriptor = ncore.NodeDescriptor(host_port=args.join) if args.join else None
-    server_node_core = ncore.NodeCore(descriptor)
+    server_node_core = ncore.HostCore(descriptor, args.vnodes, args.weight)
 
     # Start the webserver which handles incomming requests
-    logger.info("Starting HTTP server: %s, %s" % (descriptor, descriptor.rank))
+    logger.info("Starting HTTP server: %s, %s, %d virtual nodes"
+            % (descriptor, descriptor.rank, len(server_node_core.cores)))
     httpd = NodeServer((descriptor.host, descriptor.port), HttpRequestHandler)
     server_thread = threading.Thread(target = httpd.serve)
     server_thread.daemon = True
@@ -401,17 +586,30 @@ if __name__ == '__main__':
 
     def handler(signum, frame):
         logger.info("Caught signal %d, stopping http server..." % signum)
-        result = server_node_core.handle_message(ncore.Shutdown())
+        with server_node_core_lock:
+            result = server_node_core.handle_message(ncore.Shutdown())
         message_queue.put_all(result.new_messages)
         httpd.stop()
         message_queue.stop()
     signal.signal(signal.SIGINT, handler)
     signal.signal(signal.SIGTERM, handler)
 
-    # Join network
-    if join_descriptor:
-        joinmsg = ncore.Join(destination=join_descriptor, new_node=descriptor)
+    # Join network, or form one from our own virtual nodes
+    with server_node_core_lock:
+        joinmsgs = server_node_core.join(join_descriptor)
+    for joinmsg in joinmsgs:
         send_message(joinmsg)
 
+    # Keep the finger table up to date as nodes come and go
+    def refresh_fingers():
+        while True:
+            time.sleep(FINGER_REFRESH_INTERVAL)
+            with server_node_core_lock:
+                result = server_node_core.handle_message(ncore.FixFingers())
+            message_queue.put_all(result.new_messages)
+    finger_thread = threading.Thread(name="finger refresh", target=refresh_fingers)
+    finger_thread.daemon = True
+    finger_thread.start()
+
     # Wait for server thread to exit
     server_thread.join(100)
@@ -217,6 +217,39 @@ class TestParseBuild(unittest.TestCase):
         self.assertEqual(resp.status, 200)
         self.assertEqual(resp.body, "localhost:8000\nlocalhost:8001\nlocalhost:8002")
 
+    def test_parse_find_owner(self):
+        d0 = ncore.NodeDescriptor(host_port="localhost:8000")
+        d1 = ncore.NodeDescriptor(host_port="localhost:8001")
+        msg = ncore.FindOwner(destination=d0, key_hash=2**127 + 5, requester=d1, finger=127)
+
+        req = nhttp.build_request(msg)
+        self.assertEqual(req.path, "/findOwner")
+        self.assertEqual(nhttp.parse_request(req), msg)
+
+    def test_parse_owner_found(self):
+        d0 = ncore.NodeDescriptor(host_port="localhost:8000")
+        d1 = ncore.NodeDescriptor(host_port="localhost:8001")
+        msg = ncore.OwnerFound(destination=d0, owner=d1, finger=3)
+
+        req = nhttp.build_request(msg)
+        self.assertEqual(req.path, "/findOwner/result")
+        self.assertEqual(nhttp.parse_request(req), msg)
+
+    def test_parse_virtual_node_join(self):
+        d0 = ncore.NodeDescriptor(host_port="localhost:8000").virtual(2)
+        d1 = ncore.NodeDescriptor(host_port="localhost:8001").virtual(5)
+        msg = ncore.Join(destination=d0, new_node=d1)
+
+        req = nhttp.build_request(msg)
+        self.assertEqual(req.body, "localhost:8001#5")
+        self.assertEqual(req.headers, {nhttp.VNODE_HEADER: "2"})
+        self.assertEqual(nhttp.parse_request(req), msg)
+
+    def test_node_list_response_has_servers(self):
+        d0 = ncore.NodeDescriptor(host_port="localhost:8000")
+        response = nhttp.build_response(ncore.NodeList(nodes=[d0, d0.virtual(3)]))
+        self.assertEqual(response.body, "localhost:8000\nlocalhost:8000")
+
     def test_http_request_no_slash(self):
         hr = nhttp.HttpRequest(method="GET", path="needs-a-slash")
         self.assertEqual(hr.path, "/needs-a-slash")
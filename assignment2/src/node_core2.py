@@ -2,11 +2,12 @@
 # coding=utf-8
 
 import collections
-import hashlib
 import logging
 import sys
 import time
 
+import key_hash as khash
+
 logformat = '%(msecs)08.4f %(name)-12s %(levelname)-8s -- %(core)s - %(message)s'
 
 loghandler = logging.StreamHandler(sys.stdout)
@@ -17,36 +18,50 @@ logger.setLevel(logging.INFO)
 logger.addHandler(loghandler)
 
 def node_hash(s):
-    """ Map input to the node key space """
-    md5 = hashlib.md5()
-    md5.update(s)
-    hexhash = md5.hexdigest()
-    numerichash = long(hexhash,16)
-    return numerichash
+    """ Map input to the node key space (the function of key_hash.configure) """
+    return khash.hash_key(s)
 
 
 class NodeDescriptor:
-    """ Essential node metadata for addressing and ranking a node """
+    """ Essential node metadata for addressing and ranking a node
+
+    A server runs one or more virtual nodes, each with its own rank on the
+    ring. Virtual node 0 is ranked by the hash of host:port, like a server
+    without virtual nodes; virtual node v by the hash of its name,
+    host:port#v.
+    """
 
-    def __init__(self, host=None, port=None, host_port=None):
+    def __init__(self, host=None, port=None, host_port=None, vnode=0):
         if host!=None and port!=None:
             (self.host, self.port) = (host.strip(), port)
         elif host_port!=None:
-            (self.host, self.port) = host_port.strip().split(":")
+            (host_port, _, v) = host_port.strip().partition("#")
+            (self.host, self.port) = host_port.split(":")
+            if v:
+                vnode = int(v)
         else:
             raise RuntimeError( "Bad %s: host='%s', port='%s', host_port='%s'"
                 % (self.__class__.__name__, host, port, host_port) )
 
         self.port = int(self.port)
         self.host_port = "%s:%s" % (self.host, self.port)
-        self.rank = node_hash(self.host_port)
+        self.vnode = vnode
+        if vnode == 0:
+            self.name = self.host_port
+        else:
+            self.name = "%s#%d" % (self.host_port, vnode)
+        self.rank = node_hash(self.name)
+
+    def virtual(self, vnode):
+        """ Descriptor of virtual node 'vnode' on the same server """
+        return NodeDescriptor(host=self.host, port=self.port, vnode=vnode)
 
     def __repr__(self):
         return ("<%s,%s‥>"
-            % (self.host_port, str(self.rank)[0:6]))
+            % (self.name, str(self.rank)[0:6]))
 
     def __str__(self):
-        return "%s:%s" % (self.host, self.port)
+        return self.name
 
     def __eq__(a, b):
         return isinstance(b,NodeDescriptor) and a.__dict__ == b.__dict__
@@ -87,6 +102,24 @@ Shutdown = collections.namedtuple("Shutdown",
         ["destination"])
 Shutdown.__new__.__defaults__ = (None,)
 
+# Find the node responsible for key_hash, and tell the requester.
+# Used to fill in finger number 'finger' of the requester.
+FindOwner = collections.namedtuple("FindOwner",
+        ["destination", "key_hash", "requester", "finger"])
+
+OwnerFound = collections.namedtuple("OwnerFound",
+        ["destination", "owner", "finger"])
+
+# Sent by a node to itself, periodically, to refresh its finger table
+FixFingers = collections.namedtuple("FixFingers",
+        ["destination"])
+FixFingers.__new__.__defaults__ = (None,)
+
+# Sent by a node to itself when 'message' could not be delivered
+Undeliverable = collections.namedtuple("Undeliverable",
+        ["destination", "message"])
+Undeliverable.__new__.__defaults__ = (None, None)
+
 # Direct Node Responses
 # All direct responses should have a 'new_messages' field
 
@@ -118,6 +151,12 @@ class NodeCore:
         # If a node is in a network by itself, it is the leader.
         self.leader = descriptor
 
+        # Chord finger table: fingers[i] is the node responsible for
+        # rank + 2**i, or None if that is this node or not known yet.
+        # Messages are routed to the closest finger before their key, which
+        # takes O(log n) hops instead of O(n) along successors.
+        self.fingers = [None] * khash.bits
+
         self.logger = logging.LoggerAdapter(logger, {'core':self.descriptor})
 
         # For tracking election durations
@@ -149,6 +188,51 @@ class NodeCore:
             return d.rank <= key_hash or key_hash < s.rank
 
 
+    def finger_start(self, i):
+        """ The hash that finger i is responsible for """
+        return (self.descriptor.rank + 2 ** i) % khash.space
+
+    def next_hop(self, key_hash):
+        """ The node to route a message for key_hash to
+
+        That is the known node with the largest rank not past key_hash,
+        which may be the node responsible for it. The successor if no finger
+        is closer. Only call when not responsible for key_hash yourself.
+        """
+        rank = self.descriptor.rank
+        limit = (key_hash - rank) % khash.space
+
+        best = self.successor
+        best_distance = (best.rank - rank) % khash.space
+        for f in self.fingers:
+            if f is None:
+                continue
+            distance = (f.rank - rank) % khash.space
+            if best_distance < distance <= limit:
+                (best, best_distance) = (f, distance)
+        return best
+
+    def forget_node(self, node):
+        """ Remove a node from the finger table """
+        self.fingers = [None if f == node else f for f in self.fingers]
+
+    def fix_fingers(self):
+        """ Messages that look up the current owner of every finger """
+        if self.successor == None:
+            self.fingers = [None] * khash.bits
+            return []
+
+        msgs = []
+        for i in range(khash.bits):
+            start = self.finger_start(i)
+            if self.responsible_for_hash(start):
+                self.fingers[i] = None
+            else:
+                msgs.append(FindOwner(destination=self.next_hop(start),
+                    key_hash=start, requester=self.descriptor, finger=i))
+        return msgs
+
+
     def handle_message(self, msg):
         """ Handle a message
 
@@ -186,8 +270,9 @@ class NodeCore:
                 return GenericOk(newmsgs)
 
             else:
-                self.logger.debug("Join(%s): forwarding to %s", n,s)
-                return GenericOk([ msg._replace(destination=s) ])
+                hop = self.next_hop(n.rank)
+                self.logger.debug("Join(%s): forwarding to %s", n,hop)
+                return GenericOk([ msg._replace(destination=hop) ])
 
         elif isinstance(msg, JoinAccepted):
             self.logger.info("JoinAccepted: New successor=%s, predecessor=%s", msg.successor, msg.predecessor)
@@ -298,5 +383,173 @@ class NodeCore:
                 self.logger.info("Shutdown: last node")
                 return GenericOk()
 
+        elif isinstance(msg, FindOwner):
+            if self.responsible_for_hash(msg.key_hash):
+                return GenericOk(new_messages=[
+                    OwnerFound(destination=msg.requester,
+                        owner=self.descriptor, finger=msg.finger)
+                    ])
+            else:
+                return GenericOk(new_messages=[
+                    msg._replace(destination=self.next_hop(msg.key_hash))
+                    ])
+
+        elif isinstance(msg, OwnerFound):
+            if msg.owner == self.descriptor:
+                self.fingers[msg.finger] = None
+            else:
+                self.fingers[msg.finger] = msg.owner
+            return GenericOk()
+
+        elif isinstance(msg, FixFingers):
+            return GenericOk(new_messages=self.fix_fingers())
+
+        elif isinstance(msg, Undeliverable):
+            # Stop routing through the node. Messages that were routed
+            # through a finger are routed again, falling back to the
+            # successor walk if no other finger is closer.
+            failed = msg.message.destination
+            self.forget_node(failed)
+
+            if isinstance(msg.message, Join):
+                key_hash = msg.message.new_node.rank
+            elif isinstance(msg.message, FindOwner):
+                key_hash = msg.message.key_hash
+            else:
+                key_hash = None
+
+            if (key_hash is None or self.successor == None
+                    or failed == self.successor):
+                self.logger.warning("Undeliverable: dropping %s", msg.message)
+                return GenericOk()
+            if self.responsible_for_hash(key_hash):
+                return self.handle_message(msg.message._replace(destination=self.descriptor))
+
+            hop = self.next_hop(key_hash)
+            self.logger.info("Undeliverable: rerouting %s to %s", msg.message, hop)
+            return GenericOk(new_messages=[ msg.message._replace(destination=hop) ])
+
         else:
             raise RuntimeError("Unknown message: %s" % (msg,))
+
+
+# Virtual Nodes
+
+def virtual_node_count(vnodes, weight):
+    """ Number of virtual nodes for a server of the given weight """
+    return max(1, int(round(vnodes * weight)))
+
+
+class HostCore:
+    """ The virtual nodes of one server
+
+    One rank per server leaves each server an arbitrary arc of the ring, so
+    some servers own far more keys than others. With virtual nodes a server
+    owns 'vnodes' ranks per unit of 'weight', and its share of the keys is
+    close to its share of the total weight.
+
+    Every virtual node is a NodeCore in the ring of its own right. Messages
+    between the virtual nodes of this server are handled here, and only
+    messages to other servers are returned.
+    """
+
+    def __init__(self, descriptor, vnodes=1, weight=1.0):
+        self.weight = weight
+        self.cores = [NodeCore(descriptor.virtual(v))
+                for v in range(virtual_node_count(vnodes, weight))]
+        self.descriptor = self.cores[0].descriptor
+        self.stopped = 0        # Virtual nodes below this one have shut down
+
+    def core_for(self, descriptor):
+        """ The core of a virtual node of this server, None if not ours """
+        if (descriptor == None or descriptor.host_port != self.descriptor.host_port
+                or not 0 <= descriptor.vnode < len(self.cores)):
+            return None
+        return self.cores[descriptor.vnode]
+
+    def responsible_for_key(self, key):
+        return self.responsible_for_hash(node_hash(key))
+
+    def responsible_for_hash(self, key_hash):
+        return any(core.responsible_for_hash(key_hash) for core in self.cores)
+
+    def join(self, existing=None):
+        """ Messages that join this server to the ring of node 'existing'
+
+        The virtual nodes join one after the other, each through the one
+        before it, so no two joins race for the same part of the ring.
+        Without 'existing' they form a ring of their own.
+        """
+        if existing == None:
+            return self.deliver(self.join_after(0))
+        return [Join(destination=existing, new_node=self.descriptor)]
+
+    def join_after(self, vnode):
+        if vnode + 1 >= len(self.cores):
+            return []
+        return [Join(destination=self.cores[vnode].descriptor,
+            new_node=self.cores[vnode + 1].descriptor)]
+
+    def deliver(self, msgs):
+        """ Handle the messages to our own virtual nodes, return the rest
+
+        Messages to virtual nodes that have shut down are dropped.
+        """
+        outgoing = []
+        pending = collections.deque(msgs)
+        while pending:
+            msg = pending.popleft()
+            if self.core_for(msg.destination) == None:
+                outgoing.append(msg)
+            elif msg.destination.vnode >= self.stopped:
+                pending.extend(self.handle_virtual(msg).new_messages)
+        return outgoing
+
+    def handle_virtual(self, msg):
+        """ Handle a message to one of our virtual nodes, without delivering
+        the messages that result """
+        core = self.core_for(msg.destination)
+        if core == None:
+            raise RuntimeError("Not a virtual node of %s: %s" % (self.descriptor, msg))
+
+        result = core.handle_message(msg)
+        if isinstance(msg, JoinAccepted):
+            return result._replace(new_messages=result.new_messages
+                    + self.join_after(core.descriptor.vnode))
+        return result
+
+    def handle_message(self, msg):
+        """ Handle a message to one of our virtual nodes, or to the server
+
+        Shutdown, FixFingers and Undeliverable are for the whole server.
+        """
+
+        if isinstance(msg, Shutdown):
+            # One virtual node after the other, so every one leaves knowing
+            # the neighbours left behind by the ones before it
+            msgs = []
+            for core in self.cores:
+                result = core.handle_message(msg)
+                self.stopped = core.descriptor.vnode + 1
+                msgs.extend(self.deliver(result.new_messages))
+            return GenericOk(msgs)
+
+        elif isinstance(msg, FixFingers):
+            msgs = []
+            for core in self.cores:
+                msgs.extend(self.deliver(core.handle_message(msg).new_messages))
+            return GenericOk(msgs)
+
+        elif isinstance(msg, Undeliverable):
+            # Sent by whichever virtual node routed the message. Forget the
+            # node everywhere, and let the one that has it as successor
+            # decide what to do, as only it knows no way around it.
+            failed = msg.message.destination
+            for core in self.cores:
+                core.forget_node(failed)
+            owner = ([c for c in self.cores if c.successor == failed]
+                    or self.cores)[0]
+            return GenericOk(self.deliver(owner.handle_message(msg).new_messages))
+
+        result = self.handle_virtual(msg)
+        return result._replace(new_messages=self.deliver(result.new_messages))
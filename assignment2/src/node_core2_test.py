@@ -431,6 +431,182 @@ class TestNodeCore(unittest.TestCase):
         self.assertEqual(result, ncore.GenericOk())
 
 
+class TestFingerTable(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_log_level = ncore.logger.level
+        ncore.logger.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        ncore.logger.setLevel(self.saved_log_level)
+
+    def build_ring(self, count):
+        nodes = [ncore.NodeCore(ncore.NodeDescriptor(host="127.0.0.1", port=8000+i))
+                for i in range(count)]
+        reactor = NodeReactor(*nodes)
+        for node in nodes:
+            reactor.send_msg(ncore.FixFingers(destination=node.descriptor))
+        return (reactor, nodes)
+
+    def owner(self, nodes, key_hash):
+        return [n for n in nodes if n.responsible_for_hash(key_hash)][0].descriptor
+
+    def test_single_node_no_fingers(self):
+        n0 = ncore.NodeCore(node_ranked(0))
+        result = n0.handle_message(ncore.FixFingers())
+        self.assertEqual(result, ncore.GenericOk())
+        self.assertEqual(n0.fingers, [None] * ncore.khash.bits)
+
+    def test_fingers_point_to_owners(self):
+        (reactor, nodes) = self.build_ring(16)
+        for node in nodes:
+            for i in range(ncore.khash.bits):
+                owner = self.owner(nodes, node.finger_start(i))
+                if owner == node.descriptor:
+                    self.assertEqual(node.fingers[i], None)
+                else:
+                    self.assertEqual(node.fingers[i], owner)
+
+    def test_join_takes_few_hops(self):
+        (reactor, nodes) = self.build_ring(32)
+        new_node = ncore.NodeCore(ncore.NodeDescriptor(host="127.0.0.1", port=9000))
+        reactor.nodes[new_node.descriptor.name] = new_node
+        accepting = self.owner(nodes, new_node.descriptor.rank)
+
+        # Follow the join from an arbitrary node until it is accepted
+        msg = ncore.Join(destination=nodes[0].descriptor, new_node=new_node.descriptor)
+        hops = 0
+        while isinstance(msg, ncore.Join):
+            result = reactor.nodes[msg.destination.name].handle_message(msg)
+            msg = result.new_messages[-1]
+            hops += 1
+        self.assertTrue(hops <= 6, "Join took %d hops" % hops)
+        for newmsg in result.new_messages:
+            reactor.send_msg(newmsg)
+        self.assertEqual(new_node.predecessor, accepting)
+
+    def test_next_hop_without_fingers_is_successor(self):
+        d0 = node_ranked(0);    n0 = ncore.NodeCore(d0)
+        d1 = node_ranked(1);    n1 = ncore.NodeCore(d1)
+        d2 = node_ranked(2);    n2 = ncore.NodeCore(d2)
+        NodeReactor(n0, n1, n2)
+        self.assertEqual(n0.next_hop(d2.rank), d1)
+
+        n0.fingers[0] = d2
+        self.assertEqual(n0.next_hop(d2.rank), d2)
+        self.assertEqual(n0.next_hop(d2.rank - 1), d1)
+
+    def test_undeliverable_falls_back_to_successor(self):
+        d0 = node_ranked(0);    n0 = ncore.NodeCore(d0)
+        d1 = node_ranked(1);    n1 = ncore.NodeCore(d1)
+        d2 = node_ranked(2);    n2 = ncore.NodeCore(d2)
+        NodeReactor(n0, n1, n2)
+        n0.fingers[5] = d2
+
+        join = ncore.Join(destination=d2, new_node=node_ranked(3))
+        result = n0.handle_message(ncore.Undeliverable(message=join))
+
+        self.assertEqual(n0.fingers[5], None)
+        self.assertEqual(result, ncore.GenericOk([join._replace(destination=d1)]))
+
+    def test_undeliverable_to_successor_dropped(self):
+        d0 = node_ranked(0);    n0 = ncore.NodeCore(d0)
+        d1 = node_ranked(1);    n1 = ncore.NodeCore(d1)
+        NodeReactor(n0, n1)
+
+        join = ncore.Join(destination=d1, new_node=node_ranked(2))
+        result = n0.handle_message(ncore.Undeliverable(message=join))
+        self.assertEqual(result, ncore.GenericOk())
+
+
+class TestVirtualNodes(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_log_level = ncore.logger.level
+        ncore.logger.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        ncore.logger.setLevel(self.saved_log_level)
+
+    def build_hosts(self, count, vnodes):
+        hosts = [ncore.HostCore(ncore.NodeDescriptor(host="127.0.0.1", port=8000+i), vnodes)
+                for i in range(count)]
+        reactor = NodeReactor()
+        for host in hosts:
+            reactor.join_host(host)
+            for h in hosts:
+                if h.descriptor.name in reactor.nodes:
+                    for msg in h.handle_message(ncore.FixFingers()).new_messages:
+                        reactor.send_msg(msg)
+        return (reactor, hosts)
+
+    def ring(self, reactor, start):
+        """ The virtual nodes found by following successors from start """
+        found = [start]
+        core = reactor.nodes[start.name].core_for(start)
+        while core.successor != None and core.successor != start:
+            found.append(core.successor)
+            successor = reactor.nodes[core.successor.name].core_for(core.successor)
+            self.assertEqual(successor.predecessor, core.descriptor)
+            core = successor
+        return found
+
+    def assertRingOf(self, reactor, hosts):
+        vnodes = sorted([c.descriptor for h in hosts for c in h.cores],
+                key=lambda d: d.rank)
+        ring = self.ring(reactor, vnodes[0])
+        self.assertEqual(ring, vnodes)
+
+    def test_descriptors(self):
+        d = ncore.NodeDescriptor(host_port="127.0.0.1:8000")
+        v = d.virtual(3)
+        self.assertEqual(d.virtual(0), d)
+        self.assertEqual(v.name, "127.0.0.1:8000#3")
+        self.assertEqual(v.host_port, "127.0.0.1:8000")
+        self.assertEqual(v.rank, ncore.node_hash("127.0.0.1:8000#3"))
+        self.assertEqual(ncore.NodeDescriptor(host_port=str(v)), v)
+
+    def test_weight(self):
+        d = ncore.NodeDescriptor(host_port="127.0.0.1:8000")
+        self.assertEqual(len(ncore.HostCore(d).cores), 1)
+        self.assertEqual(len(ncore.HostCore(d, 8, 2.5).cores), 20)
+        self.assertEqual(len(ncore.HostCore(d, 8, 0.01).cores), 1)
+
+    def test_single_host_ring(self):
+        (reactor, hosts) = self.build_hosts(1, 8)
+        self.assertRingOf(reactor, hosts)
+        self.assertTrue(hosts[0].responsible_for_key("a"))
+        for core in hosts[0].cores:
+            self.assertEqual(core.leader, hosts[0].descriptor)
+
+    def test_hosts_join(self):
+        (reactor, hosts) = self.build_hosts(4, 8)
+        self.assertRingOf(reactor, hosts)
+        for i in range(200):
+            owners = [h for h in hosts if h.responsible_for_key(str(i))]
+            self.assertEqual(len(owners), 1)
+
+    def test_shutdown(self):
+        (reactor, hosts) = self.build_hosts(4, 8)
+        for msg in hosts[2].handle_message(ncore.Shutdown()).new_messages:
+            self.assertNotEqual(msg.destination.host_port, hosts[2].descriptor.host_port)
+            reactor.send_msg(msg)
+        self.assertRingOf(reactor, hosts[:2] + hosts[3:])
+
+    def test_shutdown_down_to_one(self):
+        (reactor, hosts) = self.build_hosts(2, 4)
+        for msg in hosts[0].handle_message(ncore.Shutdown()).new_messages:
+            reactor.send_msg(msg)
+        self.assertRingOf(reactor, hosts[1:])
+        self.assertEqual(hosts[1].handle_message(ncore.Shutdown()), ncore.GenericOk())
+
+    def test_vnodes_even_out_load(self):
+        (reactor, hosts) = self.build_hosts(4, 16)
+        keys = [str(i) for i in range(2000)]
+        counts = [len([k for k in keys if h.responsible_for_key(k)]) for h in hosts]
+        self.assertTrue(max(counts) < 2 * min(counts), "Keys per host %s" % counts)
+
+
 class NodeReactor:
     """ Simulated network of nodes that automatically propagates messages
 
@@ -449,7 +625,7 @@ class NodeReactor:
         else:
             existing = None
 
-        self.nodes[new_node.descriptor.host_port] = new_node
+        self.nodes[new_node.descriptor.name] = new_node
 
         if existing:
             self.send_msg(
@@ -457,10 +633,23 @@ class NodeReactor:
                         destination=existing.descriptor,
                         new_node=new_node.descriptor))
 
+    def join_host(self, host):
+        """ Add a HostCore, and have its virtual nodes join the network """
+        if len(self.nodes) > 0:
+            existing = self.nodes.itervalues().next().descriptor
+        else:
+            existing = None
+
+        for core in host.cores:
+            self.nodes[core.descriptor.name] = host
+
+        for msg in host.join(existing):
+            self.send_msg(msg)
+
     def send_msg(self, msg):
         """ Send a message, and propagate any new messages from the result """
         # print("delivering", msg)
-        target = self.nodes[msg.destination.host_port]
+        target = self.nodes[msg.destination.name]
         result = target.handle_message(msg)
         for newmsg in result.new_messages:
             self.send_msg(newmsg)